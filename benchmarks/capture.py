@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import CaptureReader, CaptureWriter, DIRECTION_IN, MappedCaptureReader
+
+
+RECORD_COUNT = 500000
+
+
+class CaptureScanning(object):
+
+    "Records per second read from a capture file of 500k contract quotes"
+
+    unit = 'records/s'
+    timeout = 120
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.cap')
+        payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.contract_quotes.market_id = 1
+        payload.contract_quotes.contract_id = 2
+        payload.contract_quotes.bids.add(price=5000, quantity=10000)
+        with CaptureWriter(self.path) as writer:
+            for seq in range(1, RECORD_COUNT + 1):
+                payload.eto_payload.seq = seq
+                writer.write(DIRECTION_IN, payload.SerializeToString(), timestamp=seq * 1000)
+        # Build the index outside of the measurements
+        MappedCaptureReader(self.path).close()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _track(self, reader):
+        start = time.time()
+        records = 0
+        for _ in reader:
+            records += 1
+        duration = time.time() - start
+        reader.close()
+        return records / duration
+
+    def track_capture_reader(self):
+        return self._track(CaptureReader(self.path))
+
+    def track_mapped_capture_reader(self):
+        return self._track(MappedCaptureReader(self.path))
+
+    def time_seek_time_window(self):
+        with MappedCaptureReader(self.path) as reader:
+            middle = reader.wall_clock(RECORD_COUNT // 2 * 1000)
+            for _ in reader.window(middle, middle + 1e-5):
+                pass
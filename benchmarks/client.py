@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.session import Frame, LazyFrame, Session, SessionSettings
+
+
+FRAME_COUNT = 10000
+
+
+def _quotes_frames(lazy):
+    frames = []
+    for seq in range(1, FRAME_COUNT + 1):
+        payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+        payload.eto_payload.seq = seq
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.contract_quotes.market_id = 1
+        payload.contract_quotes.contract_id = 2
+        payload.contract_quotes.bids.add(price=5000, quantity=10000)
+        if lazy:
+            frames.append(LazyFrame(
+                payload.SerializeToString(), seto.PAYLOAD_CONTRACT_QUOTES, seq, eto.PAYLOAD_NONE))
+        else:
+            frames.append(Frame(bytes=payload.SerializeToString(), protobuf=payload))
+    return frames
+
+
+class Dispatch(object):
+
+    "Dispatching 10k contract quotes frames to the client callbacks"
+
+    params = [['none', 'named', 'global', 'batch'], [False, True]]
+    param_names = ['handler', 'lazy']
+
+    def setup(self, handler, lazy):
+        self.client = StreamingAPIClient(None)
+        if handler == 'named':
+            self.client.add_handler('seto.contract_quotes', lambda message: None)
+        elif handler == 'global':
+            self.client.add_global_handler(lambda name, message: None)
+        elif handler == 'batch':
+            self.client.add_batch_handler('seto.contract_quotes', lambda messages: None)
+        self.frames = _quotes_frames(lazy)
+
+    def time_dispatch(self, handler, lazy):
+        dispatch = self.client._dispatch
+        for frame in self.frames:
+            dispatch(frame)
+        self.client._deliver_batches()
+
+
+class DispatchHandlers(object):
+
+    "Dispatching 10k contract quotes frames with a varying number of named handlers"
+
+    params = [0, 1, 10]
+    param_names = ['handlers']
+
+    def setup(self, handlers):
+        self.client = StreamingAPIClient(None)
+        for _ in range(handlers):
+            self.client.add_handler('seto.contract_quotes', lambda message: None)
+        self.frames = _quotes_frames(lazy=False)
+
+    def time_dispatch(self, handlers):
+        dispatch = self.client._dispatch
+        for frame in self.frames:
+            dispatch(frame)
+
+
+class Requoting(object):
+
+    """
+    Building and buffering a burst of 200 order creates, sent one by one with
+    StreamingAPIClient.send or all at once with send_many, or built in place with compose
+    """
+
+    params = ['send', 'send_many', 'compose']
+    param_names = ['method']
+
+    def setup(self, method):
+        self.client = StreamingAPIClient(Session(SessionSettings('username', 'password')))
+
+    def time_requote(self, method):
+        client = self.client
+        if method == 'send':
+            for index in range(200):
+                client.send(seto.OrderCreate(
+                    market_id=1, contract_id=2, side=seto.SIDE_BUY, quantity=10000,
+                    price=5000 - index, reference=index))
+        elif method == 'send_many':
+            client.send_many([
+                seto.OrderCreate(
+                    market_id=1, contract_id=2, side=seto.SIDE_BUY, quantity=10000,
+                    price=5000 - index, reference=index)
+                for index in range(200)])
+        else:
+            for index in range(200):
+                with client.compose('order_create') as order:
+                    order.market_id = 1
+                    order.contract_id = 2
+                    order.side = seto.SIDE_BUY
+                    order.quantity = 10000
+                    order.price = 5000 - index
+                    order.reference = index
+        session = client.session
+        session.send_queue.clear()
+        session._send_chunk = None
@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from smarkets.streaming_api.framing import (
+    frame_decode_all, frame_encode, frame_index, FrameDecoder, uleb128_decode, uleb128_encode,
+)
+
+
+# A typical contract quotes update is a few dozen bytes long
+PAYLOAD_SIZE = 40
+STREAM_SIZE = 4 * 1024 * 1024
+
+
+def _stream(payload_size, stream_size):
+    stream = bytearray()
+    payload = b'x' * payload_size
+    while len(stream) < stream_size:
+        frame_encode(stream, payload)
+    return bytes(stream)
+
+
+def _chunks(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+class FrameDecoding(object):
+
+    "Frames per second decoded when data arrives in chunks of given size"
+
+    params = [1024, 65536, 1024 * 1024]
+    param_names = ['chunk_size']
+    unit = 'frames/s'
+
+    def setup(self, chunk_size):
+        self.chunks = _chunks(_stream(PAYLOAD_SIZE, STREAM_SIZE), chunk_size)
+
+    def track_frame_decoder(self, chunk_size):
+        decoder = FrameDecoder()
+        frames = 0
+        start = time.time()
+        for chunk in self.chunks:
+            decoder.feed(chunk)
+            for _ in decoder.decode():
+                frames += 1
+        return frames / (time.time() - start)
+
+    def track_frame_decode_all(self, chunk_size):
+        read_buffer = bytearray()
+        frames = 0
+        start = time.time()
+        for chunk in self.chunks:
+            read_buffer += chunk
+            payloads, read_buffer = frame_decode_all(read_buffer)
+            frames += len(payloads)
+        return frames / (time.time() - start)
+
+
+class FrameIndexing(object):
+
+    "Locating frame boundaries in a buffer full of frames"
+
+    params = [16, 40, 200, 2000]
+    param_names = ['payload_size']
+
+    def setup(self, payload_size):
+        self.buffer = bytearray(_stream(payload_size, 65536))
+
+    def time_frame_index(self, payload_size):
+        frame_index(self.buffer)
+
+
+class FrameEncoding(object):
+
+    "Encoding 1000 payloads of given size into a buffer"
+
+    params = [16, 40, 200, 2000, 65536]
+    param_names = ['payload_size']
+
+    def setup(self, payload_size):
+        self.payload = b'x' * payload_size
+
+    def time_frame_encode(self, payload_size):
+        frame = bytearray()
+        payload = self.payload
+        for _ in range(1000):
+            frame_encode(frame, payload)
+
+
+class ULEB128(object):
+
+    "Encoding and decoding 1000 ULEB128 numbers of given size"
+
+    params = [0x7f, 0x3fff, 0x1fffff, 2 ** 35]
+    param_names = ['value']
+
+    def setup(self, value):
+        self.encoded = bytes(uleb128_encode(value))
+
+    def time_uleb128_encode(self, value):
+        for _ in range(1000):
+            uleb128_encode(value)
+
+    def time_uleb128_decode(self, value):
+        encoded = self.encoded
+        for _ in range(1000):
+            uleb128_decode(encoded)
+
+
+class FrameDecodeAll(object):
+
+    "Decoding a whole buffer of contract quotes sized frames at once"
+
+    params = [1024, 65536, 1024 * 1024]
+    param_names = ['buffer_size']
+
+    def setup(self, buffer_size):
+        self.buffer = bytearray(_stream(PAYLOAD_SIZE, buffer_size))
+
+    def time_frame_decode_all(self, buffer_size):
+        frame_decode_all(self.buffer)
@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import time
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import CaptureWriter, DIRECTION_IN
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import SocketDisconnected
+from smarkets.streaming_api.replay import ReplaySession
+from smarkets.streaming_api.session import SessionSettings
+
+
+FRAME_COUNT = 100000
+FRAMES_PER_READ = 100
+
+
+class Replay(object):
+
+    "Contract quotes per second replayed from a capture through a client with a handler"
+
+    params = [False, True]
+    param_names = ['lazy_parse']
+    unit = 'frames/s'
+
+    def setup(self, lazy_parse):
+        self.capture_file = io.BytesIO()
+        writer = CaptureWriter(self.capture_file)
+        payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.contract_quotes.market_id = 1
+        payload.contract_quotes.contract_id = 2
+        payload.contract_quotes.bids.add(price=5000, quantity=10000)
+        for seq in range(1, FRAME_COUNT + 1):
+            payload.eto_payload.seq = seq
+            writer.write(DIRECTION_IN, payload.SerializeToString(), timestamp=seq // FRAMES_PER_READ)
+        writer.flush()
+
+    def track_replay(self, lazy_parse):
+        settings = SessionSettings('username', 'password', lazy_parse=lazy_parse)
+        client = StreamingAPIClient(ReplaySession(settings, self.capture_file))
+        client.add_handler('seto.contract_quotes', lambda message: None)
+        client.login(receive=False)
+        frames = 0
+        start = time.time()
+        try:
+            while True:
+                frames += client.read()
+        except SocketDisconnected:
+            pass
+        return frames / (time.time() - start)
@@ -0,0 +1,151 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import threading
+import time
+from collections import deque
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_encode, FrameDecoder
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+STREAM_SIZE = 16 * 1024 * 1024
+
+
+def _stream(payload_size, stream_size):
+    "A stream of at least `stream_size` bytes and the number of frames in it"
+    stream = bytearray()
+    payload = b'x' * payload_size
+    frame_count = 0
+    while len(stream) < stream_size:
+        frame_encode(stream, payload)
+        frame_count += 1
+    return bytes(stream), frame_count
+
+
+class SocketReading(object):
+
+    """
+    Frames per second read from a local socket and decoded by :meth:`Session.read` with
+    varying `SessionSettings.read_chunksize`, for contract quotes sized payloads and for
+    large ones.
+    """
+
+    params = [[1024, 4096, 16384, 65536, 262144, 1024 * 1024], [40, 2000]]
+    param_names = ['read_chunksize', 'payload_size']
+    unit = 'frames/s'
+    timeout = 120
+
+    def setup(self, read_chunksize, payload_size):
+        self.stream, self.frame_count = _stream(payload_size, STREAM_SIZE)
+
+    def _read_stream(self, read):
+        "Receive the stream with `read`, which returns the number of decoded frames"
+        reader, writer = socket.socketpair()
+        sender = threading.Thread(target=writer.sendall, args=(self.stream,))
+        frames = 0
+        start = time.time()
+        sender.start()
+        try:
+            while frames < self.frame_count:
+                frames += read(reader)
+        finally:
+            sender.join()
+            reader.close()
+            writer.close()
+        return frames / (time.time() - start)
+
+    def track_session_read(self, read_chunksize, payload_size):
+        session = Session(SessionSettings('username', 'password'))
+        session.settings.read_chunksize = read_chunksize
+        payloads = session.buffered_incoming_payloads
+
+        def read(sock):
+            session.socket._sock = sock
+            session.read()
+            frames = len(payloads)
+            payloads.clear()
+            return frames
+
+        return self._read_stream(read)
+
+    def track_recv_and_feed(self, read_chunksize, payload_size):
+        "Receiving new byte strings copied into the decoder, like Session.read used to"
+        decoder = FrameDecoder()
+        payloads = deque()
+
+        def read(sock):
+            decoder.feed(sock.recv(read_chunksize))
+            payloads.extend(decoder.decode())
+            frames = len(payloads)
+            payloads.clear()
+            return frames
+
+        return self._read_stream(read)
+
+
+def _drain(sock):
+    "Receive and discard everything until the other end is closed"
+    while sock.recv(1024 * 1024):
+        pass
+
+
+class Sending(object):
+
+    "Sending contract quotes sized payloads with Session.send and flushing them to a local socket"
+
+    params = [1, 100, 1000]
+    param_names = ['payloads_per_flush']
+
+    def setup(self, payloads_per_flush):
+        self.writer, self.reader = socket.socketpair()
+        self.drainer = threading.Thread(target=_drain, args=(self.reader,))
+        self.drainer.start()
+        self.session = Session(SessionSettings('username', 'password'))
+        self.session.socket._sock = self.writer
+        payload = self.session.out_payload
+        payload.type = seto.PAYLOAD_ORDER_CANCEL
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.order_cancel.order_id = 12345
+
+    def teardown(self, payloads_per_flush):
+        self.writer.close()
+        self.drainer.join()
+        self.reader.close()
+
+    def time_send_and_flush(self, payloads_per_flush):
+        session = self.session
+        for _ in range(1000 // payloads_per_flush):
+            for _ in range(payloads_per_flush):
+                session.send()
+            session.flush()
+
+
+class NextFrame(object):
+
+    "Taking frames off the buffered incoming payloads with Session.next_frame"
+
+    params = [[1, 100, 10000], [False, True]]
+    param_names = ['buffered_payloads', 'lazy']
+
+    def setup(self, buffered_payloads, lazy):
+        settings = SessionSettings('username', 'password', lazy_parse=lazy)
+        self.session = Session(settings)
+        self.payloads = []
+        for seq in range(1, buffered_payloads + 1):
+            payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+            payload.eto_payload.seq = seq
+            payload.eto_payload.type = eto.PAYLOAD_NONE
+            payload.contract_quotes.market_id = 1
+            payload.contract_quotes.contract_id = 2
+            payload.contract_quotes.bids.add(price=5000, quantity=10000)
+            self.payloads.append(payload.SerializeToString())
+
+    def time_next_frame(self, buffered_payloads, lazy):
+        session = self.session
+        session.inseq = 1
+        session.buffered_incoming_payloads.extend(self.payloads)
+        next_frame = session.next_frame
+        while next_frame() is not None:
+            pass
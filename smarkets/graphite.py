@@ -54,7 +54,7 @@ class Graphite(object):
 
         try:
             message = "%s %s %s\n" % (metric, value, timestamp)
-            send_fun(message)
+            send_fun(message.encode('utf-8'))
         except socket.error as e:
             log.warn('Cannot send stuff to Graphite: %r', e)
             self._socket = None
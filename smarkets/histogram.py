@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__all__ = ('Histogram',)
+
+
+class Histogram(object):
+
+    """Distribution of recorded non-negative integers in power of two buckets.
+
+    Bucket ``i`` counts values whose bit length is ``i``: 0 goes to bucket 0, 1 to bucket 1,
+    2-3 to bucket 2, 4-7 to bucket 3 and so on. Recording a value is cheap and the memory
+    used doesn't depend on the number of values recorded.
+
+    For more precision each power of two range can be split in ``2 ** significant_bits``
+    linear sub-buckets like in HDR histograms: values below ``2 ** (significant_bits + 1)``
+    get a bucket each and the relative error of larger ones is at most
+    ``2 ** -significant_bits``.
+
+        >>> histogram = Histogram()
+        >>> for value in (0, 1, 3, 3, 900):
+        ...     histogram.record(value)
+        >>> histogram.count, histogram.min, histogram.max
+        (5, 0, 900)
+        >>> histogram.buckets()
+        [(0, 1), (1, 1), (3, 2), (1023, 1)]
+        >>> histogram.percentile(50)
+        3
+        >>> histogram.percentile(100)
+        900
+        >>> precise = Histogram(significant_bits=3)
+        >>> precise.record(900)
+        >>> precise.buckets()
+        [(959, 1)]
+    """
+
+    __slots__ = ('significant_bits', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, significant_bits=0):
+        self.significant_bits = significant_bits
+        self.reset()
+
+    def reset(self):
+        "Forget all recorded values"
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        :type value: non-negative int
+        """
+        significant_bits = self.significant_bits
+        shift = value.bit_length() - significant_bits - 1
+        bucket = (shift << significant_bits) + (value >> shift) if shift > 0 else value
+        counts = self.counts
+        if bucket >= len(counts):
+            counts.extend([0] * (bucket + 1 - len(counts)))
+        counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket containing the `percent` percentile (capped at the largest
+        recorded value), None when nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def buckets(self):
+        """
+        :return: upper bound and count of each non-empty bucket
+        :rtype: list of (int, int) tuples
+        """
+        return [(self._upper_bound(bucket), count) for bucket, count in enumerate(self.counts) if count]
+
+    def _upper_bound(self, bucket):
+        "Largest value recorded in `bucket`"
+        significant_bits = self.significant_bits
+        shift = (bucket >> significant_bits) - 1
+        if shift <= 0:
+            return bucket
+        return ((bucket - (shift << significant_bits) + 1) << shift) - 1
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Statistics of the recorded values named ``count``, ``min``, ``mean``, ``max`` and
+        ``p<percentile>`` (with the decimal point replaced by an underscore, ``p99_9``), ready
+        to be sent to a metrics service.
+
+        :rtype: list of (str, number) tuples
+        """
+        statistics = [('count', self.count), ('min', self.min), ('mean', self.mean), ('max', self.max)]
+        for percent in percentiles:
+            name = 'p' + ('%g' % percent).replace('.', '_')
+            statistics.append((name, self.percentile(percent)))
+        return statistics
+
+    def __repr__(self):
+        return '%s(count=%s, min=%s, mean=%s, max=%s)' % (
+            type(self).__name__, self.count, self.min, self.mean, self.max)
@@ -57,6 +57,17 @@ class StatsD(object):
         """
         self.update_stats(stats, -1, sample_rate)
 
+    def gauge(self, stats, value, sample_rate=1):
+        """
+        Sets one or more gauges to a value
+        """
+        if not self.enabled or self.addr is None:
+            return
+
+        if type(stats) is not list:
+            stats = [stats]
+        self.send(dict(("%s%s" % (self.prefix, stat), "%s|g" % value) for stat in stats), sample_rate)
+
     def update_stats(self, stats, delta=1, sampleRate=1):
         """
         Updates one or more stats counters by arbitrary amounts
@@ -84,7 +95,7 @@ class StatsD(object):
 
         try:
             for stat, value in sampled_data.items():
-                self.udp_sock.sendto("%s:%s" % (stat, value), self.addr)
+                self.udp_sock.sendto(("%s:%s" % (stat, value)).encode('utf-8'), self.addr)
         except Exception as e:
             log.exception('Failed to send data to the server: %r', e)
 
@@ -0,0 +1,318 @@
+"asyncio based Smarkets streaming API session and client (Python 3.5+)"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+import asyncio
+import logging
+import socket
+import ssl
+import sys
+from collections import deque
+
+from smarkets import private
+from smarkets.streaming_api.client import (
+    READ_MODE_BUFFER_AND_DISPATCH, READ_MODE_BUFFER_FROM_SOCKET, READ_MODE_DISPATCH_FROM_BUFFER,
+    StreamingAPIClient,
+)
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.keepalive import BaseKeepalive
+from smarkets.streaming_api.session import Session
+
+__all__ = ('AsyncKeepalive', 'AsyncSession', 'AsyncStreamingAPIClient')
+
+
+class _SessionProtocol(asyncio.Protocol):
+
+    "Feeds data received from the transport to an :class:`AsyncSession`"
+
+    def __init__(self, session):
+        self.session = session
+        self.transport = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and self.session.settings.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data):
+        self.session._data_received(data)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        # Nobody will ever resume writing, don't leave drain() waiting
+        self._writable.set()
+        self.session._connection_lost(exc)
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+
+class AsyncSession(Session):
+
+    """
+    :class:`Session` running on an asyncio event loop instead of a blocking socket.
+
+    Login, sequencing and heartbeat handling are the ones of :class:`Session`, only the
+    transport differs: incoming data is decoded as soon as the event loop receives it and
+    :meth:`flush` hands all buffered frames to the transport at once. Many sessions can
+    share a single event loop.
+    """
+    logger = private(logging.getLogger('smarkets.session.async'))
+
+    def __init__(self, settings, inseq=1, outseq=1, account_sequence=None, loop=None, capture=None,
+                 instrumentation=None):
+        """
+        :type setting: :class:`SessionSettings`
+        :type loop: :class:`asyncio.AbstractEventLoop` or None for the current event loop
+        """
+        super(AsyncSession, self).__init__(
+            settings, inseq=inseq, outseq=outseq, account_sequence=account_sequence, capture=capture,
+            instrumentation=instrumentation)
+        # The transport is owned by the protocol, there's no blocking socket
+        self.socket = None
+        self.loop = loop
+        self._protocol = None
+        self._data_ready = asyncio.Event()
+        self._disconnect_reason = None
+
+    @property
+    def raw_socket(self):
+        if self._protocol is None:
+            return None
+        return self._protocol.transport.get_extra_info('socket')
+
+    @property
+    def connected(self):
+        return self._protocol is not None
+
+    async def connect(self):
+        "Connects to the API and logs in if not already connected"
+        if self._protocol is not None:
+            self.logger.debug("connect() called, but already connected")
+            return
+        loop = self.loop or asyncio.get_event_loop()
+        self.logger.info(
+            "connecting with new transport to %s:%s", self.settings.host, self.settings.port)
+        try:
+            _transport, protocol = await asyncio.wait_for(
+                loop.create_connection(
+                    lambda: _SessionProtocol(self), self.settings.host, self.settings.port,
+                    ssl=_ssl_context(self.settings.ssl_kwargs) if self.settings.ssl else None,
+                ),
+                self.settings.socket_timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError(
+                'Error connecting to %s:%s. %r.' % (self.settings.host, self.settings.port, e))
+
+        self._protocol = protocol
+        self._disconnect_reason = None
+        self._login()
+
+    def disconnect(self):
+        "Disconnects from the API"
+        if self._protocol is not None:
+            self.logger.info("closing transport")
+            self._protocol.transport.close()
+            self._protocol = None
+        self.logged_in = False
+        self.inseq = self.init_inseq
+        self.outseq = self.init_outseq
+
+    def flush(self):
+        "Hand all buffered frames to the transport, see :meth:`drain` for flow control"
+        if not self.send_queue:
+            return
+        if self._protocol is None:
+            raise SocketDisconnected('Trying to write to socket when disconnected')
+        self.flush_logger.debug("Flushing %d bytes", self.output_buffer_size)
+        if self.instrumentation is not None:
+            self.instrumentation.record_sent(self.output_buffer_size)
+        self._protocol.transport.writelines(self.send_queue)
+        # The transport may keep referencing the chunks, start from scratch instead of reusing them
+        self.send_queue = deque()
+        self._send_chunk = None
+
+    async def drain(self):
+        "Wait until the transport's write buffer is below its high-water mark"
+        if self._protocol is not None:
+            await self._protocol._writable.wait()
+
+    async def read(self):
+        """
+        Wait until there are incoming payloads to process.
+
+        :raises:
+            :SocketDisconnected: when the connection is lost.
+            :ConnectionError: when no data is received within `socket_timeout`.
+        """
+        while not self.buffered_incoming_payloads:
+            if self._protocol is None:
+                raise SocketDisconnected(
+                    'Trying to read from a socket when disconnected: %r' % (self._disconnect_reason,))
+            self._data_ready.clear()
+            try:
+                await asyncio.wait_for(self._data_ready.wait(), self.settings.socket_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError('Error while reading from socket: timed out')
+
+    def _data_received(self, data):
+        received_at = self.instrumentation.clock() if self.instrumentation is not None else None
+        self.decoder.feed(data)
+        self._buffer_payloads(self.decoder.decode(), len(data), received_at)
+        self._data_ready.set()
+
+    def _connection_lost(self, exc):
+        self.logger.info("connection lost: %r", exc)
+        self._protocol = None
+        self._disconnect_reason = exc
+        self._data_ready.set()
+
+
+def _ssl_context(ssl_kwargs):
+    "Build an SSL context equivalent to :func:`ssl.wrap_socket` called with `ssl_kwargs`"
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+    context.check_hostname = False
+    context.verify_mode = ssl_kwargs.get('cert_reqs', ssl.CERT_NONE)
+    if ssl_kwargs.get('ca_certs'):
+        context.load_verify_locations(ssl_kwargs['ca_certs'])
+    if ssl_kwargs.get('certfile'):
+        context.load_cert_chain(ssl_kwargs['certfile'], ssl_kwargs.get('keyfile'))
+    if ssl_kwargs.get('ciphers'):
+        context.set_ciphers(ssl_kwargs['ciphers'])
+    return context
+
+
+class AsyncStreamingAPIClient(StreamingAPIClient):
+
+    """
+    :class:`StreamingAPIClient` for :class:`AsyncSession`.
+
+    Handlers and dispatching work exactly like in :class:`StreamingAPIClient`. Iterating
+    over the client (``async for frame in client``) dispatches and yields incoming frames
+    until the connection is closed.
+    """
+
+    _last_frame = None
+
+    async def login(self, receive=True):
+        "Connect and ensure the session is active"
+        await self.session.connect()
+        if receive:
+            await self.read()
+            self.check_login()
+            await self.flush()
+
+    async def logout(self, receive=True):
+        """
+        Disconnect and send logout message, optionally waiting for
+        confirmation.
+        """
+        self.last_login = None
+        self.session.logout()
+        if receive:
+            await self.read()
+            await self.flush()
+
+        self.session.disconnect()
+
+    async def read(self, read_mode=READ_MODE_BUFFER_AND_DISPATCH, limit=sys.maxsize):
+        """
+        .. note::
+            This method will wait until it can read *any* data from the remote endpoint.
+        :return: Number of processed incoming messages.
+        :rtype: int
+        """
+        if read_mode & READ_MODE_BUFFER_FROM_SOCKET:
+            await self.session.read()
+
+        if read_mode & READ_MODE_DISPATCH_FROM_BUFFER:
+            return self._dispatch_buffered(limit)
+        return 0
+
+    async def flush(self):
+        "Flush the send buffer"
+        self.session.flush()
+        await self.session.drain()
+
+    async def send(self, message):
+        StreamingAPIClient.send(self, message)
+
+    async def send_many(self, messages, flush=False):
+        sent = StreamingAPIClient.send_many(self, messages)
+        if flush:
+            await self.flush()
+        return sent
+
+    async def ping(self):
+        "Ping the service"
+        StreamingAPIClient.ping(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        Dispatch and return the next incoming frame. The previously returned frame is released
+        to the session.
+        """
+        if self._last_frame is not None:
+            self.session.release_frame(self._last_frame)
+            self._last_frame = None
+        while True:
+            frame = self.session.next_frame()
+            if frame:
+                if self._dispatch(frame):
+                    self._deliver_batches()
+                instrumentation = self.session.instrumentation
+                if instrumentation is not None:
+                    instrumentation.record_frame(
+                        self._frame_name(frame), self.session.frame_times, instrumentation.clock())
+                self._last_frame = frame
+                return frame
+            if not self.session.buffered_incoming_payloads:
+                try:
+                    await self.session.read()
+                except SocketDisconnected:
+                    raise StopAsyncIteration
+
+
+class AsyncKeepalive(BaseKeepalive):
+
+    """
+    :class:`smarkets.streaming_api.keepalive.BaseKeepalive` running as a task of the event
+    loop of an :class:`AsyncStreamingAPIClient`'s session, for applications that don't
+    iterate over the client often enough to answer heartbeats in time. It can't help if the
+    event loop itself is blocked::
+
+        keepalive = AsyncKeepalive(client)
+        keepalive.start()
+        ...
+        keepalive.stop()
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncKeepalive, self).__init__(*args, **kwargs)
+        self._task = None
+
+    def start(self):
+        self._attach()
+        loop = self.session.loop or asyncio.get_event_loop()
+        self._task = loop.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+        self._task = None
+        self._detach()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.max_flush_delay)
+            self.service()
@@ -0,0 +1,370 @@
+"Recording of the frames a session sends and receives"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+from smarkets.streaming_api.exceptions import ParseError
+from smarkets.streaming_api.framing import frame_header, frame_index, FrameDecoder
+from smarkets.streaming_api.utils import peek_payload
+
+__all__ = (
+    'CaptureReader', 'CaptureRecord', 'CaptureWriter', 'DIRECTION_IN', 'DIRECTION_OUT',
+    'IndexEntry', 'MappedCaptureReader',
+)
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+# A capture file starts with a header holding the wall clock and monotonic clock times (in
+# nanoseconds) of its creation, followed by records framed like the payloads on the wire
+# (ULEB128 length prefix). Each record is the direction, the monotonic time in nanoseconds
+# and the raw serialised seto.Payload.
+_MAGIC = b'SMKCAP01'
+_FILE_HEADER = struct.Struct('<8sQQ')
+_RECORD_HEADER = struct.Struct('<BQ')
+
+try:
+    monotonic_ns = time.monotonic_ns
+except AttributeError:
+    _monotonic = getattr(time, 'monotonic', time.time)
+
+    def monotonic_ns():
+        return int(_monotonic() * 1e9)
+
+
+def _wall_clock_ns():
+    return int(time.time() * 1e9)
+
+
+def _open(file_or_path, mode):
+    "Open `file_or_path` unless it's a file object already, return the file and whether we own it"
+    if hasattr(file_or_path, 'read') or hasattr(file_or_path, 'write'):
+        return file_or_path, False
+    return open(file_or_path, mode), True
+
+
+class CaptureWriter(object):
+
+    """
+    Appends frames to a capture file, see :class:`Session`'s `capture` argument.
+
+    Records are buffered in memory and written out in large blocks, :meth:`flush` or
+    :meth:`close` the writer to make sure everything is on disk.
+    """
+
+    _FLUSH_SIZE = 1024 * 1024
+
+    def __init__(self, file_or_path, clock=monotonic_ns):
+        """
+        :param file_or_path: path or binary file object opened for appending
+        :param clock: returns the current monotonic time in nanoseconds
+        """
+        self._file, self._owns_file = _open(file_or_path, 'ab')
+        self.clock = clock
+        self._buffer = bytearray()
+        self._file.seek(0, 2)
+        if not self._file.tell():
+            self._buffer += _FILE_HEADER.pack(_MAGIC, _wall_clock_ns(), clock())
+
+    def write(self, direction, payload, timestamp=None):
+        """
+        :param direction: :data:`DIRECTION_IN` or :data:`DIRECTION_OUT`
+        :type payload: bytes-like object
+        :param timestamp: monotonic time in nanoseconds, now if None
+        """
+        if timestamp is None:
+            timestamp = self.clock()
+        buffer_ = self._buffer
+        buffer_ += frame_header(_RECORD_HEADER.size + len(payload))
+        buffer_ += _RECORD_HEADER.pack(direction, timestamp)
+        buffer_ += payload
+        if len(buffer_) >= self._FLUSH_SIZE:
+            self.flush()
+
+    def write_many(self, direction, payloads):
+        "Write `payloads`, all with the current time"
+        timestamp = self.clock()
+        for payload in payloads:
+            self.write(direction, payload, timestamp)
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureRecord(namedtuple('CaptureRecord', 'direction timestamp payload')):
+
+    "A captured frame, `timestamp` is the monotonic time in nanoseconds it was recorded at"
+
+
+class CaptureReader(object):
+
+    """
+    Iterates over the :class:`CaptureRecord` objects of a capture file. Payloads are
+    :class:`memoryview` objects.
+    """
+
+    def __init__(self, file_or_path, chunk_size=1024 * 1024):
+        """
+        :param file_or_path: path or binary file object
+        :param chunk_size: number of bytes read from the file at once
+        """
+        self._file, self._owns_file = _open(file_or_path, 'rb')
+        self.chunk_size = chunk_size
+        self._file.seek(0)
+        header = self._file.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size or not header.startswith(_MAGIC):
+            raise ParseError('Not a capture file')
+        _, self.start_wall_clock, self.start_monotonic = _FILE_HEADER.unpack(header)
+
+    def wall_clock(self, timestamp):
+        "Convert a record timestamp to seconds since the epoch"
+        return (self.start_wall_clock + timestamp - self.start_monotonic) / 1e9
+
+    def __iter__(self):
+        self._file.seek(_FILE_HEADER.size)
+        decoder = FrameDecoder()
+        read = self._file.read
+        unpack_from = _RECORD_HEADER.unpack_from
+        header_size = _RECORD_HEADER.size
+        while True:
+            data = read(self.chunk_size)
+            if not data:
+                break
+            decoder.feed(data)
+            for record in decoder.decode():
+                direction, timestamp = unpack_from(record)
+                yield CaptureRecord(direction, timestamp, record[header_size:])
+        if len(decoder):
+            raise ParseError('Capture file ends with an incomplete record')
+
+    def close(self):
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class IndexEntry(namedtuple('IndexEntry', 'offset timestamp seq')):
+
+    "Offset of an incoming payload record in a capture file with its timestamp and ETO sequence"
+
+
+# The index file starts with the size of the capture file indexed so far, followed by entries
+_INDEX_MAGIC = b'SMKIDX01'
+_INDEX_HEADER = struct.Struct('<8sQ')
+_INDEX_ENTRY = struct.Struct('<QQQ')
+
+
+class MappedCaptureReader(object):
+
+    """
+    Reads a capture file through :mod:`mmap`, records are :class:`CaptureRecord` objects with
+    payloads being :class:`memoryview` slices of the mapped file, nothing is copied.
+
+    A sparse index of the incoming payloads (an entry every `index_interval` bytes) is kept
+    in a sidecar file next to the capture (``<path>.idx``) to seek to a point in time or to
+    an ETO sequence number without reading everything before it. The index is built by the
+    first scan and extended when the capture has grown since.
+
+    Python 3 only (payload headers are decoded by indexing memoryviews).
+    """
+
+    def __init__(self, path, index_interval=1024 * 1024, index_path=None):
+        """
+        :param path: capture file path
+        :param index_interval: approximate number of bytes between index entries
+        :param index_path: sidecar index path, None for `path` + ``.idx``
+        """
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.index_interval = index_interval
+        with open(path, 'rb') as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size < _FILE_HEADER.size:
+                raise ParseError('Not a capture file')
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        header = self._view[:_FILE_HEADER.size].tobytes()
+        if len(header) < _FILE_HEADER.size or not header.startswith(_MAGIC):
+            self.close()
+            raise ParseError('Not a capture file')
+        _, self.start_wall_clock, self.start_monotonic = _FILE_HEADER.unpack(header)
+        self.index = self._load_index()
+
+    def wall_clock(self, timestamp):
+        "Convert a record timestamp to seconds since the epoch"
+        return (self.start_wall_clock + timestamp - self.start_monotonic) / 1e9
+
+    def timestamp(self, wall_clock):
+        "Convert seconds since the epoch to a record timestamp"
+        return int(wall_clock * 1e9) - self.start_wall_clock + self.start_monotonic
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, offset=_FILE_HEADER.size):
+        """
+        Iterate over records starting with the one at `offset`.
+
+        :rtype: iterator of :class:`CaptureRecord`
+        """
+        for _, _, record in self._records(offset):
+            yield record
+
+    def seek_time(self, wall_clock):
+        """
+        :return: offset of an indexed record at or before the first record captured at or
+            after `wall_clock` (seconds since the epoch)
+        :rtype: int
+        """
+        timestamps = [entry.timestamp for entry in self.index]
+        # The last entry before the time, records with the same timestamp may precede an entry
+        position = bisect_left(timestamps, self.timestamp(wall_clock)) - 1
+        return self.index[position].offset if position >= 0 else _FILE_HEADER.size
+
+    def seek_seq(self, seq):
+        """
+        :return: offset of an indexed record at or before the incoming payload with ETO
+            sequence number `seq`. Sequence numbers restart with each login, the offset is for
+            the last session captured in the file.
+        :rtype: int
+        """
+        offset = _FILE_HEADER.size
+        for entry in self.index:
+            if entry.seq <= seq:
+                offset = entry.offset
+        return offset
+
+    def window(self, start, end, direction=DIRECTION_IN):
+        """
+        Records in `direction` captured between `start` (inclusive) and `end` (exclusive),
+        both in seconds since the epoch.
+
+        :rtype: iterator of :class:`CaptureRecord`
+        """
+        start_timestamp = self.timestamp(start)
+        end_timestamp = self.timestamp(end)
+        for record in self.records(self.seek_time(start)):
+            if record.timestamp >= end_timestamp:
+                break
+            if record.timestamp >= start_timestamp and record.direction == direction:
+                yield record
+
+    def close(self):
+        self.index = None
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Payloads are still referenced, the mapping is closed once they're gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _records(self, offset):
+        "Iterate over (start offset, end offset, record) of records starting at `offset`"
+        view = self._view
+        end = len(view)
+        unpack_from = _RECORD_HEADER.unpack_from
+        header_size = _RECORD_HEADER.size
+        while offset < end:
+            # Records are indexed a window at a time, widened for records larger than it
+            window = self._SCAN_SIZE
+            while True:
+                stop = min(offset + window, end)
+                index, next_offset = frame_index(view, offset, stop)
+                if index or stop == end:
+                    break
+                window *= 2
+            if not index:
+                # An incomplete record at the end, still being written
+                break
+            for payload_offset, size in index:
+                direction, timestamp = unpack_from(view, payload_offset)
+                record_end = payload_offset + size
+                yield offset, record_end, CaptureRecord(
+                    direction, timestamp, view[payload_offset + header_size:record_end])
+                offset = record_end
+
+    _SCAN_SIZE = 1024 * 1024
+
+    def _load_index(self):
+        indexed_size = _FILE_HEADER.size
+        entries = []
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            data = b''
+        if data.startswith(_INDEX_MAGIC) and len(data) >= _INDEX_HEADER.size:
+            _, indexed_size = _INDEX_HEADER.unpack_from(data)
+            entries = [
+                IndexEntry(*_INDEX_ENTRY.unpack_from(data, offset))
+                for offset in range(_INDEX_HEADER.size, len(data) - _INDEX_ENTRY.size + 1,
+                                    _INDEX_ENTRY.size)
+            ]
+            if indexed_size > len(self._view):
+                # Not the index of this capture
+                indexed_size, entries = _FILE_HEADER.size, []
+
+        if indexed_size < len(self._view):
+            indexed_size = self._extend_index(entries, indexed_size)
+            self._write_index(entries, indexed_size)
+        return entries
+
+    def _extend_index(self, entries, offset):
+        "Index records from `offset`, return the offset right after the last complete record"
+        next_entry = entries[-1].offset + self.index_interval if entries else offset
+        for start, offset, record in self._records(offset):
+            if start >= next_entry and record.direction == DIRECTION_IN:
+                try:
+                    seq = peek_payload(record.payload)[1]
+                except ParseError:
+                    continue
+                entries.append(IndexEntry(start, record.timestamp, seq))
+                next_entry = start + self.index_interval
+        return offset
+
+    def _write_index(self, entries, indexed_size):
+        data = bytearray(_INDEX_HEADER.pack(_INDEX_MAGIC, indexed_size))
+        for entry in entries:
+            data += _INDEX_ENTRY.pack(*entry)
+        temporary_path = self.index_path + '.tmp'
+        try:
+            with open(temporary_path, 'wb') as f:
+                f.write(data)
+            os.rename(temporary_path, self.index_path)
+        except (IOError, OSError):
+            # The index is only an optimisation, a read-only location mustn't prevent reading
+            pass
@@ -5,12 +5,13 @@
 # http://www.opensource.org/licenses/mit-license.php
 import logging
 import sys
+from collections import OrderedDict
 
 from smarkets.signal import Signal
 from smarkets.streaming_api import eto
 from smarkets.streaming_api import seto
 from smarkets.streaming_api.exceptions import InvalidCallbackError, LoginError, LoginTimeout
-from smarkets.streaming_api.utils import set_payload_message
+from smarkets.streaming_api.utils import payload_message, wrap
 
 
 def _get_payload_types(module):
@@ -25,6 +26,68 @@ def _get_payload_types(module):
 
 _ETO_PAYLOAD_TYPES = _get_payload_types(eto)
 _SETO_PAYLOAD_TYPES = _get_payload_types(seto)
+_LOGIN_ETO_TYPES = frozenset((eto.PAYLOAD_LOGIN_RESPONSE, eto.PAYLOAD_LOGOUT))
+
+
+def _contract_quotes_key(message):
+    quotes = message.contract_quotes
+    return quotes.market_id, quotes.contract_id
+
+
+def _market_quotes_key(message):
+    return message.market_quotes.market_id
+
+
+# What batch handlers coalesce messages on by default
+_COALESCE_KEYS = {
+    'seto.contract_quotes': _contract_quotes_key,
+    'seto.market_quotes': _market_quotes_key,
+}
+
+
+class _Compose(object):
+
+    "Context manager of :meth:`StreamingAPIClient.compose`"
+
+    __slots__ = ('client', 'message_class')
+
+    def __init__(self, client, message_class):
+        self.client = client
+        self.message_class = message_class
+
+    def __enter__(self):
+        # The outgoing payload is only claimed here, anything sent before would overwrite it
+        return payload_message(self.client.session.out_payload, self.message_class)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.client._send()
+        else:
+            # Don't leave a half-built message for whoever uses the payload next
+            self.client.session.out_payload.Clear()
+
+
+class _Batch(object):
+
+    "Messages of a single callback name collected for batch handlers during a read cycle"
+
+    __slots__ = ('handlers', 'messages')
+
+    def __init__(self):
+        # (callback, coalesce key function or None) pairs
+        self.handlers = []
+        self.messages = []
+
+    def deliver(self):
+        messages, self.messages = self.messages, []
+        for callback, key in list(self.handlers):
+            if key is None:
+                callback(messages=messages)
+            else:
+                latest = OrderedDict()
+                for message in messages:
+                    latest[key(message)] = message
+                callback(messages=list(latest.values()))
 
 
 READ_MODE_BUFFER_FROM_SOCKET = 1
@@ -49,6 +112,8 @@ class StreamingAPIClient(object):
                               for callback_name in self.__class__.CALLBACKS)
         self.global_callback = Signal()
         self.last_login = None
+        self._batches = {}
+        self._dispatch_table = self._build_dispatch_table()
 
     def login(self, receive=True):
         "Connect and ensure the session is active"
@@ -115,28 +180,119 @@ class StreamingAPIClient(object):
         if read_mode & READ_MODE_BUFFER_FROM_SOCKET:
             self.session.read()
 
-        processed = 0
         if read_mode & READ_MODE_DISPATCH_FROM_BUFFER:
-            while processed < limit:
-                frame = self.session.next_frame()
-                if frame:
-                    self._dispatch(frame)
-                    processed += 1
+            return self._dispatch_buffered(limit)
+        return 0
+
+    def _dispatch_buffered(self, limit):
+        "Dispatch up to `limit` frames buffered in the session"
+        if self.session.instrumentation is not None:
+            return self._dispatch_buffered_timed(limit, self.session.instrumentation)
+        dispatch = self._dispatch_logged if self.logger.isEnabledFor(logging.DEBUG) else self._dispatch_frame
+        session = self.session
+        buffered = session.buffered_incoming_payloads
+        # Frames with messages waiting in a batch can only be released once it's delivered
+        retained = []
+        processed = 0
+        # Like Session.next_frames, without building the list: stale and out of sequence
+        # frames are skipped, the frames buffered after them still get dispatched
+        while processed < limit and buffered:
+            frame = session.next_frame()
+            if frame:
+                if dispatch(frame):
+                    retained.append(frame)
                 else:
-                    break
+                    session.release_frame(frame)
+                processed += 1
 
+        if retained:
+            self._deliver_batches()
+            for frame in retained:
+                session.release_frame(frame)
+        return processed
+
+    def _dispatch_buffered_timed(self, limit, instrumentation):
+        "Like :meth:`_dispatch_buffered`, recording the timings of every frame in `instrumentation`"
+        dispatch = self._dispatch_logged if self.logger.isEnabledFor(logging.DEBUG) else self._dispatch_frame
+        session = self.session
+        clock = instrumentation.clock
+        buffered = session.buffered_incoming_payloads
+        retained = []
+        processed = 0
+        while processed < limit and buffered:
+            frame = session.next_frame()
+            if not frame:
+                continue
+            times = session.frame_times
+            if dispatch(frame):
+                retained.append((frame, times))
+            else:
+                instrumentation.record_frame(self._frame_name(frame), times, clock())
+                session.release_frame(frame)
+            processed += 1
+
+        if retained:
+            self._deliver_batches()
+            handled = clock()
+            for frame, times in retained:
+                instrumentation.record_frame(self._frame_name(frame), times, handled)
+                session.release_frame(frame)
         return processed
 
+    def _frame_name(self, frame):
+        "Message type name of `frame`, ``seto.contract_quotes`` for example"
+        key = (frame.type, frame.eto_type)
+        entry = self._dispatch_table.get(key)
+        if entry is None:
+            entry = self._dispatch_table[key] = self._dispatch_entry(*key)
+        return entry[0]
+
     def flush(self):
         "Flush the send buffer"
         self.session.flush()
 
     def send(self, message):
-        payload = self.session.out_payload
-        payload.Clear()
-        set_payload_message(payload, message)
+        wrap(message, self.session.out_payload)
         self._send()
 
+    def compose(self, message_class):
+        """
+        Build a message directly in the session's outgoing payload instead of copying it
+        there like :meth:`send` does, the message is sent when the block exits without an
+        exception::
+
+            with client.compose('order_create') as order:
+                order.market_id = market_id
+                order.contract_id = contract_id
+                ...
+            client.flush()
+
+        The payload is shared with everything else the session sends (heartbeat answers,
+        replay requests, logouts...), so nothing may be read or sent inside the block.
+
+        :param message_class: message class or name of the payload field (``'order_create'``)
+        """
+        return _Compose(self, message_class)
+
+    def send_many(self, messages, flush=False):
+        """
+        Send a batch of messages (order creates and cancels when requoting for example), then
+        flush the send buffer once if `flush` is true. Cheaper than calling :meth:`send` for
+        each message.
+
+        :return: number of messages sent
+        """
+        payload = self.session.out_payload
+        send = self._send
+        sent = 0
+        for message in messages:
+            wrap(message, payload)
+            send()
+            sent += 1
+        if flush:
+            self.flush()
+        return sent
+
     def ping(self):
         "Ping the service"
         msg = self.session.out_payload
@@ -153,6 +309,30 @@ class StreamingAPIClient(object):
             raise InvalidCallbackError(name)
         self.callbacks[name] += callback
 
+    def add_batch_handler(self, name, callback, coalesce=False):
+        """
+        Add a callback handler receiving all `name` messages dispatched during a single
+        :meth:`read` at once, as ``callback(messages=[...])``. Batches are delivered after
+        all frames of the read have been dispatched to the other handlers.
+
+        :param coalesce: False to receive every message, True to only receive the latest
+            message per market (``seto.market_quotes``) or per contract
+            (``seto.contract_quotes``), or a callable returning the key to coalesce a message on.
+        """
+        if not hasattr(callback, '__call__'):
+            raise ValueError('callback must be a callable')
+        if name not in self.callbacks:
+            raise InvalidCallbackError(name)
+        if coalesce is True:
+            if name not in _COALESCE_KEYS:
+                raise ValueError('no default coalesce key for %s, pass a callable' % (name,))
+            coalesce = _COALESCE_KEYS[name]
+        elif coalesce is not False and not hasattr(coalesce, '__call__'):
+            raise ValueError('coalesce must be a boolean or a callable')
+
+        self._batches.setdefault(name, _Batch()).handlers.append((callback, coalesce or None))
+        self._dispatch_table = self._build_dispatch_table()
+
     def add_global_handler(self, callback):
         "Add a global callback handler, called for every message"
         if not hasattr(callback, '__call__'):
@@ -165,6 +345,22 @@ class StreamingAPIClient(object):
             raise InvalidCallbackError(name)
         self.callbacks[name] -= callback
 
+    def del_batch_handler(self, name, callback):
+        "Remove a batch callback handler"
+        if name not in self.callbacks:
+            raise InvalidCallbackError(name)
+        handlers = self._batches[name].handlers if name in self._batches else []
+        for handler in handlers:
+            if handler[0] == callback:
+                handlers.remove(handler)
+                break
+        else:
+            raise KeyError(callback)
+
+        if not handlers:
+            del self._batches[name]
+        self._dispatch_table = self._build_dispatch_table()
+
     def del_global_handler(self, callback):
         "Remove a global callback handler"
         self.global_callback -= callback
@@ -176,27 +372,83 @@ class StreamingAPIClient(object):
         self.session.send()
 
     def _dispatch(self, frame):
-        "Dispatch a frame to the callbacks"
-        message = frame.protobuf
-        name = _SETO_PAYLOAD_TYPES.get(message.type, 'seto.unknown')
-        if name == 'seto.eto':
-            name = _ETO_PAYLOAD_TYPES.get(message.eto_payload.type)
-
-            # handle login and logout messages
-            if message.eto_payload.type in [eto.PAYLOAD_LOGIN_RESPONSE, eto.PAYLOAD_LOGOUT]:
-                self.last_login = message
-                if message.eto_payload.type == eto.PAYLOAD_LOGOUT:
-                    self.session.disconnect()
+        """
+        Dispatch a frame to the callbacks
 
+        :return: whether the frame's message was added to a batch, see :meth:`_deliver_batches`
+        :rtype: bool
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            return self._dispatch_logged(frame)
+        return self._dispatch_frame(frame)
+
+    def _dispatch_frame(self, frame):
+        "Dispatch a frame to the callbacks without any logging"
+        key = (frame.type, frame.eto_type)
+        try:
+            name, callback, is_login, batch = self._dispatch_table[key]
+        except KeyError:
+            name, callback, is_login, batch = self._dispatch_table[key] = self._dispatch_entry(*key)
+
+        if is_login:
+            self._handle_login(frame, key[1])
+        # Only touch the protobuf (which may parse it) when someone is listening
+        if callback:
+            callback(message=frame.protobuf)
+        if self.global_callback:
+            self.global_callback(name=name, message=frame)
+        if batch is not None:
+            batch.messages.append(frame.protobuf)
+            return True
+        return False
+
+    def _dispatch_logged(self, frame):
+        "Dispatch a frame to the callbacks with debug logging"
+        name = self._dispatch_entry(frame.type, frame.eto_type)[0]
         if name in self.callbacks:
             self.logger.debug("dispatching callback %s", name)
-            callback = self.callbacks.get(name)
-            if callback is not None:
-                callback(message=message)
-            else:
-                self.logger.error("no callback %s", name)
         else:
             self.logger.debug("ignoring unknown message: %s", name)
-
         self.logger.debug('Dispatching global callbacks for %s', name)
-        self.global_callback(name=name, message=frame)
+        return self._dispatch_frame(frame)
+
+    def _deliver_batches(self):
+        "Deliver messages collected since the last call to batch handlers"
+        for batch in list(self._batches.values()):
+            if batch.messages:
+                batch.deliver()
+
+    def _dispatch_entry(self, seto_type, eto_type):
+        """
+        Resolve a payload type pair to callback name, callback :class:`Signal` (None for
+        unknown names), whether it's a login response or logout and the batch collecting its
+        messages (None without batch handlers).
+        """
+        name = _SETO_PAYLOAD_TYPES.get(seto_type, 'seto.unknown')
+        is_login = False
+        if name == 'seto.eto':
+            name = _ETO_PAYLOAD_TYPES.get(eto_type)
+            is_login = eto_type in _LOGIN_ETO_TYPES
+        return name, self.callbacks.get(name), is_login, self._batches.get(name)
+
+    def _build_dispatch_table(self):
+        """
+        Map (payload type, ETO payload type) pairs of all known payloads to their dispatch
+        entries. Entries reference the callback signals, so handlers added or removed later
+        are picked up without rebuilding the table; it's only rebuilt when batch handlers
+        change. Unknown pairs are added when first seen.
+        """
+        table = {}
+        for seto_type in _SETO_PAYLOAD_TYPES:
+            eto_types = _ETO_PAYLOAD_TYPES if seto_type == seto.PAYLOAD_ETO else (eto.PAYLOAD_NONE,)
+            for eto_type in eto_types:
+                table[seto_type, eto_type] = self._dispatch_entry(seto_type, eto_type)
+        return table
+
+    def _handle_login(self, frame, eto_type):
+        "Keep the login response or logout and disconnect on the latter"
+        # A copy, the frame's payload may get reused by the session
+        self.last_login = seto.Payload()
+        self.last_login.CopyFrom(frame.protobuf)
+        if eto_type == eto.PAYLOAD_LOGOUT:
+            self.session.disconnect()
@@ -0,0 +1,446 @@
+"""
+Local stand-in for the Smarkets streaming API, for load testing clients (Python 3.5+)
+
+Run it with ``python -m smarkets.streaming_api.fake_server`` and point clients at it with
+``SessionSettings(..., host='127.0.0.1', port=3701, ssl=False)``.
+"""
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import threading
+
+from smarkets import private
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_encode, FrameDecoder
+from smarkets.streaming_api.orderbook import TICK_PRICES
+from smarkets.streaming_api.utils import wrap
+
+__all__ = ('FakeServer',)
+
+# Valid order prices, the number of quotes on each side of a contract and the tick quoted
+# first (between the best bid and offer)
+_TICKS = frozenset(TICK_PRICES)
+_QUOTE_DEPTH = 3
+_FIRST_TICK = TICK_PRICES.index(5000)
+
+
+class _Quoter(object):
+
+    """
+    Prices of the contracts quoted to one session, moving a tick at a time at random. Quotes
+    follow the tick ladder, and updates remove the levels that moved so that an
+    :class:`smarkets.streaming_api.orderbook.OrderBook` fed with them stays consistent.
+    """
+
+    def __init__(self, random):
+        self.random = random
+        # [tick index between the best bid and offer, bid prices, offer prices] quoted by
+        # contract
+        self.contracts = {}
+
+    def market_quotes(self, market_id, contract_ids):
+        "A seto.MarketQuotes snapshot quoting the contracts afresh"
+        quotes = seto.MarketQuotes(market_id=market_id)
+        for contract_id in contract_ids:
+            contract = self.contracts.setdefault((market_id, contract_id), [_FIRST_TICK, (), ()])
+            contract_quotes = quotes.contract_quotes.add(market_id=market_id, contract_id=contract_id)
+            contract[1:] = self._quote(contract_quotes, contract[0])
+        return quotes
+
+    def contract_quotes(self, market_id, contract_id):
+        "A seto.ContractQuotes update with the price of the contract moved a tick at random"
+        contract = self.contracts.setdefault((market_id, contract_id), [_FIRST_TICK, (), ()])
+        tick = contract[0] + self.random.choice((-1, 0, 1))
+        tick = contract[0] = min(max(tick, _QUOTE_DEPTH), len(TICK_PRICES) - 1 - _QUOTE_DEPTH)
+        quotes = seto.ContractQuotes(market_id=market_id, contract_id=contract_id)
+        bids, offers = self._quote(quotes, tick)
+        for removed in sorted(set(contract[1]).difference(bids), reverse=True):
+            quotes.bids.add(price=removed, quantity=0)
+        for removed in sorted(set(contract[2]).difference(offers)):
+            quotes.offers.add(price=removed, quantity=0)
+        contract[1:] = bids, offers
+        return quotes
+
+    def _quote(self, quotes, tick):
+        "Quote random quantities around `tick`, return the bid and offer prices"
+        randint = self.random.randint
+        bids = tuple(TICK_PRICES[tick - depth] for depth in range(1, _QUOTE_DEPTH + 1))
+        offers = tuple(TICK_PRICES[tick + depth] for depth in range(1, _QUOTE_DEPTH + 1))
+        for price in bids:
+            quotes.bids.add(price=price, quantity=randint(1, 100) * 10000)
+        for price in offers:
+            quotes.offers.add(price=price, quantity=randint(1, 100) * 10000)
+        return bids, offers
+
+
+class _FakeSessionProtocol(asyncio.Protocol):
+
+    "One client connection to a :class:`FakeServer`"
+
+    logger = private(logging.getLogger('smarkets.streaming_api.fake_server'))
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.decoder = FrameDecoder()
+        self.out_payload = seto.Payload()
+        self.outseq = 1
+        self.inseq = 1
+        self.session = None
+        self.subscriptions = set()
+        self.orders = {}
+        self.paused = False
+        self._output = bytearray()
+        self._last_received = None
+        self._heartbeat_timer = None
+        self._quote_timer = None
+        self._quote_time = None
+        self._quote_credit = 0.0
+        self._contracts = itertools.cycle(server.contracts)
+        self._quoter = _Quoter(server._random)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._last_received = self.loop.time()
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.server.connections.discard(self)
+        for timer in (self._heartbeat_timer, self._quote_timer):
+            if timer is not None:
+                timer.cancel()
+
+    def pause_writing(self):
+        # Quotes aren't generated while the client can't keep up
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def data_received(self, data):
+        self._last_received = self.loop.time()
+        self.decoder.feed(data)
+        for raw in self.decoder.decode():
+            payload = seto.Payload.FromString(bytes(raw))
+            self.server.received += 1
+            self._handle(payload)
+            if self.transport is None:
+                return
+        self._flush()
+
+    def _handle(self, payload):
+        seq = payload.eto_payload.seq
+        if self.session is None:
+            if payload.type != seto.PAYLOAD_LOGIN or seq != 1:
+                self._logout(eto.LOGOUT_LOGIN_NOT_FIRST_SEQ)
+            elif not self.server.check_login(payload.login):
+                self._logout(eto.LOGOUT_UNAUTHORISED)
+            else:
+                self._login()
+            return
+
+        if seq < self.inseq:
+            self.logger.debug("ignoring duplicate payload %d", seq)
+            return
+        if seq > self.inseq:
+            self.logger.warning("received sequence %d instead of %d, requesting a replay", seq, self.inseq)
+            self._send_eto(eto.PAYLOAD_REPLAY).replay.seq = self.inseq
+            self._encode()
+            return
+        self.inseq += 1
+
+        if payload.type == seto.PAYLOAD_ETO:
+            eto_type = payload.eto_payload.type
+            if eto_type == eto.PAYLOAD_PING:
+                self._send_eto(eto.PAYLOAD_PONG)
+                self._encode()
+            elif eto_type == eto.PAYLOAD_LOGOUT:
+                self._logout(eto.LOGOUT_CONFIRMATION)
+        elif payload.type == seto.PAYLOAD_ORDER_CREATE:
+            self._order_create(seq, payload.order_create)
+        elif payload.type == seto.PAYLOAD_ORDER_CANCEL:
+            self._order_cancel(payload.order_cancel)
+        elif payload.type == seto.PAYLOAD_MARKET_SUBSCRIBE:
+            market_id = payload.market_subscribe.market_id
+            self.subscriptions.add(market_id)
+            contract_ids = [
+                contract_id for market, contract_id in self.server.contracts if market == market_id]
+            if contract_ids:
+                self._send(self._quoter.market_quotes(market_id, contract_ids))
+            self._start_quotes()
+        elif payload.type == seto.PAYLOAD_MARKET_UNSUBSCRIBE:
+            self.subscriptions.discard(payload.market_unsubscribe.market_id)
+
+    def _login(self):
+        self.session = 'fake-session-%d' % next(self.server.session_ids)
+        self.inseq = 2
+        response = self._send_eto(eto.PAYLOAD_LOGIN_RESPONSE).login_response
+        response.session = self.session
+        response.reset = self.inseq
+        self._encode()
+        self.logger.info("session %s logged in", self.session)
+        if self.server.heartbeat_interval:
+            self._heartbeat_timer = self.loop.call_later(self.server.heartbeat_interval, self._heartbeat)
+
+    def _logout(self, reason):
+        self._send_eto(eto.PAYLOAD_LOGOUT).logout.reason = reason
+        self._encode()
+        self._flush()
+        self.logger.info("session %s logged out: %s", self.session, eto.LogoutReason.Name(reason))
+        self.transport.close()
+        self.transport = None
+
+    def _heartbeat(self):
+        interval = self.server.heartbeat_interval
+        if self.loop.time() - self._last_received > 2 * interval:
+            self._logout(eto.LOGOUT_HEARTBEAT_TIMEOUT)
+            return
+        self._send_eto(eto.PAYLOAD_HEARTBEAT)
+        self._encode()
+        self._flush()
+        self._heartbeat_timer = self.loop.call_later(interval, self._heartbeat)
+
+    def _order_create(self, seq, order):
+        server = self.server
+        invalid = []
+        if order.price not in _TICKS:
+            invalid.append(seto.ORDER_INVALID_INVALID_PRICE)
+        if not order.quantity:
+            invalid.append(seto.ORDER_INVALID_INVALID_QUANTITY)
+        if invalid:
+            self._send(seto.OrderInvalid(seq=seq, reasons=invalid, reference=order.reference))
+            server.orders_rejected += 1
+            return
+        reason = server.order_policy(order)
+        if reason is not None:
+            rejected = seto.OrderRejected(seq=seq, reason=reason, reference=order.reference)
+            self._send(rejected)
+            server.orders_rejected += 1
+            return
+        order_id = next(server.order_ids)
+        self.orders[order_id] = order
+        self._send(seto.OrderAccepted(
+            seq=seq, order_id=order_id, reference=order.reference, price=order.price,
+            quantity=order.quantity, market_id=order.market_id, contract_id=order.contract_id,
+            side=order.side))
+        server.orders_accepted += 1
+
+    def _order_cancel(self, cancel):
+        order = self.orders.pop(cancel.order_id, None)
+        if order is None:
+            self._send(seto.OrderCancelRejected(
+                reason=seto.ORDER_CANCEL_REJECTED_NOT_FOUND, reference=cancel.reference,
+                order_id=cancel.order_id))
+        else:
+            self._send(seto.OrderCancelled(
+                reason=seto.ORDER_CANCELLED_MEMBER_REQUESTED, reference=cancel.reference,
+                order_id=cancel.order_id, market_id=order.market_id, contract_id=order.contract_id,
+                side=order.side))
+
+    def _start_quotes(self):
+        if self._quote_timer is None and self.server.quote_rate:
+            self._quote_time = self.loop.time()
+            self._quote_timer = self.loop.call_soon(self._send_quotes)
+
+    def _send_quotes(self):
+        "Send the quotes due since the last call, at most `quote_rate` per second"
+        server = self.server
+        now = self.loop.time()
+        self._quote_credit += (now - self._quote_time) * server.quote_rate
+        self._quote_time = now
+        if self.paused:
+            self._quote_credit = 0.0
+        elif self._quote_credit >= 1:
+            subscriptions = self.subscriptions
+            for _ in range(int(self._quote_credit)):
+                for _ in range(len(server.contracts)):
+                    market_id, contract_id = next(self._contracts)
+                    if market_id in subscriptions:
+                        self._send(self._quoter.contract_quotes(market_id, contract_id))
+                        break
+            self._quote_credit -= int(self._quote_credit)
+            self._flush()
+        self._quote_timer = self.loop.call_later(server.quote_interval, self._send_quotes)
+
+    def _send_eto(self, eto_type):
+        "Prepare an ETO payload of `eto_type` for :meth:`_encode`, return the eto.Payload"
+        payload = self.out_payload
+        payload.Clear()
+        payload.type = seto.PAYLOAD_ETO
+        payload.eto_payload.type = eto_type
+        return payload.eto_payload
+
+    def _send(self, message):
+        payload = wrap(message, self.out_payload)
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        self._encode()
+
+    def _encode(self):
+        "Sequence and buffer the outgoing payload until :meth:`_flush`"
+        self.out_payload.eto_payload.seq = self.outseq
+        self.outseq += 1
+        frame_encode(self._output, self.out_payload.SerializeToString())
+        self.server.sent += 1
+
+    def _flush(self):
+        if self._output and self.transport is not None:
+            self.transport.write(bytes(self._output))
+            del self._output[:]
+
+
+class FakeServer(object):
+
+    """
+    asyncio TCP server speaking enough of the streaming API to drive a
+    :class:`StreamingAPIClient` without the exchange:
+
+    * logs in any user (or only those accepted by `check_login`) and logs out on request,
+      after a heartbeat timeout or when the first payload isn't a login
+    * sequences outgoing payloads, checks incoming sequence numbers and requests a replay of
+      missing ones
+    * sends heartbeats and answers pings with pongs
+    * accepts order creations or rejects them (price off the tick ladder, invalid quantity,
+      unknown market or contract, see also `order_policy`) and cancels accepted orders
+    * sends a market quotes snapshot when a session subscribes to a market, then streams
+      random contract quotes of subscribed markets along the tick ladder at `quote_rate`
+      payloads per second to each session
+
+    Counters of payloads `sent` and `received` and of orders accepted and rejected are kept
+    across connections.
+    """
+    logger = private(logging.getLogger('smarkets.streaming_api.fake_server'))
+
+    def __init__(self, host='127.0.0.1', port=0, quote_rate=0, markets=(1,), contracts_per_market=3,
+                 heartbeat_interval=30, order_policy=None, check_login=None,
+                 quote_interval=0.01, loop=None, seed=None):
+        """
+        :param port: port to listen on, 0 picks a free one (see :attr:`port`)
+        :param quote_rate: contract quotes sent per second to each session subscribed to a
+            market, 0 for none
+        :param markets: ids of the markets quoted, contracts are numbered from 1
+        :param heartbeat_interval: seconds between heartbeats, 0 for none
+        :param order_policy: callable taking a valid seto.OrderCreate and returning None to
+            accept it or a seto.OrderRejectedReason to reject it, None to reject orders for
+            markets and contracts not quoted
+        :param check_login: callable taking a seto.Login and returning whether to accept it,
+            None to accept everybody
+        :param quote_interval: seconds between batches of quotes
+        :param seed: random seed of the quoted prices
+        """
+        self.host = host
+        self.port = port
+        self.quote_rate = quote_rate
+        self.quote_interval = quote_interval
+        self.contracts = [
+            (market_id, contract_id)
+            for market_id in markets for contract_id in range(1, contracts_per_market + 1)]
+        self.heartbeat_interval = heartbeat_interval
+        self.order_policy = order_policy or self._check_contract
+        self.check_login = check_login or (lambda login: True)
+        self.loop = loop
+        self.connections = set()
+        self.session_ids = itertools.count(1)
+        self.order_ids = itertools.count(1)
+        self.sent = 0
+        self.received = 0
+        self.orders_accepted = 0
+        self.orders_rejected = 0
+        self._random = random.Random(seed)
+        self._server = None
+        self._thread = None
+
+    async def start(self):
+        "Start listening on the event loop, :attr:`port` is set once it returns"
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self._server = await self.loop.create_server(
+            lambda: _FakeSessionProtocol(self), self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info("listening on %s:%d", self.host, self.port)
+
+    def close(self):
+        "Stop listening and drop all connections"
+        if self._server is not None:
+            self._server.close()
+        for connection in list(self.connections):
+            if connection.transport is not None:
+                connection.transport.abort()
+
+    async def wait_closed(self):
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def start_thread(self):
+        """
+        Run the server on its own event loop in a daemon thread, returns once it's listening.
+        Stop it with :meth:`stop_thread`.
+        """
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start())
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.wait_closed())
+            self.loop.close()
+
+        self._thread = threading.Thread(target=run, name='FakeServer')
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+
+    def stop_thread(self):
+        def stop():
+            self.close()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(stop)
+        self._thread.join()
+        self._thread = None
+
+    def _check_contract(self, order):
+        if (order.market_id, order.contract_id) in self.contracts:
+            return None
+        if any(market_id == order.market_id for market_id, _ in self.contracts):
+            return seto.ORDER_REJECTED_CONTRACT_NOT_FOUND
+        return seto.ORDER_REJECTED_MARKET_NOT_FOUND
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a fake Smarkets streaming API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3701)
+    parser.add_argument('--quote-rate', type=float, default=1000,
+                        help='contract quotes per second sent to each session')
+    parser.add_argument('--markets', type=int, default=1, help='number of markets quoted')
+    parser.add_argument('--heartbeat-interval', type=float, default=30)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    server = FakeServer(
+        args.host, args.port, quote_rate=args.quote_rate, markets=range(1, args.markets + 1),
+        heartbeat_interval=args.heartbeat_interval, loop=loop)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
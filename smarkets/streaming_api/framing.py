@@ -17,11 +17,30 @@ def frame_encode(frame, payload):
     :type payload: byte string or bytearray
     """
     byte_count = len(payload)
-    header = uleb128_encode(byte_count)
-    padding = b'\x00' * max(0, MIN_FRAME_SIZE - len(header) - byte_count)
+    header = frame_header(byte_count)
     frame += header
     frame += payload
-    frame += padding
+    if len(header) + byte_count < MIN_FRAME_SIZE:
+        frame += b'\x00' * (MIN_FRAME_SIZE - len(header) - byte_count)
+
+
+def frame_header(payload_size):
+    """
+    :type payload_size: int
+    :rtype: bytes
+    """
+    if payload_size < _PRECOMPUTED_HEADERS_COUNT:
+        return _PRECOMPUTED_HEADERS[payload_size]
+    return bytes(uleb128_encode(payload_size))
+
+
+# Headers of all payloads shorter than 16k (one and two byte ULEB128 values)
+_PRECOMPUTED_HEADERS_COUNT = 2 ** 14
+_PRECOMPUTED_HEADERS = tuple(
+    [int2byte(size) for size in range(0x80)] +
+    [int2byte(0x80 | (size & 0x7f)) + int2byte(size >> 7)
+     for size in range(0x80, _PRECOMPUTED_HEADERS_COUNT)]
+)
 
 
 def uleb128_encode(value):
@@ -51,28 +70,159 @@ def frame_decode_all(to_decode):
     :type to_decode: bytes
     :rtype: tuple (list of bytes, remaining bytes)
     """
-    payloads = []
-    while len(to_decode) >= MIN_FRAME_SIZE:
-        try:
-            decoded = uleb128_decode(to_decode)
-        except IncompleteULEB128:
-            # There may be not enough data in the input to decode the header
-            break
+    index, position = frame_index(to_decode)
+    payloads = [to_decode[offset:offset + size] for offset, size in index]
+    return payloads, to_decode[position:]
+
+
+def frame_index(to_decode, position=0, end=None):
+    """Find all complete frames in `to_decode` in a single pass.
+
+    Nothing is copied, only the payload boundaries are returned. Headers of payloads shorter
+    than 128 bytes (a single ULEB128 byte) are decoded inline.
+
+    Frame boundaries depend on every preceding header so they can't be found in parallel,
+    a single tight loop is as good as it gets.
+
+    :type to_decode: bytearray
+    :param position: offset in `to_decode` to start decoding at
+    :param end: offset in `to_decode` to stop decoding at, its length if None
+    :return: list of (payload offset, payload size) pairs and offset of the first byte not
+        belonging to a complete frame
+    :rtype: tuple of (list of tuples of 2 ints) and int
+    """
+    index = []
+    append = index.append
+    if end is None:
+        end = len(to_decode)
+    while end - position >= MIN_FRAME_SIZE:
+        payload_size = to_decode[position]
+        if payload_size < 0x80:
+            header_size = 1
         else:
-            payload_size, header_size = decoded
-            frame_size = max(payload_size + header_size, MIN_FRAME_SIZE)
-            if len(to_decode) >= frame_size:
-                frame, to_decode = to_decode[:frame_size], to_decode[frame_size:]
-                payloads.append(frame[header_size:header_size + payload_size])
-            else:
+            try:
+                payload_size, header_size = uleb128_decode(to_decode, position)
+            except IncompleteULEB128:
+                # There may be not enough data in the input to decode the header
+                break
+            if position + header_size > end:
                 break
+        frame_size = payload_size + header_size
+        if frame_size < MIN_FRAME_SIZE:
+            frame_size = MIN_FRAME_SIZE
+        if end - position < frame_size:
+            break
+        append((position + header_size, payload_size))
+        position += frame_size
 
-    return payloads, to_decode
+    return index, position
 
 
-def uleb128_decode(to_decode):
+class FrameDecoder(object):
+
+    """Incrementally decodes frames from a stream of bytes.
+
+    Incoming data is stored in a buffer owned by the decoder, either copied there by
+    :meth:`feed` or received directly into it (see :meth:`writable`). Decoded payloads are
+    returned as :class:`memoryview` slices of that buffer, so no payload bytes are copied.
+    Decoding only moves a read offset forward.
+
+    The buffer is reused once the end is reached: undecoded bytes are moved to its start if
+    no decoded payload of it is still referenced, otherwise the decoder switches to a new
+    buffer (containing only the undecoded tail). Payloads are never overwritten, it's
+    therefore safe to hold on to them across calls to :meth:`feed`.
+    """
+
+    __slots__ = ('_buffer', '_offset', '_end')
+
+    def __init__(self, capacity=0):
+        """
+        :param capacity: initial buffer size, the buffer grows as needed
+        """
+        self._buffer = bytearray(capacity)
+        self._offset = 0
+        self._end = 0
+
+    def __len__(self):
+        "Number of buffered bytes not decoded yet"
+        return self._end - self._offset
+
+    @property
+    def capacity(self):
+        "Current buffer size"
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        :type data: byte string or bytearray
+        """
+        size = len(data)
+        self._reserve(size)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def writable(self, size):
+        """Get `size` bytes of free buffer space to receive data into, e.g. with
+        :meth:`socket.socket.recv_into`. Received data has to be added with :meth:`commit`.
+
+        The view has to be released (dropped) before any other call to the decoder.
+
+        :rtype: :class:`memoryview`
+        """
+        self._reserve(size)
+        return memoryview(self._buffer)[self._end:self._end + size]
+
+    def commit(self, size):
+        "Add `size` bytes received into the view returned by :meth:`writable`"
+        self._end += size
+
+    def decode(self):
+        """Decode all complete frames buffered so far.
+
+        :return: payloads
+        :rtype: list of :class:`memoryview`
+        """
+        index, self._offset = frame_index(self._buffer, self._offset, self._end)
+        if not index:
+            return []
+        view = memoryview(self._buffer)
+        return [view[offset:offset + size] for offset, size in index]
+
+    def _reserve(self, size):
+        "Make sure there's room for `size` more bytes after the buffered ones"
+        buffer_ = self._buffer
+        capacity = len(buffer_)
+        if capacity - self._end >= size:
+            return
+        pending = self._end - self._offset
+        if pending + size > capacity:
+            capacity = max(2 * capacity, pending + size)
+        elif not _exported(buffer_):
+            buffer_[:pending] = buffer_[self._offset:self._end]
+            self._offset = 0
+            self._end = pending
+            return
+        new_buffer = bytearray(capacity)
+        new_buffer[:pending] = buffer_[self._offset:self._end]
+        self._buffer = new_buffer
+        self._offset = 0
+        self._end = pending
+
+
+def _exported(byte_array):
+    "Whether any view of `byte_array` is still alive, it can't be resized then"
+    try:
+        byte_array.append(0)
+    except BufferError:
+        return True
+    del byte_array[-1]
+    return False
+
+
+def uleb128_decode(to_decode, offset=0):
     """
     :type to_decode: bytes
+    :param offset: position in `to_decode` the value starts at
     :return: decoded value and number of bytes from `to_decode` used to decode it
     :rtype: tuple of (int or long) and int
     :raises:
@@ -83,7 +233,7 @@ def uleb128_decode(to_decode):
 
     shift = 0
     result = 0
-    position = 0
+    position = offset
 
     while True:
         try:
@@ -99,4 +249,4 @@ def uleb128_decode(to_decode):
                 shift += 7
                 position += 1
 
-    return result, position + 1
+    return result, position - offset + 1
@@ -0,0 +1,125 @@
+"Timings and traffic statistics of streaming API sessions"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+from smarkets.histogram import Histogram
+from smarkets.streaming_api.capture import monotonic_ns
+
+__all__ = ('Instrumentation', 'MessageTimings')
+
+
+class MessageTimings(object):
+
+    """
+    Histograms of the time (in nanoseconds) frames of a message type spend in each stage
+    between the socket and the handlers:
+
+    * `decode`: from receiving the data to decoding the frames in it
+    * `wait`: from decoding to being taken out of the session's buffer, the time spent
+      dispatching the frames received before
+    * `parse`: taking the frame out of the buffer, parsing the payload unless parsing is lazy
+      (the handlers then parse it)
+    * `handle`: running the handlers (for batch handlers, until the batch is delivered)
+    """
+
+    STAGES = ('decode', 'wait', 'parse', 'handle')
+
+    __slots__ = STAGES
+
+    def __init__(self, significant_bits):
+        for stage in self.STAGES:
+            setattr(self, stage, Histogram(significant_bits))
+
+
+class Instrumentation(object):
+
+    """
+    Optional hook of :class:`Session` (see its `instrumentation` argument) counting the bytes
+    sent and received and the frames decoded by each read and, when used with a
+    :class:`StreamingAPIClient`, recording the :class:`MessageTimings` of every dispatched
+    frame by message type (``seto.contract_quotes``, ``eto.pong``...) in :attr:`messages`.
+
+    An instrumentation can be shared by many sessions. Statistics are exported with
+    :meth:`export_statsd` or :meth:`export_graphite`, :meth:`reset` it after exporting to
+    get statistics per reporting interval::
+
+        instrumentation = Instrumentation()
+        client = StreamingAPIClient(Session(settings, instrumentation=instrumentation))
+        ...
+        instrumentation.export_statsd(StatsD(prefix='strategy.'))
+        instrumentation.reset()
+    """
+
+    def __init__(self, clock=monotonic_ns, significant_bits=3):
+        """
+        :param clock: returns the current monotonic time in nanoseconds
+        :param significant_bits: precision of the timing histograms, see :class:`Histogram`
+        """
+        self.clock = clock
+        self.significant_bits = significant_bits
+        self.reset()
+
+    def reset(self):
+        "Forget everything recorded"
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_per_read = Histogram()
+        self.messages = {}
+
+    def record_read(self, received, frames):
+        self.bytes_in += received
+        self.frames_per_read.record(frames)
+
+    def record_sent(self, sent):
+        self.bytes_out += sent
+
+    def record_frame(self, name, times, handled):
+        """
+        :param name: message type
+        :param times: times the frame was received, decoded, taken out of the session's buffer
+            and ready to be dispatched, see :attr:`Session.frame_times`
+        :param handled: time the handlers were done with the frame
+        """
+        received, decoded, taken, ready = times
+        timings = self.messages.get(name)
+        if timings is None:
+            timings = self.messages[name] = MessageTimings(self.significant_bits)
+        timings.decode.record(decoded - received)
+        timings.wait.record(taken - decoded)
+        timings.parse.record(ready - taken)
+        timings.handle.record(handled - ready)
+
+    def metrics(self):
+        """
+        All statistics as dotted metric names (``bytes_in``, ``frames_per_read.p99``,
+        ``messages.seto.contract_quotes.handle.p50``...) and values, empty histograms are
+        skipped.
+
+        :rtype: list of (str, number) tuples
+        """
+        metrics = [('bytes_in', self.bytes_in), ('bytes_out', self.bytes_out)]
+        histograms = [('frames_per_read', self.frames_per_read)]
+        for name in sorted(self.messages):
+            timings = self.messages[name]
+            histograms.extend(
+                ('messages.%s.%s' % (name, stage), getattr(timings, stage))
+                for stage in MessageTimings.STAGES)
+        for prefix, histogram in histograms:
+            if histogram.count:
+                metrics.extend(
+                    ('%s.%s' % (prefix, statistic), value)
+                    for statistic, value in histogram.summary())
+        return metrics
+
+    def export_statsd(self, statsd):
+        "Send the :meth:`metrics` as gauges through a :class:`smarkets.statsd.StatsD` client"
+        for metric, value in self.metrics():
+            statsd.gauge(metric, value)
+
+    def export_graphite(self, graphite, timestamp=None):
+        "Send the :meth:`metrics` through a :class:`smarkets.graphite.Graphite` client"
+        for metric, value in self.metrics():
+            graphite.send_metric(metric, value, timestamp)
@@ -0,0 +1,137 @@
+"Keeping idle sessions alive while the application is busy"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+import threading
+from collections import deque
+
+from smarkets import private
+from smarkets.histogram import Histogram
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import monotonic_ns
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.session import Session
+
+__all__ = ('BaseKeepalive', 'Keepalive')
+
+
+class BaseKeepalive(object):
+
+    """
+    Pings the service every `ping_interval` seconds and flushes the output of a client's
+    session, the heartbeats answered while reading included, at most `max_flush_delay`
+    seconds after it's buffered. Subclasses decide when :meth:`service` runs.
+
+    Round trip times of the pings, until the client dispatches the pongs, are recorded in
+    :attr:`latency` (nanoseconds). Pings sent with :meth:`StreamingAPIClient.ping` make the
+    pongs match the wrong pings.
+    """
+    logger = private(logging.getLogger('smarkets.streaming_api.keepalive'))
+
+    def __init__(self, client, ping_interval=5.0, max_flush_delay=0.05, clock=monotonic_ns):
+        """
+        :param clock: returns the current monotonic time in nanoseconds
+        """
+        self.client = client
+        self.session = client.session
+        self.ping_interval = ping_interval
+        self.max_flush_delay = max_flush_delay
+        self.clock = clock
+        self.latency = Histogram(3)
+        self._ping = seto.Payload()
+        self._ping.type = seto.PAYLOAD_ETO
+        self._ping.eto_payload.type = eto.PAYLOAD_PING
+        # Times the pings waiting for a pong were sent, appended by service() and consumed by
+        # the client's pong handler
+        self._pings = deque()
+        self._last_ping = None
+
+    def service(self):
+        "Send a ping if it's time to, and flush the session's output, once logged in"
+        session = self.session
+        now = self.clock()
+        with session.send_lock:
+            if not (session.logged_in and session.connected):
+                # Pings sent on a lost connection won't be answered, ping again once logged in
+                self._pings.clear()
+                self._last_ping = None
+                return
+            try:
+                if self._last_ping is None or now - self._last_ping >= self.ping_interval * 1e9:
+                    session.send(self._ping)
+                    self._pings.append(now)
+                    self._last_ping = now
+                if session.send_queue:
+                    self._flush()
+            except (ConnectionError, SocketDisconnected) as exc:
+                # Whoever reads the session deals with it
+                self.logger.warning("keepalive failed: %s", exc)
+
+    def _flush(self):
+        self.session.flush()
+
+    def _attach(self):
+        self.client.add_handler('eto.pong', self._pong_received)
+
+    def _detach(self):
+        self.client.del_handler('eto.pong', self._pong_received)
+        self._pings.clear()
+        self._last_ping = None
+
+    def _pong_received(self, message):
+        if self._pings:
+            self.latency.record(self.clock() - self._pings.popleft())
+
+
+class Keepalive(BaseKeepalive):
+
+    """
+    :class:`BaseKeepalive` running in a background thread, for clients whose thread may be
+    too busy to read and answer heartbeats in time::
+
+        keepalive = Keepalive(client)
+        keepalive.start()
+        ...
+        keepalive.stop()
+
+    The thread only sends and flushes under the session's
+    :attr:`~smarkets.streaming_api.session.Session.send_lock`, reading and dispatching stay
+    in the client's thread without locking. Flushing errors are left for the client's thread
+    to run into, the thread never reconnects.
+
+    The thread writes to the socket while the client's thread reads it, which SSL sockets
+    don't support: sessions with :attr:`SessionSettings.ssl` set are refused, use
+    :class:`smarkets.streaming_api.aio.AsyncKeepalive` with them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Keepalive, self).__init__(*args, **kwargs)
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.session.settings.ssl:
+            raise ValueError('SSL sockets can\'t be written by a thread while another reads them')
+        self._attach()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='Keepalive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self._detach()
+
+    def _run(self):
+        while not self._stopped.wait(self.max_flush_delay):
+            self.service()
+
+    def _flush(self):
+        # Not the session's own flush, which may reconnect
+        Session.flush(self.session)
@@ -0,0 +1,191 @@
+"""
+Load generator measuring :class:`StreamingAPIClient` throughput and order latency
+
+Run it against a :mod:`smarkets.streaming_api.fake_server` with
+``python -m smarkets.streaming_api.loadgen --serve`` (or without ``--serve`` against a server
+started separately).
+"""
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import itertools
+import logging
+from collections import namedtuple
+
+from smarkets import private
+from smarkets.histogram import Histogram
+from smarkets.streaming_api import seto
+from smarkets.streaming_api.capture import monotonic_ns
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.reactor import Reactor
+from smarkets.streaming_api.session import Session, SessionSettings
+
+__all__ = ('LoadGenerator', 'LoadReport')
+
+
+class LoadReport(namedtuple('LoadReport', 'duration quotes orders_sent orders_answered latency')):
+
+    """
+    Outcome of a :meth:`LoadGenerator.run`: `duration` in seconds, numbers of contract quotes
+    received, of orders sent and of orders accepted or rejected, and a :class:`Histogram` of
+    the order round trip times in microseconds.
+    """
+
+    @property
+    def quotes_per_second(self):
+        return self.quotes / self.duration
+
+    @property
+    def orders_per_second(self):
+        return self.orders_answered / self.duration
+
+    def __str__(self):
+        latency = self.latency
+        return '\n'.join([
+            'duration:        %.2f s' % self.duration,
+            'quotes received: %d (%.0f/s)' % (self.quotes, self.quotes_per_second),
+            'orders answered: %d of %d (%.0f/s)' % (
+                self.orders_answered, self.orders_sent, self.orders_per_second),
+            'order latency:   p50 %s us, p99 %s us, max %s us' % (
+                latency.percentile(50), latency.percentile(99), latency.max),
+        ])
+
+
+class LoadGenerator(object):
+
+    """
+    Logs in `clients` :class:`StreamingAPIClient` instances, subscribes them to `markets`,
+    drives them all with a :class:`Reactor` and creates orders at `order_rate` per second
+    (spread across the clients) while counting the contract quotes received.
+    """
+    logger = private(logging.getLogger('smarkets.streaming_api.loadgen'))
+
+    def __init__(self, host='127.0.0.1', port=3701, clients=1, order_rate=100, markets=(1,),
+                 contracts_per_market=3, clock=monotonic_ns):
+        """
+        :param order_rate: orders created per second across all clients
+        :param markets: ids of the markets subscribed to and traded
+        :param contracts_per_market: orders are for contracts numbered from 1 to this
+        :param clock: returns the current monotonic time in nanoseconds
+        """
+        self.host = host
+        self.port = port
+        self.client_count = clients
+        self.order_rate = order_rate
+        self.markets = list(markets)
+        self.contracts_per_market = contracts_per_market
+        self.clock = clock
+
+    def _client(self):
+        settings = SessionSettings('loadgen', 'password', host=self.host, port=self.port, ssl=False)
+        settings.lazy_parse = True
+        return StreamingAPIClient(Session(settings))
+
+    def run(self, duration):
+        """
+        :param duration: seconds to generate load for
+        :rtype: :class:`LoadReport`
+        """
+        clock = self.clock
+        reactor = Reactor()
+        latency = Histogram()
+        # Send times of the orders not answered yet by reference
+        pending = {}
+        counts = {'quotes': 0, 'answered': 0}
+
+        def on_quotes(message):
+            counts['quotes'] += 1
+
+        clients = []
+        try:
+            for _ in range(self.client_count):
+                client = self._client()
+                client.login()
+                for market_id in self.markets:
+                    client.send(seto.MarketSubscribe(market_id=market_id))
+                client.flush()
+                client.add_handler('seto.contract_quotes', on_quotes)
+                for name in ('order_accepted', 'order_rejected', 'order_invalid'):
+                    client.add_handler('seto.' + name, _answer_handler(name, pending, latency, counts, clock))
+                reactor.register(client)
+                clients.append(client)
+            self.logger.info("%d clients logged in", len(clients))
+
+            contracts = itertools.cycle([
+                (market_id, contract_id) for market_id in self.markets
+                for contract_id in range(1, self.contracts_per_market + 1)])
+            targets = itertools.cycle(clients)
+            references = itertools.count(1)
+            orders_sent = 0
+            start = clock()
+            end = start + int(duration * 1e9)
+            now = start
+            while now < end:
+                due = int((now - start) * self.order_rate / 1e9)
+                while orders_sent < due:
+                    market_id, contract_id = next(contracts)
+                    reference = next(references)
+                    next(targets).send(seto.OrderCreate(
+                        market_id=market_id, contract_id=contract_id, side=seto.SIDE_BUY,
+                        quantity=10000, price=2500, reference=reference))
+                    pending[reference] = clock()
+                    orders_sent += 1
+                reactor.poll(0.001)
+                now = clock()
+            elapsed = (now - start) / 1e9
+        finally:
+            for client in clients:
+                try:
+                    reactor.unregister(client)
+                except KeyError:
+                    pass
+                client.session.disconnect()
+            reactor.close()
+        return LoadReport(elapsed, counts['quotes'], orders_sent, counts['answered'], latency)
+
+
+def _answer_handler(name, pending, latency, counts, clock):
+    "Handler recording the round trip time of orders answered with a `name` message"
+    def handler(message):
+        sent = pending.pop(getattr(message, name).reference, None)
+        if sent is not None:
+            latency.record((clock() - sent) // 1000)
+            counts['answered'] += 1
+    return handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate load against a streaming API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3701)
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--order-rate', type=float, default=100, help='orders created per second')
+    parser.add_argument('--markets', type=int, default=1, help='number of markets subscribed to')
+    parser.add_argument('--serve', action='store_true',
+                        help='run a fake server in this process (on another thread)')
+    parser.add_argument('--quote-rate', type=float, default=1000,
+                        help='contract quotes per second per client of the fake server')
+    args = parser.parse_args(argv)
+
+    markets = range(1, args.markets + 1)
+    server = None
+    if args.serve:
+        from smarkets.streaming_api.fake_server import FakeServer
+        server = FakeServer(args.host, 0, quote_rate=args.quote_rate, markets=markets)
+        server.start_thread()
+        args.port = server.port
+    try:
+        generator = LoadGenerator(args.host, args.port, args.clients, args.order_rate, markets)
+        print(generator.run(args.duration))
+    finally:
+        if server is not None:
+            server.stop_thread()
+
+
+if __name__ == '__main__':
+    main()
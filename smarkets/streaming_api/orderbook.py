@@ -0,0 +1,220 @@
+"Order books kept up to date from the quotes received by a client"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+from array import array
+from collections import namedtuple
+
+from smarkets import private
+from smarkets.odds import _ALL_TICKS
+from smarkets.signal import Signal
+
+__all__ = ('ContractBook', 'OrderBook', 'PriceLevel')
+
+# Prices of the ticks in PRICE_PERCENT_ODDS units (basis points), in increasing order, and
+# the index of each one in the ladders
+TICK_PRICES = tuple(int(tick * 100) for tick in _ALL_TICKS)
+_TICK_INDEX = dict((price, index) for index, price in enumerate(TICK_PRICES))
+
+try:
+    array('Q')
+    _QUANTITY_TYPECODE = 'Q'
+except ValueError:
+    # No unsigned long long arrays on Python 2
+    _QUANTITY_TYPECODE = 'L'
+
+
+class PriceLevel(namedtuple('PriceLevel', 'price quantity')):
+
+    "Quantity available at a price, both in the units of the quote messages"
+
+
+class ContractBook(object):
+
+    """
+    Bids and offers of a contract, as ladders of quantities indexed by tick (see
+    :data:`TICK_PRICES`). The best bid and offer are tracked as the ladders change so reading
+    them is O(1).
+    """
+
+    __slots__ = ('market_id', 'contract_id', 'bid_quantities', 'offer_quantities', '_best_bid', '_best_offer')
+
+    def __init__(self, market_id, contract_id):
+        self.market_id = market_id
+        self.contract_id = contract_id
+        self.bid_quantities = array(_QUANTITY_TYPECODE, [0]) * len(TICK_PRICES)
+        self.offer_quantities = array(_QUANTITY_TYPECODE, [0]) * len(TICK_PRICES)
+        # Ladder indexes of the best bid and offer, outside of the ladders when there's none
+        self._best_bid = -1
+        self._best_offer = len(TICK_PRICES)
+
+    @property
+    def best_bid(self):
+        "Highest bid, None when there's none"
+        index = self._best_bid
+        if index < 0:
+            return None
+        return PriceLevel(TICK_PRICES[index], self.bid_quantities[index])
+
+    @property
+    def best_offer(self):
+        "Lowest offer, None when there's none"
+        index = self._best_offer
+        if index >= len(TICK_PRICES):
+            return None
+        return PriceLevel(TICK_PRICES[index], self.offer_quantities[index])
+
+    def bids(self, depth=None):
+        """
+        :param depth: maximum number of price levels, None for all of them
+        :return: bids from the highest price down
+        :rtype: list of :class:`PriceLevel`
+        """
+        return self._levels(self.bid_quantities, self._best_bid, -1, -1, depth)
+
+    def offers(self, depth=None):
+        """
+        :param depth: maximum number of price levels, None for all of them
+        :return: offers from the lowest price up
+        :rtype: list of :class:`PriceLevel`
+        """
+        return self._levels(self.offer_quantities, self._best_offer, len(TICK_PRICES), 1, depth)
+
+    def top(self):
+        "Best bid and offer as a tuple of ladder indexes and quantities, to detect changes"
+        best_bid, best_offer = self._best_bid, self._best_offer
+        return (
+            best_bid, self.bid_quantities[best_bid] if best_bid >= 0 else 0,
+            best_offer, self.offer_quantities[best_offer] if best_offer < len(TICK_PRICES) else 0,
+        )
+
+    def clear(self):
+        for index in range(self._best_bid + 1):
+            self.bid_quantities[index] = 0
+        for index in range(self._best_offer, len(TICK_PRICES)):
+            self.offer_quantities[index] = 0
+        self._best_bid = -1
+        self._best_offer = len(TICK_PRICES)
+
+    def set_bid(self, index, quantity):
+        "Set the quantity bid at the tick `index`, 0 to remove the price level"
+        self.bid_quantities[index] = quantity
+        best = self._best_bid
+        if quantity:
+            if index > best:
+                self._best_bid = index
+        elif index == best:
+            quantities = self.bid_quantities
+            while best >= 0 and not quantities[best]:
+                best -= 1
+            self._best_bid = best
+
+    def set_offer(self, index, quantity):
+        "Set the quantity offered at the tick `index`, 0 to remove the price level"
+        self.offer_quantities[index] = quantity
+        best = self._best_offer
+        if quantity:
+            if index < best:
+                self._best_offer = index
+        elif index == best:
+            quantities = self.offer_quantities
+            end = len(TICK_PRICES)
+            while best < end and not quantities[best]:
+                best += 1
+            self._best_offer = best
+
+    def _levels(self, quantities, index, end, step, depth):
+        levels = []
+        while index != end and (depth is None or len(levels) < depth):
+            quantity = quantities[index]
+            if quantity:
+                levels.append(PriceLevel(TICK_PRICES[index], quantity))
+            index += step
+        return levels
+
+    def __repr__(self):
+        return '%s(market_id=%r, contract_id=%r, best_bid=%r, best_offer=%r)' % (
+            type(self).__name__, self.market_id, self.contract_id, self.best_bid, self.best_offer)
+
+
+class OrderBook(object):
+
+    """
+    :class:`ContractBook` of every contract quoted to a :class:`StreamingAPIClient`.
+
+    ``seto.market_quotes`` messages (sent when subscribing to a market) replace the books
+    of the contracts they contain, ``seto.contract_quotes`` messages update the quantities
+    of the price levels they contain (a quantity of 0 removing the level).
+
+    :attr:`top_changed` is fired with a ``contract`` argument (the :class:`ContractBook`)
+    once per message changing the best bid or offer (price or quantity) of a contract::
+
+        book = OrderBook(client)
+        book.top_changed += lambda contract: print(contract.best_bid, contract.best_offer)
+    """
+    logger = private(logging.getLogger('smarkets.streaming_api.orderbook'))
+
+    def __init__(self, client=None):
+        """
+        :param client: client to :meth:`attach` to, if any
+        """
+        self.contracts = {}
+        self.top_changed = Signal()
+        if client is not None:
+            self.attach(client)
+
+    def attach(self, client):
+        "Update the books from the quotes received by `client`"
+        client.add_handler('seto.market_quotes', self._market_quotes_received)
+        client.add_handler('seto.contract_quotes', self._contract_quotes_received)
+
+    def detach(self, client):
+        client.del_handler('seto.market_quotes', self._market_quotes_received)
+        client.del_handler('seto.contract_quotes', self._contract_quotes_received)
+
+    def contract(self, market_id, contract_id):
+        ":rtype: :class:`ContractBook` or None if the contract hasn't been quoted"
+        return self.contracts.get((market_id, contract_id))
+
+    def update_market_quotes(self, market_quotes):
+        ":type market_quotes: :class:`seto.MarketQuotes`"
+        for contract_quotes in market_quotes.contract_quotes:
+            self._update(contract_quotes, snapshot=True)
+
+    def update_contract_quotes(self, contract_quotes):
+        ":type contract_quotes: :class:`seto.ContractQuotes`"
+        self._update(contract_quotes, snapshot=False)
+
+    def _market_quotes_received(self, message):
+        self.update_market_quotes(message.market_quotes)
+
+    def _contract_quotes_received(self, message):
+        self.update_contract_quotes(message.contract_quotes)
+
+    def _update(self, contract_quotes, snapshot):
+        key = (contract_quotes.market_id, contract_quotes.contract_id)
+        book = self.contracts.get(key)
+        if book is None:
+            book = self.contracts[key] = ContractBook(*key)
+        top = book.top()
+        if snapshot:
+            book.clear()
+        tick_index = _TICK_INDEX
+        for quote in contract_quotes.bids:
+            index = tick_index.get(quote.price)
+            if index is None:
+                self.logger.warning("ignoring bid at %d which isn't a tick", quote.price)
+            else:
+                book.set_bid(index, quote.quantity)
+        for quote in contract_quotes.offers:
+            index = tick_index.get(quote.price)
+            if index is None:
+                self.logger.warning("ignoring offer at %d which isn't a tick", quote.price)
+            else:
+                book.set_offer(index, quote.quantity)
+        if self.top_changed and book.top() != top:
+            self.top_changed(contract=book)
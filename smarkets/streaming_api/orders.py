@@ -0,0 +1,344 @@
+"Tracking of the orders created through a client"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import itertools
+import logging
+
+from smarkets import private
+from smarkets.signal import Signal
+from smarkets.streaming_api import seto
+
+__all__ = ('Exposure', 'OrderTracker', 'TrackedOrder')
+
+# Prices are percentages in basis points
+_MAX_PRICE = 10000
+
+PENDING = 'pending'
+LIVE = 'live'
+FILLED = 'filled'
+CANCELLED = 'cancelled'
+REJECTED = 'rejected'
+
+
+class TrackedOrder(object):
+
+    """
+    State of an order known to an :class:`OrderTracker`: :data:`PENDING` until it's accepted,
+    :data:`LIVE` until it's filled, cancelled or rejected (:data:`FILLED`, :data:`CANCELLED`,
+    :data:`REJECTED`).
+    """
+
+    __slots__ = (
+        'reference', 'order_id', 'market_id', 'contract_id', 'side', 'price', 'quantity',
+        'executed_quantity', 'state', 'cancel_requested',
+    )
+
+    def __init__(self, reference, market_id, contract_id, side, price, quantity, order_id=None):
+        self.reference = reference
+        self.order_id = order_id
+        self.market_id = market_id
+        self.contract_id = contract_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.executed_quantity = 0
+        self.state = PENDING
+        # Whether to cancel the order as soon as it's accepted
+        self.cancel_requested = False
+
+    @property
+    def remaining_quantity(self):
+        return self.quantity - self.executed_quantity
+
+    @property
+    def open(self):
+        "Whether the order is pending or live"
+        return self.state in (PENDING, LIVE)
+
+    def __repr__(self):
+        return '%s(reference=%r, order_id=%r, state=%r, price=%r, quantity=%r, executed_quantity=%r)' % (
+            type(self).__name__, self.reference, self.order_id, self.state, self.price,
+            self.quantity, self.executed_quantity)
+
+
+def _value(side, price, quantity):
+    "Money at risk (times 10000) buying or selling `quantity` at `price`"
+    return quantity * (price if side == seto.SIDE_BUY else _MAX_PRICE - price)
+
+
+class Exposure(object):
+
+    """
+    Aggregated quantities and stakes (the money at risk: the price times the quantity when
+    buying, one minus the price times the quantity when selling) of the open (unexecuted
+    quantity of pending and live orders) and executed parts of orders.
+    """
+
+    __slots__ = ('open_quantity', 'open_value', 'executed_quantity', 'executed_value')
+
+    def __init__(self):
+        self.open_quantity = 0
+        self.open_value = 0
+        self.executed_quantity = 0
+        self.executed_value = 0
+
+    @property
+    def open_stake(self):
+        "In the unit of the quantities"
+        return self.open_value / _MAX_PRICE
+
+    @property
+    def executed_stake(self):
+        "In the unit of the quantities"
+        return self.executed_value / _MAX_PRICE
+
+    def __repr__(self):
+        return '%s(open_quantity=%r, open_stake=%r, executed_quantity=%r, executed_stake=%r)' % (
+            type(self).__name__, self.open_quantity, self.open_stake, self.executed_quantity,
+            self.executed_stake)
+
+
+class OrderTracker(object):
+
+    """
+    Matches the order messages received by a :class:`StreamingAPIClient` to the orders created
+    through :meth:`create`.
+
+    Open orders are indexed by reference, by order id (once accepted) and by market, so that
+    every message is matched and every market is cancelled (:meth:`cancel_market`) without
+    scanning all orders. :class:`Exposure` aggregates per market and per contract and side
+    are updated as orders are created, executed, cancelled or rejected. Closed orders are
+    forgotten, :attr:`order_changed` is fired with an ``order`` argument whenever the state
+    or the executed quantity of an order changes.
+
+    An accepted order cancel replace cancels the original order and opens the replacing
+    order under the replace's reference. Track the order create a replace is made from (see
+    :class:`smarkets.streaming_api.scheduler.SendScheduler`) to get that order back::
+
+        tracker = OrderTracker(client)
+        order = tracker.create(seto.OrderCreate(
+            market_id=market_id, contract_id=contract_id, side=seto.SIDE_BUY,
+            quantity=100000, price=2500))
+        client.flush()
+        ...
+        tracker.exposure(market_id).open_stake
+    """
+    logger = private(logging.getLogger('smarkets.streaming_api.orders'))
+
+    _HANDLERS = (
+        ('seto.order_accepted', '_order_accepted'),
+        ('seto.order_rejected', '_order_rejected'),
+        ('seto.order_invalid', '_order_invalid'),
+        ('seto.order_executed', '_order_executed'),
+        ('seto.order_cancelled', '_order_cancelled'),
+        ('seto.order_cancel_replace_accepted', '_order_cancel_replace_accepted'),
+        ('seto.order_cancel_replace_rejected', '_order_cancel_replace_rejected'),
+    )
+
+    def __init__(self, client=None, first_reference=1):
+        """
+        :param client: client to :meth:`attach` to, if any
+        :param first_reference: reference given to the first order created without one
+        """
+        self.client = None
+        self.by_reference = {}
+        self.by_order_id = {}
+        # Open orders of each market
+        self.by_market = {}
+        self.order_changed = Signal()
+        self._references = itertools.count(first_reference)
+        self._exposures = {}
+        if client is not None:
+            self.attach(client)
+
+    def attach(self, client):
+        "Track the orders created and the order messages received through `client`"
+        self.client = client
+        for name, method in self._HANDLERS:
+            client.add_handler(name, getattr(self, method))
+
+    def detach(self):
+        for name, method in self._HANDLERS:
+            self.client.del_handler(name, getattr(self, method))
+        self.client = None
+
+    def create(self, order_create):
+        """
+        Send `order_create` and track the order, a reference is set if it doesn't have one.
+        The client isn't flushed.
+
+        :type order_create: :class:`seto.OrderCreate`
+        :rtype: :class:`TrackedOrder`
+        """
+        if not order_create.reference:
+            order_create.reference = next(self._references)
+        order = self.track(order_create)
+        self.client.send(order_create)
+        return order
+
+    def track(self, order_create):
+        """
+        Track an order sent by other means than :meth:`create`, `order_create` must have a
+        unique reference.
+
+        :rtype: :class:`TrackedOrder`
+        """
+        if order_create.reference in self.by_reference:
+            raise ValueError('Reference %d is already used by %r' % (
+                order_create.reference, self.by_reference[order_create.reference]))
+        order = TrackedOrder(
+            order_create.reference, order_create.market_id, order_create.contract_id,
+            order_create.side, order_create.price, order_create.quantity)
+        self._open(order)
+        return order
+
+    def cancel(self, order):
+        """
+        Send an order cancel for `order` (a :class:`TrackedOrder` or an order id), pending
+        orders are cancelled once accepted. The client isn't flushed.
+        """
+        if not isinstance(order, TrackedOrder):
+            order = self.by_order_id[order]
+        if order.order_id is None:
+            order.cancel_requested = True
+        else:
+            self.client.send(seto.OrderCancel(order_id=order.order_id))
+
+    def cancel_market(self, market_id):
+        """
+        :meth:`cancel` all open orders in a market.
+
+        :return: number of orders cancelled
+        """
+        orders = list(self.by_market.get(market_id, ()))
+        for order in orders:
+            self.cancel(order)
+        return len(orders)
+
+    def open_orders(self, market_id=None):
+        ":rtype: list of the pending and live :class:`TrackedOrder` of a market or of all markets"
+        if market_id is None:
+            return list(self.by_reference.values())
+        return list(self.by_market.get(market_id, ()))
+
+    def exposure(self, market_id, contract_id=None, side=None):
+        """
+        Exposure in a market, or on one side of a contract when both `contract_id` and `side`
+        are given.
+
+        :rtype: :class:`Exposure`
+        """
+        key = (market_id,) if contract_id is None else (market_id, contract_id, side)
+        return self._exposures.get(key) or Exposure()
+
+    def _exposures_of(self, order):
+        exposures = self._exposures
+        keys = ((order.market_id,), (order.market_id, order.contract_id, order.side))
+        for key in keys:
+            exposure = exposures.get(key)
+            if exposure is None:
+                exposure = exposures[key] = Exposure()
+            yield exposure
+
+    def _open(self, order):
+        self.by_reference[order.reference] = order
+        if order.order_id is not None:
+            self.by_order_id[order.order_id] = order
+        self.by_market.setdefault(order.market_id, set()).add(order)
+        value = _value(order.side, order.price, order.quantity)
+        for exposure in self._exposures_of(order):
+            exposure.open_quantity += order.quantity
+            exposure.open_value += value
+
+    def _close(self, order, state):
+        remaining = order.remaining_quantity
+        value = _value(order.side, order.price, remaining)
+        for exposure in self._exposures_of(order):
+            exposure.open_quantity -= remaining
+            exposure.open_value -= value
+        order.state = state
+        self.by_reference.pop(order.reference, None)
+        if order.order_id is not None:
+            self.by_order_id.pop(order.order_id, None)
+        market_orders = self.by_market[order.market_id]
+        market_orders.discard(order)
+        if not market_orders:
+            del self.by_market[order.market_id]
+        self._changed(order)
+
+    def _changed(self, order):
+        if self.order_changed:
+            self.order_changed(order=order)
+
+    def _order_accepted(self, message):
+        self._accept(message.order_accepted)
+
+    def _accept(self, accepted):
+        "Make the order of an order accepted or order cancel replace accepted message live"
+        order = self.by_reference.get(accepted.reference)
+        if order is None:
+            self.logger.info("tracking order %d accepted but not created here", accepted.order_id)
+            # Orders created elsewhere may not have a reference
+            reference = accepted.reference or ('order_id', accepted.order_id)
+            order = TrackedOrder(
+                reference, accepted.market_id, accepted.contract_id, accepted.side,
+                accepted.price, accepted.quantity, order_id=accepted.order_id)
+            self._open(order)
+        else:
+            order.order_id = accepted.order_id
+            self.by_order_id[accepted.order_id] = order
+        order.state = LIVE
+        self._changed(order)
+        if order.cancel_requested:
+            self.cancel(order)
+
+    def _order_rejected(self, message):
+        self._reject(message.order_rejected.reference)
+
+    def _order_invalid(self, message):
+        self._reject(message.order_invalid.reference)
+
+    def _reject(self, reference):
+        order = self.by_reference.get(reference)
+        if order is not None and order.state == PENDING:
+            self._close(order, REJECTED)
+
+    def _order_executed(self, message):
+        executed = message.order_executed
+        order = self.by_order_id.get(executed.order_id)
+        if order is None:
+            self.logger.warning("execution of unknown order %d", executed.order_id)
+            return
+        quantity = executed.quantity
+        open_value = _value(order.side, order.price, quantity)
+        executed_value = _value(order.side, executed.price, quantity)
+        for exposure in self._exposures_of(order):
+            exposure.open_quantity -= quantity
+            exposure.open_value -= open_value
+            exposure.executed_quantity += quantity
+            exposure.executed_value += executed_value
+        order.executed_quantity += quantity
+        if order.remaining_quantity <= 0:
+            self._close(order, FILLED)
+        else:
+            self._changed(order)
+
+    def _order_cancelled(self, message):
+        order = self.by_order_id.get(message.order_cancelled.order_id)
+        if order is not None:
+            self._close(order, CANCELLED)
+
+    def _order_cancel_replace_accepted(self, message):
+        accepted = message.order_cancel_replace_accepted
+        original = self.by_order_id.get(accepted.orig_order_id)
+        if original is not None:
+            self._close(original, CANCELLED)
+        self._accept(accepted)
+
+    def _order_cancel_replace_rejected(self, message):
+        # The original order is left as it is
+        self._reject(message.order_cancel_replace_rejected.reference)
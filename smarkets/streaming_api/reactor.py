@@ -0,0 +1,175 @@
+"Drive many streaming API clients from a single thread"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+import ssl
+from collections import namedtuple
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+from smarkets import private
+from smarkets.signal import Signal
+from smarkets.streaming_api.client import READ_MODE_BUFFER_FROM_SOCKET, READ_MODE_DISPATCH_FROM_BUFFER
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+
+__all__ = ('Backlog', 'Reactor')
+
+
+class Backlog(namedtuple('Backlog', 'outgoing_bytes incoming_bytes incoming_frames')):
+
+    """
+    Data a session hasn't processed yet: bytes waiting to be sent, received bytes not forming
+    a complete frame yet and decoded frames waiting to be dispatched.
+    """
+
+
+class Reactor(object):
+
+    """
+    Reads, dispatches and flushes any number of logged in :class:`StreamingAPIClient`
+    instances using a single :mod:`selectors` selector.
+
+    Sockets of registered clients are switched to non-blocking mode. Whenever a socket is
+    readable all available data is read and dispatched to the client's handlers, and
+    output buffered with :meth:`StreamingAPIClient.send` is flushed as soon as the socket
+    is writable (the socket is only watched for writability while there's output pending).
+
+    Clients whose connection fails are unregistered and :attr:`disconnected` is fired with
+    ``client`` and ``exception`` arguments.
+
+    Example::
+
+        reactor = Reactor()
+        for client in clients:
+            client.login()
+            reactor.register(client)
+        reactor.run()
+    """
+    logger = private(logging.getLogger('smarkets.reactor'))
+
+    def __init__(self, selector=None):
+        """
+        :type selector: :class:`selectors.BaseSelector` or None for the default selector
+        """
+        self.selector = selector or selectors.DefaultSelector()
+        self.disconnected = Signal()
+        self._running = False
+
+    @property
+    def clients(self):
+        "Registered clients"
+        return [key.data for key in self.selector.get_map().values()]
+
+    def register(self, client):
+        """
+        :type client: :class:`StreamingAPIClient` with a connected session
+        """
+        sock = client.raw_socket
+        if sock is None:
+            raise SocketDisconnected('Only connected clients can be registered')
+        sock.setblocking(False)
+        self.selector.register(sock, self._events(client), client)
+
+    def unregister(self, client):
+        "Stop processing `client`, its socket is left open and non-blocking"
+        for key in list(self.selector.get_map().values()):
+            if key.data is client:
+                self.selector.unregister(key.fileobj)
+                return
+        raise KeyError(client)
+
+    def backlog(self, client):
+        """
+        :rtype: :class:`Backlog`
+        """
+        session = client.session
+        return Backlog(
+            outgoing_bytes=session.output_buffer_size,
+            incoming_bytes=len(session.decoder),
+            incoming_frames=len(session.buffered_incoming_payloads),
+        )
+
+    def backlogs(self):
+        """
+        :return: backlog of each registered client
+        :rtype: dict of :class:`StreamingAPIClient` to :class:`Backlog`
+        """
+        return dict((client, self.backlog(client)) for client in self.clients)
+
+    def poll(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (forever if None) for any socket to be ready and
+        process all ready sockets.
+
+        :return: Number of dispatched incoming messages.
+        :rtype: int
+        """
+        # Output may have been buffered since the last poll
+        for key in list(self.selector.get_map().values()):
+            self._update_events(key)
+
+        processed = 0
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            try:
+                if events & selectors.EVENT_READ:
+                    processed += self._read(client, key.fileobj)
+                if client.session.output_buffer_size:
+                    client.flush()
+            except (ConnectionError, SocketDisconnected) as e:
+                self._disconnect(key, e)
+            else:
+                self._update_events(key)
+
+        return processed
+
+    def run(self, timeout=None):
+        """
+        Poll until :meth:`stop` is called or no clients are left.
+
+        :param timeout: passed to each :meth:`poll`
+        """
+        self._running = True
+        while self._running and self.selector.get_map():
+            self.poll(timeout)
+
+    def stop(self):
+        "Make :meth:`run` return after the current poll"
+        self._running = False
+
+    def close(self):
+        "Unregister all clients and close the selector"
+        self.selector.close()
+
+    def _read(self, client, sock):
+        client.read(READ_MODE_BUFFER_FROM_SOCKET)
+        # Decrypted data buffered by SSL doesn't make the socket readable again
+        if isinstance(sock, ssl.SSLSocket):
+            while sock.pending():
+                client.read(READ_MODE_BUFFER_FROM_SOCKET)
+        return client.read(READ_MODE_DISPATCH_FROM_BUFFER)
+
+    def _update_events(self, key):
+        events = self._events(key.data)
+        if events != key.events:
+            self.selector.modify(key.fileobj, events, key.data)
+
+    @staticmethod
+    def _events(client):
+        if client.session.output_buffer_size:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def _disconnect(self, key, exception):
+        client = key.data
+        self.logger.warning('client %r disconnected: %r', client, exception)
+        self.selector.unregister(key.fileobj)
+        client.session.disconnect()
+        self.disconnected(client=client, exception=exception)
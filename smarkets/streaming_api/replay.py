@@ -0,0 +1,122 @@
+"Replay of captured sessions without a connection"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import logging
+import time
+from collections import deque
+
+from smarkets import private
+from smarkets.streaming_api.capture import CaptureReader, DIRECTION_IN, monotonic_ns
+from smarkets.streaming_api.exceptions import SocketDisconnected
+from smarkets.streaming_api.session import Session
+from smarkets.streaming_api.utils import peek_payload
+
+__all__ = ('ReplaySession',)
+
+
+class ReplaySession(Session):
+
+    """
+    :class:`Session` reading the payloads received in a capture file (see
+    :class:`smarkets.streaming_api.capture.CaptureWriter`) instead of a socket. It can be
+    used with :class:`StreamingAPIClient` like a live session::
+
+        client = StreamingAPIClient(ReplaySession(settings, 'session.cap'))
+        client.login()
+        while True:
+            client.read()  # raises SocketDisconnected at the end of the capture
+
+    Each :meth:`read` returns the payloads received by a single read when the capture was
+    made. Payloads sent by the client are discarded, so are the outgoing payloads recorded
+    in the capture. Incoming sequence numbers continue from the first payload of the
+    capture.
+    """
+    logger = private(logging.getLogger('smarkets.session.replay'))
+
+    def __init__(self, settings, capture_file, speed=None, sleep=time.sleep, clock=monotonic_ns, **kwargs):
+        """
+        :param capture_file: path or binary file object of a capture file
+        :param speed: None to replay as fast as possible, 1 to replay at the recorded
+            speed, 2 twice as fast...
+        :param sleep: function sleeping for given number of seconds
+        :param clock: returns the current monotonic time in nanoseconds
+        """
+        super(ReplaySession, self).__init__(settings, **kwargs)
+        self.reader = CaptureReader(capture_file)
+        self.speed = speed
+        self.sleep = sleep
+        self.clock = clock
+        self._records = None
+        self._pending = deque()
+        # Recorded time of the first replayed payload and when it was replayed
+        self._start = None
+
+    @property
+    def raw_socket(self):
+        return None
+
+    @property
+    def connected(self):
+        return self._records is not None
+
+    def connect(self):
+        "Start replaying from the beginning of the capture"
+        if self._records is None:
+            self._records = (
+                record for record in self.reader if record.direction == DIRECTION_IN)
+            self._start = None
+            self._clear_send_buffer()
+
+    def disconnect(self):
+        self._records = None
+        self._pending.clear()
+        self.inseq = self.init_inseq
+        self.outseq = self.init_outseq
+
+    def flush(self):
+        "Discard everything sent"
+        self.send_queue.clear()
+        self._send_chunk = None
+
+    def read(self):
+        """
+        Buffer the next batch of recorded payloads, waiting until it's due when replaying at
+        the recorded speed.
+
+        :raises:
+            :SocketDisconnected: at the end of the capture or when not connected.
+        """
+        if self._records is None:
+            raise SocketDisconnected('Trying to read from a replay session when disconnected')
+        batch = self._pending
+        if not batch:
+            record = next(self._records, None)
+            if record is None:
+                self.logger.info("end of capture reached")
+                self._records = None
+                raise SocketDisconnected('End of capture reached')
+            batch.append(record)
+        timestamp = batch[0].timestamp
+        # Payloads received by the same read share the timestamp
+        for record in self._records:
+            batch.append(record)
+            if record.timestamp != timestamp:
+                break
+
+        if self._start is None:
+            self._start = (timestamp, self.clock())
+            self.inseq = peek_payload(batch[0].payload)[1]
+        elif self.speed:
+            due = self._start[1] + (timestamp - self._start[0]) / self.speed
+            delay = (due - self.clock()) / 1e9
+            if delay > 0:
+                self.sleep(delay)
+
+        payloads = []
+        while batch and batch[0].timestamp == timestamp:
+            payloads.append(batch.popleft().payload)
+        self._buffer_payloads(payloads, sum(len(payload) for payload in payloads))
@@ -0,0 +1,225 @@
+"Sessions reconnecting and recovering missed payloads by themselves"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+import time
+
+from smarkets import private
+from smarkets.errors import reraise
+from smarkets.histogram import Histogram
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import monotonic_ns
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.framing import FrameDecoder
+from smarkets.streaming_api.session import Session
+
+__all__ = ('ResilientSession',)
+
+
+def _account_sequence_fields():
+    "Payload types of the messages carrying an account sequence and their payload field names"
+    fields = {}
+    payload_types = seto.Payload.DESCRIPTOR.fields_by_name['type'].enum_type.values_by_name
+    for field in seto.Payload.DESCRIPTOR.fields:
+        payload_type = payload_types.get('PAYLOAD_' + field.name.upper())
+        if (payload_type is not None and field.message_type is not None and
+                'account_sequence_64' in field.message_type.fields_by_name):
+            fields[payload_type.number] = field.name
+    return fields
+
+
+_ACCOUNT_SEQUENCE_FIELDS = _account_sequence_fields()
+
+# Logouts reconnecting wouldn't help with
+_FINAL_LOGOUT_REASONS = frozenset((
+    eto.LOGOUT_CONFIRMATION, eto.LOGOUT_UNAUTHORISED, eto.LOGOUT_UNVERIFIED))
+
+
+class ResilientSession(Session):
+
+    """
+    :class:`Session` that survives connection failures and missed payloads:
+
+    * When reading or flushing fails, or the service logs the session out (for reasons other
+      than bad credentials or a :meth:`logout`), it reconnects with exponential backoff and
+      logs in again, resuming from the account sequence of the last message handed out by
+      :meth:`next_frame` so that the account messages sent since are received again.
+      Decoded and partially received payloads of the lost connection are discarded, and so
+      is the send buffer.
+    * Payloads received ahead of the expected sequence number are kept in a bounded reorder
+      buffer, and a replay of the missing ones is requested. Once they're received the
+      buffered payloads follow in order.
+
+    Reconnections and gaps are counted in :attr:`reconnects`, :attr:`reconnect_times`
+    (nanoseconds), :attr:`gap_sizes`, :attr:`frames_replayed`, :attr:`frames_reordered` and
+    :attr:`frames_dropped` (out of sequence payloads not fitting in the reorder buffer, they
+    are expected to be replayed), see :meth:`metrics`.
+    """
+    logger = private(logging.getLogger('smarkets.session.resilient'))
+
+    def __init__(self, settings, reorder_buffer_size=1024, initial_delay=0.1, max_delay=30.0,
+                 max_attempts=None, sleep=time.sleep, clock=monotonic_ns, **kwargs):
+        """
+        :param reorder_buffer_size: maximum number of out of sequence payloads kept
+        :param initial_delay: seconds to wait after the first failed connection attempt, the
+            delay doubles after each failure up to `max_delay`
+        :param max_attempts: connection attempts before giving up and raising the error of the
+            last one, None to never give up
+        :param sleep: called with the seconds to wait between connection attempts
+        :param clock: returns the current monotonic time in nanoseconds
+
+        Other arguments are passed to :class:`Session`.
+        """
+        super(ResilientSession, self).__init__(settings, **kwargs)
+        self.reorder_buffer_size = reorder_buffer_size
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+        self.clock = clock
+        # Out of sequence payloads by sequence number, and the highest sequence number seen
+        # while a replay is expected
+        self.reorder_buffer = {}
+        self._gap_end = None
+        # Whether the next buffered payload comes from the reorder buffer
+        self._reordered_next = False
+        self._logout_reason = None
+        self._closing = False
+        self.reconnects = 0
+        self.reconnect_times = Histogram(3)
+        self.gap_sizes = Histogram()
+        self.frames_replayed = 0
+        self.frames_reordered = 0
+        self.frames_dropped = 0
+
+    def connect(self):
+        self._closing = False
+        self._logout_reason = None
+        super(ResilientSession, self).connect()
+
+    def logout(self):
+        self._closing = True
+        super(ResilientSession, self).logout()
+
+    def read(self):
+        try:
+            super(ResilientSession, self).read()
+        except (ConnectionError, SocketDisconnected) as exc:
+            self._connection_lost(exc)
+
+    def flush(self):
+        try:
+            super(ResilientSession, self).flush()
+        except (ConnectionError, SocketDisconnected) as exc:
+            self._connection_lost(exc)
+
+    def reconnect(self):
+        "Drop the connection and everything received on it, then connect and log in again"
+        started = self.clock()
+        self.disconnect()
+        self.decoder = FrameDecoder()
+        self.buffered_incoming_payloads.clear()
+        if self.instrumentation is not None:
+            self._read_times.clear()
+        self.reorder_buffer.clear()
+        self._gap_end = None
+        self._reordered_next = False
+        attempt = 0
+        while True:
+            try:
+                self.connect()
+                break
+            except (ConnectionError, SocketDisconnected) as exc:
+                attempt += 1
+                if self.max_attempts is not None and attempt >= self.max_attempts:
+                    raise
+                self.socket.disconnect()
+                delay = min(self.initial_delay * 2 ** (attempt - 1), self.max_delay)
+                self.logger.warning(
+                    "connection attempt %d failed (%s), retrying in %.1fs", attempt, exc, delay)
+                self.sleep(delay)
+        self.reconnects += 1
+        self.reconnect_times.record(self.clock() - started)
+        self.logger.info("reconnected, resuming from account sequence %s", self.account_sequence)
+
+    def _connection_lost(self, exc):
+        if self._closing or self._logout_reason in _FINAL_LOGOUT_REASONS:
+            reraise(exc)
+        self.logger.warning("connection lost (%s), reconnecting", exc)
+        self.reconnect()
+
+    def next_frame(self):
+        frame = super(ResilientSession, self).next_frame()
+        if frame is None:
+            return None
+        if self._reordered_next:
+            self._reordered_next = False
+        elif self._gap_end is not None:
+            self.frames_replayed += 1
+        field = _ACCOUNT_SEQUENCE_FIELDS.get(frame.type)
+        if field is not None:
+            message = getattr(frame.protobuf, field)
+            self.account_sequence = message.account_sequence_64 or message.account_sequence
+        elif frame.eto_type == eto.PAYLOAD_LOGOUT:
+            self._logout_reason = frame.protobuf.eto_payload.logout.reason
+        if self._gap_end is not None:
+            self._next_in_sequence()
+        return frame
+
+    def _next_in_sequence(self):
+        "Queue the payload following the last one from the reorder buffer, if it's there"
+        data = self.reorder_buffer.pop(self.inseq, None)
+        if data is not None:
+            self.buffered_incoming_payloads.appendleft(data)
+            self._reordered_next = True
+            self.frames_reordered += 1
+            if self.instrumentation is not None:
+                now = self.instrumentation.clock()
+                self._read_times.appendleft([1, now, now])
+        elif self.inseq > self._gap_end:
+            self.logger.info("recovered from the gap up to sequence %d", self._gap_end)
+            self._gap_end = None
+
+    def _out_of_sequence(self, frame):
+        seq = frame.seq
+        if self._gap_end is None:
+            self.logger.warning(
+                "received sequence %d instead of %d, requesting a replay", seq, self.inseq)
+            self.gap_sizes.record(seq - self.inseq)
+            self._gap_end = seq
+            replay = self.out_payload
+            replay.Clear()
+            replay.type = seto.PAYLOAD_ETO
+            replay.eto_payload.type = eto.PAYLOAD_REPLAY
+            replay.eto_payload.replay.seq = self.inseq
+            self.send()
+            self.flush()
+        else:
+            self._gap_end = max(self._gap_end, seq)
+        if seq in self.reorder_buffer:
+            return
+        if len(self.reorder_buffer) < self.reorder_buffer_size:
+            self.reorder_buffer[seq] = bytes(frame.bytes)
+        else:
+            self.frames_dropped += 1
+
+    def metrics(self):
+        """
+        Reconnection and gap statistics as dotted metric names and values, in the format of
+        :meth:`smarkets.streaming_api.instrumentation.Instrumentation.metrics`
+        """
+        metrics = [
+            ('reconnects', self.reconnects),
+            ('frames_replayed', self.frames_replayed),
+            ('frames_reordered', self.frames_reordered),
+            ('frames_dropped', self.frames_dropped),
+        ]
+        for prefix, histogram in (('reconnect_time', self.reconnect_times), ('gap_size', self.gap_sizes)):
+            if histogram.count:
+                metrics.extend(
+                    ('%s.%s' % (prefix, statistic), value) for statistic, value in histogram.summary())
+        return metrics
@@ -0,0 +1,250 @@
+"Rate limited sending of the messages of a client"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import logging
+import time
+from collections import deque
+
+from smarkets import private
+from smarkets.streaming_api import seto
+from smarkets.streaming_api.utils import payload_field
+
+__all__ = ('SendScheduler', 'TokenBucket')
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Optional fields of order creates an order cancel replace can carry
+_REPLACE_OPTIONAL_FIELDS = ('price_type', 'quantity_type', 'reference', 'label', 'market_id')
+
+
+def _replaceable(create, order):
+    "Whether an order cancel replace of `order` can do what cancelling it and `create` would"
+    return (
+        create.HasField('price') and create.HasField('quantity') and
+        create.type == seto.ORDER_CREATE_LIMIT and
+        not create.HasField('maq') and not create.HasField('tif') and
+        create.contract_id == order.contract_id and create.side == order.side and
+        (not create.HasField('market_id') or create.market_id == order.market_id))
+
+
+class TokenBucket(object):
+
+    """
+    Allows `burst` messages at once and `rate` messages per second on average. Tokens are
+    added continuously, or `rate` * `tick` of them every `tick` seconds when a tick is given
+    (the way the exchange refills its own buckets).
+    """
+
+    __slots__ = ('rate', 'burst', 'tick', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, tick=0, now=0):
+        self.rate = rate
+        self.burst = burst
+        self.tick = tick
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        if self.tick:
+            ticks = elapsed // self.tick
+            self.updated += ticks * self.tick
+            elapsed = ticks * self.tick
+        else:
+            self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def delay(self, now):
+        ":return: seconds until a token is available, after :meth:`refill`"
+        missing = 1 - self.tokens
+        if missing <= 0:
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        if self.tick:
+            per_tick = self.rate * self.tick
+            ticks = -(-missing // per_tick)
+            return max(0, ticks * self.tick - (now - self.updated))
+        return missing / self.rate
+
+    def __repr__(self):
+        return '%s(rate=%r, burst=%r, tick=%r, tokens=%r)' % (
+            type(self).__name__, self.rate, self.burst, self.tick, self.tokens)
+
+
+class SendScheduler(object):
+
+    """
+    Queues the messages of a :class:`StreamingAPIClient` and sends them as fast as
+    :class:`TokenBucket` limits allow: limits per message type (``order_create``,
+    ``order_cancel``... see :meth:`set_limit`) and the limit of the exchange, which follows
+    the ``seto.throttle_limits_changed`` messages received by the client.
+
+    While they're queued, cancels of an order already being cancelled are dropped, and a
+    cancel and an order create replacing the cancelled order (see :meth:`schedule`) are
+    merged into an order cancel replace when the create is for the same contract and side
+    and its fields allow it.
+
+    Messages are sent in the order they were scheduled by :meth:`flush`, which the
+    application calls again after :meth:`next_send_delay` seconds while messages are left::
+
+        scheduler = SendScheduler(client)
+        scheduler.set_limit('order_create', rate=10, burst=20)
+        scheduler.schedule(seto.OrderCancel(order_id=order.order_id))
+        scheduler.schedule(order_create, replaces=order)
+        scheduler.flush()
+        ...
+        delay = scheduler.next_send_delay()
+    """
+    logger = private(logging.getLogger('smarkets.streaming_api.scheduler'))
+
+    def __init__(self, client, clock=_monotonic):
+        """
+        :param clock: returns the current monotonic time in seconds
+        """
+        self.client = client
+        self.clock = clock
+        # Limits by payload field name, and the exchange's limit once known
+        self.limits = {}
+        self.throttle = None
+        # Queued [message, id of the order it cancels or None] entries, lists so that a
+        # cancel can be turned into a cancel replace in place
+        self.queue = deque()
+        # Queued cancel (or cancel replace) entries by id of the order cancelled
+        self.cancels = {}
+        self.merged = 0
+        self.dropped = 0
+        client.add_handler('seto.throttle_limits_changed', self._throttle_limits_changed)
+
+    def detach(self):
+        "Stop following the exchange's limit"
+        self.client.del_handler('seto.throttle_limits_changed', self._throttle_limits_changed)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def set_limit(self, name, rate, burst, tick=0):
+        """
+        Limit the messages of a type.
+
+        :param name: payload field name of the messages, ``'order_create'`` for example.
+            Order cancel replaces without a limit of their own are charged against the
+            ``order_create`` and ``order_cancel`` limits.
+        """
+        self.limits[name] = TokenBucket(rate, burst, tick, self.clock())
+
+    def schedule(self, message, replaces=None):
+        """
+        Queue `message` to be sent.
+
+        :param replaces: when `message` is an order create, the order it replaces, anything
+            with `order_id`, `market_id`, `contract_id` and `side` attributes like a
+            :class:`smarkets.streaming_api.orders.TrackedOrder`. If a cancel of that order is
+            queued and the create has a price and is for the same contract and side, both are
+            merged into an order cancel replace. Otherwise they're sent separately.
+        :return: False if the message was dropped or merged with a queued message
+        """
+        message_type = type(message)
+        if message_type is seto.OrderCancel:
+            if message.order_id in self.cancels:
+                self.dropped += 1
+                return False
+            entry = self.cancels[message.order_id] = [message, message.order_id]
+        elif replaces is not None and message_type is seto.OrderCreate:
+            entry = self.cancels.get(replaces.order_id)
+            if (entry is not None and type(entry[0]) is seto.OrderCancel and
+                    _replaceable(message, replaces)):
+                replace = seto.OrderCancelReplace(
+                    orig_order_id=replaces.order_id, price=message.price, quantity=message.quantity)
+                for field in _REPLACE_OPTIONAL_FIELDS:
+                    if message.HasField(field):
+                        setattr(replace, field, getattr(message, field))
+                entry[0] = replace
+                self.merged += 1
+                return False
+            entry = [message, None]
+        else:
+            entry = [message, None]
+        self.queue.append(entry)
+        return True
+
+    def flush(self):
+        """
+        Send the messages the limits allow and flush the client.
+
+        :return: number of messages sent
+        """
+        queue = self.queue
+        if not queue:
+            return 0
+        now = self.clock()
+        throttle = self.throttle
+        if throttle is not None:
+            throttle.refill(now)
+        limits = self.limits
+        messages = []
+        while queue:
+            message, cancelled = queue[0]
+            buckets = self._limits_of(message) if limits else ()
+            for bucket in buckets:
+                bucket.refill(now)
+            if ((throttle is not None and throttle.tokens < 1) or
+                    any(bucket.tokens < 1 for bucket in buckets)):
+                break
+            if throttle is not None:
+                throttle.tokens -= 1
+            for bucket in buckets:
+                bucket.tokens -= 1
+            queue.popleft()
+            messages.append(message)
+            if cancelled is not None:
+                del self.cancels[cancelled]
+        if messages:
+            self.client.send_many(messages, flush=True)
+        return len(messages)
+
+    def next_send_delay(self):
+        """
+        :return: seconds until the next queued message can be sent (0 if it can be sent
+            now), None if there are none
+        """
+        if not self.queue:
+            return None
+        now = self.clock()
+        message = self.queue[0][0]
+        buckets = self._limits_of(message)
+        if self.throttle is not None:
+            buckets.append(self.throttle)
+        delay = 0
+        for bucket in buckets:
+            bucket.refill(now)
+            delay = max(delay, bucket.delay(now))
+        return delay
+
+    def _limits_of(self, message):
+        ":return: list of the buckets of :attr:`limits` `message` is charged against"
+        limits = self.limits
+        name = payload_field(type(message))[1].name
+        if name in limits:
+            return [limits[name]]
+        if name == 'order_cancel_replace':
+            # Merged from a cancel and a create, which it mustn't let exceed their limits
+            return [limits[field] for field in ('order_create', 'order_cancel') if field in limits]
+        return []
+
+    def _throttle_limits_changed(self, message):
+        limits = message.throttle_limits_changed
+        self.logger.info(
+            "throttle limits changed to %d messages/s, bursts of %d, %dms ticks",
+            limits.average_rate_ps, limits.burst_size, limits.tick_ms)
+        now = self.clock()
+        throttle = TokenBucket(limits.average_rate_ps, limits.burst_size, limits.tick_ms / 1000, now)
+        if self.throttle is not None:
+            # Don't assume the exchange's bucket was refilled
+            self.throttle.refill(now)
+            throttle.tokens = min(throttle.burst, self.throttle.tokens)
+        self.throttle = throttle
@@ -3,19 +3,26 @@
 #
 # This module is released under the MIT License:
 # http://www.opensource.org/licenses/mit-license.php
+import errno
 import logging
 import socket
 import ssl
-from collections import namedtuple
+import sys
+import threading
+from collections import deque, namedtuple
+from itertools import islice
 
 from google.protobuf.text_format import MessageToString
 
 from smarkets import private
 from smarkets.errors import reraise
+from smarkets.histogram import Histogram
 from smarkets.lazy import LazyCall
 from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import DIRECTION_IN, DIRECTION_OUT
 from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
-from smarkets.streaming_api.framing import frame_decode_all, frame_encode
+from smarkets.streaming_api.framing import frame_encode, FrameDecoder
+from smarkets.streaming_api.utils import peek_payload
 
 
 class SessionSettings(object):
@@ -24,7 +31,9 @@ class SessionSettings(object):
 
     def __init__(self, username=None, password=None, token=None,
                  host='stream.smarkets.com', port=3801, ssl=True,
-                 socket_timeout=30, ssl_kwargs=None, tcp_nodelay=True):
+                 socket_timeout=30, ssl_kwargs=None, tcp_nodelay=True, lazy_parse=False,
+                 payload_pool_size=0, adaptive_read=False, min_read_chunksize=4096,
+                 max_read_chunksize=1048576):
         self.username = username
         self.password = password
         self.token = token
@@ -34,15 +43,105 @@ class SessionSettings(object):
         self.ssl = ssl
         self.ssl_kwargs = ssl_kwargs or {}
         self.tcp_nodelay = tcp_nodelay
-        # Most message are quite small, so this won't come into
-        # effect. For larger messages, it needs some performance
-        # testing to determine whether a single large recv() system
-        # call is worse than many smaller ones.
+        # Only parse incoming payloads when something needs the parsed message, see `LazyFrame`
+        self.lazy_parse = lazy_parse
+        # Number of incoming payload objects kept for reuse, 0 disables pooling. With pooling
+        # enabled frames have to be released with `Session.release_frame` once consumed
+        # (`StreamingAPIClient` does it after dispatching) and must not be used afterwards.
+        self.payload_pool_size = payload_pool_size
+        # Maximum number of bytes read by a single recv() system call. Smaller reads are
+        # slower (see benchmarks/session.py), larger ones only help with bursts of data.
         self.read_chunksize = 65536  # 64k
+        # Whether to grow and shrink the read size between `min_read_chunksize` and
+        # `max_read_chunksize` based on how many bytes and frames reads return, starting with
+        # `read_chunksize`. See `Session.read_sizes` and `Session.frames_per_read`.
+        self.adaptive_read = adaptive_read
+        self.min_read_chunksize = min_read_chunksize
+        self.max_read_chunksize = max_read_chunksize
 
 
 class Frame(namedtuple('Frame', 'bytes protobuf')):
-    pass
+
+    @property
+    def type(self):
+        return self.protobuf.type
+
+    @property
+    def seq(self):
+        return self.protobuf.eto_payload.seq
+
+    @property
+    def eto_type(self):
+        return self.protobuf.eto_payload.type
+
+
+class LazyFrame(object):
+
+    """
+    Frame of a payload that's only parsed when :attr:`protobuf` is accessed. Payload type, ETO
+    sequence number and ETO payload type are read directly from the serialised payload.
+    """
+
+    __slots__ = ('bytes', 'type', 'seq', 'eto_type', '_protobuf', '_pool')
+
+    def __init__(self, data, type_, seq, eto_type, pool=None):
+        self.bytes = data
+        self.type = type_
+        self.seq = seq
+        self.eto_type = eto_type
+        self._protobuf = None
+        self._pool = pool
+
+    @property
+    def protobuf(self):
+        if self._protobuf is None:
+            payload = seto.Payload() if self._pool is None else self._pool.acquire()
+            payload.ParseFromString(bytes(self.bytes))
+            self._protobuf = payload
+        return self._protobuf
+
+
+class PayloadPool(object):
+
+    """
+    Keeps released :class:`seto.Payload` objects around for reuse. There's no need to clear
+    them, parsing into a payload clears it first.
+    """
+
+    def __init__(self, size):
+        "Keep up to `size` payloads"
+        self.size = size
+        self._free = []
+        # Ids of the payloads in `_free`, so that releasing a payload twice doesn't let two
+        # frames share it
+        self._free_ids = set()
+        # Number of payloads requested and how many of those had to be created
+        self.acquired = 0
+        self.allocated = 0
+
+    def acquire(self):
+        self.acquired += 1
+        if self._free:
+            payload = self._free.pop()
+            self._free_ids.discard(id(payload))
+            return payload
+        self.allocated += 1
+        return seto.Payload()
+
+    def release(self, payload):
+        "Keep `payload` for reuse, unless the pool is full or already has it"
+        if len(self._free) < self.size and id(payload) not in self._free_ids:
+            self._free.append(payload)
+            self._free_ids.add(id(payload))
+
+    @property
+    def allocations_per_payload(self):
+        "Ratio of payloads that had to be allocated instead of reused"
+        return float(self.allocated) / self.acquired if self.acquired else 0.0
+
+
+# ETO payload types `Session._handle_in_payload` acts on
+_PRE_CONSUMED_ETO_TYPES = frozenset((eto.PAYLOAD_LOGIN_RESPONSE, eto.PAYLOAD_HEARTBEAT))
 
 
 class Session(object):
@@ -51,11 +150,19 @@ class Session(object):
     logger = private(logging.getLogger('smarkets.session'))
     flush_logger = private(logging.getLogger('smarkets.session.flush'))
 
-    def __init__(self, settings, inseq=1, outseq=1, account_sequence=None):
+    def __init__(self, settings, inseq=1, outseq=1, account_sequence=None, capture=None,
+                 instrumentation=None):
         """
         :type setting: :class:`SessionSettings`
+        :param capture: records every payload sent and received when given
+        :type capture: :class:`smarkets.streaming_api.capture.CaptureWriter` or None
+        :param instrumentation: records traffic statistics and frame timings when given
+        :type instrumentation: :class:`smarkets.streaming_api.instrumentation.Instrumentation`
+            or None
         """
         self.settings = settings
+        self.capture = capture
+        self.instrumentation = instrumentation
         self.account_sequence = account_sequence
         self.socket = SessionSocket(settings)
         self.inseq = inseq
@@ -66,9 +173,33 @@ class Session(object):
         # Outgoing buffer sequence number
         self.buf_outseq = outseq
         self.out_payload = seto.Payload()
-        self.send_buffer = bytearray()
-        self.read_buffer = bytearray()
-        self.buffered_incoming_payloads = []
+        # Encoded frames waiting to be sent, in chunks of about `_SEND_CHUNK_SIZE` bytes.
+        # Frames are appended to `_send_chunk` which is the last chunk in the queue.
+        self.send_queue = deque()
+        self._send_chunk = None
+        # Held while the output buffer and its sequence numbers change and while flushing,
+        # so that another thread can send and flush (see smarkets.streaming_api.keepalive).
+        # Reentrant as flushing may log in again, which sends.
+        self.send_lock = threading.RLock()
+        # Whether the login response was received since the last login or disconnection
+        self.logged_in = False
+        self.decoder = FrameDecoder()
+        self.buffered_incoming_payloads = deque()
+        self.payload_pool = (
+            PayloadPool(settings.payload_pool_size) if settings.payload_pool_size else None)
+        # Read size of adaptive reads, see `read_chunksize`
+        self._read_chunksize = settings.read_chunksize
+        # Bytes received and complete frames decoded by each read
+        self.read_sizes = Histogram()
+        self.frames_per_read = Histogram()
+        # Moving average of the bytes received per read, in adaptive read mode
+        self._average_read_size = settings.read_chunksize
+        if instrumentation is not None:
+            # Number of frames left, receive time and decode time of the reads buffered
+            self._read_times = deque()
+            # Receive, decode, take and ready times of the last frame returned by next_frame
+            self.frame_times = None
+            self.next_frame = self._timed_next_frame
 
     @property
     def raw_socket(self):
@@ -78,9 +209,19 @@ class Session(object):
         '''
         return self.socket._sock
 
+    @property
+    def read_chunksize(self):
+        """
+        Bytes requested by each read: `SessionSettings.read_chunksize`, or the size adapted to
+        recent reads when `SessionSettings.adaptive_read` is set
+        """
+        if self.settings.adaptive_read:
+            return self._read_chunksize
+        return self.settings.read_chunksize
+
     @property
     def output_buffer_size(self):
-        return len(self.send_buffer)
+        return sum(len(chunk) for chunk in self.send_queue)
 
     @property
     def connected(self):
@@ -90,6 +231,12 @@ class Session(object):
     def connect(self):
         "Connects to the API and logs in if not already connected"
         if self.socket.connect():
+            self._login()
+
+    def _login(self):
+        "Send the login payload, starting a new outgoing sequence"
+        with self.send_lock:
+            self.logged_in = False
             self._clear_send_buffer()
             # Reset separate outgoing buffer sequence number
             self.buf_outseq = 1
@@ -113,12 +260,14 @@ class Session(object):
             self.flush()
 
     def _clear_send_buffer(self):
-        if self.send_buffer:
-            self.logger.warn(
-                'Clearing non-empty buffer, %d bytes will be lost: %r',
-                len(self.send_buffer), self.send_buffer,
-            )
-        self.send_buffer = bytearray()
+        with self.send_lock:
+            if self.send_queue:
+                self.logger.warn(
+                    'Clearing non-empty buffer, %d bytes will be lost: %s',
+                    self.output_buffer_size, LazyCall(b''.join, self.send_queue),
+                )
+            self.send_queue = deque()
+            self._send_chunk = None
 
     def logout(self):
         "Disconnects from the API"
@@ -133,34 +282,108 @@ class Session(object):
 
     def disconnect(self):
         "Disconnects from the API"
-        self.socket.disconnect()
+        with self.send_lock:
+            self.socket.disconnect()
+            self.logged_in = False
         self.inseq = self.init_inseq
         self.outseq = self.init_outseq
 
-    def send(self):
-        "Serialise, sequence, add header, and send payload"
+    def send(self, payload=None):
+        """
+        Serialise, sequence, add header, and send payload
+
+        :param payload: payload to send instead of :attr:`out_payload`
+        :type payload: :class:`seto.Payload` or None
+        """
+        if payload is None:
+            payload = self.out_payload
         self.logger.debug(
             "buffering payload: %s",
-            LazyCall(MessageToString, self.out_payload))
-        sent_seq = self.buf_outseq
-        self.out_payload.eto_payload.seq = sent_seq
-        frame_encode(self.send_buffer, self.out_payload.SerializeToString())
-        self.buf_outseq += 1
+            LazyCall(MessageToString, payload))
+        with self.send_lock:
+            sent_seq = self.buf_outseq
+            payload.eto_payload.seq = sent_seq
+            chunk = self._send_chunk
+            if chunk is None or len(chunk) >= _SEND_CHUNK_SIZE:
+                chunk = self._send_chunk = bytearray()
+                self.send_queue.append(chunk)
+            data = payload.SerializeToString()
+            frame_encode(chunk, data)
+            if self.capture is not None:
+                self.capture.write(DIRECTION_OUT, data)
+            self.buf_outseq += 1
 
     def flush(self):
         "Flush payloads to the socket"
-        self.flush_logger.debug("Flushing %d bytes", len(self.send_buffer))
-        if self.send_buffer:
-            bytes_sent = self.socket.send(self.send_buffer)
-            self.flush_logger.debug("Flushed %d bytes out of %d", bytes_sent, len(self.send_buffer))
-            self.send_buffer[0:] = self.send_buffer[bytes_sent:]
+        with self.send_lock:
+            queue = self.send_queue
+            self.flush_logger.debug("Flushing %d bytes", self.output_buffer_size)
+            if queue:
+                bytes_sent = self.socket.send_segments(queue)
+                self.flush_logger.debug("Flushed %d bytes", bytes_sent)
+                if self.instrumentation is not None:
+                    self.instrumentation.record_sent(bytes_sent)
+                # Chunks handed to the socket may be viewed below and can't grow anymore
+                self._send_chunk = None
+                while bytes_sent:
+                    chunk_size = len(queue[0])
+                    if chunk_size > bytes_sent:
+                        # Keep a view of what's left instead of shifting the unsent bytes
+                        queue[0] = memoryview(queue[0])[bytes_sent:]
+                        break
+                    queue.popleft()
+                    bytes_sent -= chunk_size
 
     def read(self):
-        self.read_buffer += self.socket.recv()
-
-        messages, remaining_buffer = frame_decode_all(self.read_buffer)
-        self.buffered_incoming_payloads.extend(messages)
-        self.read_buffer = remaining_buffer
+        "Receive data straight into the decoder's buffer and decode it"
+        decoder = self.decoder
+        received = self.socket.recv_into(decoder.writable(self.read_chunksize))
+        if not received:
+            return
+        received_at = self.instrumentation.clock() if self.instrumentation is not None else None
+        decoder.commit(received)
+        payloads = decoder.decode()
+        self._buffer_payloads(payloads, received, received_at)
+        if self.settings.adaptive_read:
+            self._adapt_read_chunksize(received, len(payloads))
+
+    def _buffer_payloads(self, payloads, received, received_at=None):
+        """
+        Queue payloads decoded from `received` bytes for :meth:`next_frame`. `received_at` is
+        the instrumentation clock time the bytes were received, now if None.
+        """
+        self.buffered_incoming_payloads.extend(payloads)
+        self.read_sizes.record(received)
+        self.frames_per_read.record(len(payloads))
+        if self.capture is not None:
+            self.capture.write_many(DIRECTION_IN, payloads)
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            instrumentation.record_read(received, len(payloads))
+            if payloads:
+                decoded = instrumentation.clock()
+                self._read_times.append(
+                    [len(payloads), decoded if received_at is None else received_at, decoded])
+
+    def _adapt_read_chunksize(self, received, frames):
+        """
+        Double the read size when a read fills it (more data is probably waiting) or doesn't
+        complete any frame, halve it when reads are on average much smaller than it.
+        """
+        settings = self.settings
+        size = self.read_chunksize
+        self._average_read_size += (received - self._average_read_size) / 8.0
+        if received == size or not frames:
+            size = min(2 * size, settings.max_read_chunksize)
+            self._average_read_size = size
+        elif self._average_read_size < size / 4:
+            size = max(size // 2, settings.min_read_chunksize)
+            self._average_read_size = size / 2
+        else:
+            return
+        if size != self.read_chunksize:
+            self.logger.debug("changing read size from %d to %d", self.read_chunksize, size)
+            self._read_chunksize = size
 
     def next_frame(self):
         """Get the next payload and increment inseq.
@@ -176,33 +399,93 @@ class Session(object):
         if not self.buffered_incoming_payloads:
             return None
 
-        data, self.buffered_incoming_payloads = (
-            self.buffered_incoming_payloads[0], self.buffered_incoming_payloads[1:])
+        data = self.buffered_incoming_payloads.popleft()
 
-        payload = seto.Payload()
-        payload.ParseFromString(bytes(data))
-        self._handle_in_payload(payload)
-        frame = Frame(bytes=data, protobuf=payload)
-        if payload.eto_payload.seq == self.inseq:
+        pool = self.payload_pool
+        if self.settings.lazy_parse:
+            seto_type, seq, eto_type = peek_payload(data)
+            frame = LazyFrame(data, seto_type, seq, eto_type, pool)
+            if eto_type in _PRE_CONSUMED_ETO_TYPES:
+                self._handle_in_payload(frame.protobuf)
+        else:
+            payload = seto.Payload() if pool is None else pool.acquire()
+            payload.ParseFromString(bytes(data))
+            self._handle_in_payload(payload)
+            frame = Frame(bytes=data, protobuf=payload)
+        if frame.seq == self.inseq:
             # Go ahead
             self.logger.debug("received sequence %d", self.inseq)
             self.inseq += 1
             return frame
-        elif payload.eto_payload.seq > self.inseq:
-            self.logger.warn(
-                'Received incoming sequence %d instead of expected %d',
-                payload.eto_payload.seq, self.inseq)
+        elif frame.seq > self.inseq:
+            self._out_of_sequence(frame)
+            self.release_frame(frame)
             return None
         else:
+            self.release_frame(frame)
+            return None
+
+    def _out_of_sequence(self, frame):
+        "Called with frames received ahead of the expected sequence number, which are dropped"
+        self.logger.warn(
+            'Received incoming sequence %d instead of expected %d',
+            frame.seq, self.inseq)
+
+    def _timed_next_frame(self):
+        ":meth:`next_frame` setting :attr:`frame_times`, used with instrumentation"
+        if not self.buffered_incoming_payloads:
             return None
+        clock = self.instrumentation.clock
+        taken = clock()
+        read_times = self._read_times
+        if read_times:
+            read = read_times[0]
+            read[0] -= 1
+            if not read[0]:
+                read_times.popleft()
+            received, decoded = read[1], read[2]
+        else:
+            # Payloads buffered by other means than reading
+            received = decoded = taken
+        frame = type(self).next_frame(self)
+        self.frame_times = (received, decoded, taken, clock())
+        return frame
+
+    def release_frame(self, frame):
+        """Let the session reuse the frame's payload object if payload pooling is enabled.
+
+        The frame must not be used after it has been released.
+        """
+        pool = self.payload_pool
+        if pool is not None:
+            payload = frame._protobuf if isinstance(frame, LazyFrame) else frame.protobuf
+            if payload is not None:
+                pool.release(payload)
+
+    def next_frames(self, limit=sys.maxsize):
+        """Get up to `limit` next payloads, skipping the ones dropped by :meth:`next_frame`.
+
+        :return: Frames in the order they were received, empty if no payloads in buffer.
+        :rtype: list of :class:`smarkets.streaming_api.session.Frame`
+        """
+        frames = []
+        buffered_incoming_payloads = self.buffered_incoming_payloads
+        while buffered_incoming_payloads and len(frames) < limit:
+            frame = self.next_frame()
+            if frame is not None:
+                frames.append(frame)
+
+        return frames
 
     def _handle_in_payload(self, msg):
         "Pre-consume the login response message"
         self.logger.debug("received message to dispatch: %s", LazyCall(MessageToString, msg))
         if msg.eto_payload.type == eto.PAYLOAD_LOGIN_RESPONSE:
             self.session = msg.eto_payload.login_response.session
-            self.buf_outseq = msg.eto_payload.login_response.reset
-            self._clear_send_buffer()
+            with self.send_lock:
+                self.buf_outseq = msg.eto_payload.login_response.reset
+                self._clear_send_buffer()
+                self.logged_in = True
             self.logger.info("received login_response with session %r and outseq %d",
                              self.session, self.buf_outseq)
         elif msg.eto_payload.type == eto.PAYLOAD_HEARTBEAT:
@@ -215,6 +498,20 @@ class Session(object):
         return msg
 
 
+# Lowest limit of the number of buffers a single sendmsg() call accepts across platforms we care about
+_IOV_MAX = 1024
+# Outgoing frames are batched in chunks of this size, so a large backlog is sent with a handful of
+# buffers while a partially sent chunk never needs to be copied.
+_SEND_CHUNK_SIZE = 65536
+
+
+def _would_block(exc):
+    "Whether `exc` was raised because a non-blocking socket isn't ready"
+    if isinstance(exc, ssl.SSLError):
+        return exc.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+    return exc.args and exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
 class SessionSocket(object):
 
     "Wraps a socket with basic framing/deframing"
@@ -293,9 +590,38 @@ class SessionSocket(object):
         except socket.error as e:
             reraise(ConnectionError("Error while writing to socket", e))
 
+    def send_segments(self, segments):
+        """
+        Send a sequence of buffers with a single system call. Uses scatter-gather IO
+        (:meth:`socket.socket.sendmsg`) where available, SSL sockets don't support it so the
+        segments are joined for them.
+
+        :type segments: iterable of bytes-like objects
+        :return: Number of sent bytes
+        :rtype: int
+        """
+        if self._sock is None:
+            raise SocketDisconnected('Trying to write to socket when disconnected')
+        sendmsg = getattr(self._sock, 'sendmsg', None)
+        try:
+            self.wire_logger.debug("sending segments: %s", LazyCall(b''.join, segments))
+            if sendmsg is None or isinstance(self._sock, ssl.SSLSocket):
+                sent = self._sock.send(b''.join(segments))
+            else:
+                sent = sendmsg(islice(segments, _IOV_MAX))
+        except socket.error as e:
+            if _would_block(e):
+                return 0
+            reraise(ConnectionError("Error while writing to socket", e))
+        if sent == 0:
+            raise SocketDisconnected('Socket disconnected when writing to it, 0 bytes written')
+        return sent
+
     def recv(self):
         """Read stuff from underlying socket.
 
+        Non-blocking sockets with nothing to read return an empty byte string.
+
         :rtype: byte string
         """
         if self._sock is None:
@@ -304,14 +630,43 @@ class SessionSocket(object):
 
         try:
             inbytes = self._sock.recv(self.settings.read_chunksize)
-            if not inbytes:
-                message = "Socket disconnected while receiving, got %r" % (inbytes,)
-                self.logger.info(message)
-                raise SocketDisconnected(message)
-            self.wire_logger.debug('Received %d bytes: %r', len(inbytes), inbytes)
-            return inbytes
         except socket.error as e:
+            if _would_block(e):
+                return b''
+            reraise(ConnectionError('Error while reading from socket', e))
+        if not inbytes:
+            message = "Socket disconnected while receiving, got %r" % (inbytes,)
+            self.logger.info(message)
+            raise SocketDisconnected(message)
+        self.wire_logger.debug('Received %d bytes: %r', len(inbytes), inbytes)
+        return inbytes
+
+    def recv_into(self, buffer_):
+        """Read stuff from underlying socket into `buffer_`.
+
+        Non-blocking sockets with nothing to read return 0.
+
+        :type buffer_: writable bytes-like object, e.g. :class:`memoryview`
+        :return: Number of bytes read
+        :rtype: int
+        """
+        if self._sock is None:
+            raise SocketDisconnected(
+                'Trying to read from a socket when disconnected')
+
+        try:
+            received = self._sock.recv_into(buffer_)
+        except socket.error as e:
+            if _would_block(e):
+                return 0
             reraise(ConnectionError('Error while reading from socket', e))
+        if not received:
+            message = "Socket disconnected while receiving, got 0 bytes"
+            self.logger.info(message)
+            raise SocketDisconnected(message)
+        if self.wire_logger.isEnabledFor(logging.DEBUG):
+            self.wire_logger.debug('Received %d bytes: %r', received, buffer_[:received].tobytes())
+        return received
 
     def _error_message(self, exception):
         "Stringify a socket exception"
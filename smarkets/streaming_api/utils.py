@@ -1,13 +1,198 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from smarkets.streaming_api import seto
-from smarkets.string import camel_case_to_underscores
+from six import string_types
 
-__all__ = ('set_payload_message',)
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.exceptions import ParseError
+from smarkets.streaming_api.framing import IncompleteULEB128, uleb128_decode
+
+__all__ = ('payload_field', 'payload_message', 'peek_payload', 'set_payload_message', 'wrap')
+
+
+def _payload_fields():
+    """
+    Payload type and :class:`seto.Payload` field descriptor of every message class a payload
+    can contain, from the payload's descriptor: the field of the messages of type
+    ``PAYLOAD_ORDER_CREATE`` is ``order_create``...
+    """
+    payload = seto.Payload()
+    payload_types = seto.Payload.DESCRIPTOR.fields_by_name['type'].enum_type.values_by_name
+    fields = {}
+    for field in seto.Payload.DESCRIPTOR.fields:
+        payload_type = payload_types.get('PAYLOAD_' + field.name.upper())
+        if field.message_type is not None and payload_type is not None:
+            # The class used by the protobuf runtime, whatever the implementation
+            fields[type(getattr(payload, field.name))] = (payload_type.number, field)
+    return fields
+
+
+_PAYLOAD_FIELDS = _payload_fields()
+_PAYLOAD_FIELDS_BY_NAME = dict(
+    (field.name, (payload_type, field)) for payload_type, field in _PAYLOAD_FIELDS.values())
+
+
+def payload_field(message_class):
+    """
+    :return: payload type and descriptor of the :class:`seto.Payload` field of the messages
+        of `message_class`, ``(seto.PAYLOAD_ORDER_CREATE, <order_create field descriptor>)``
+        for example
+    :raises TypeError: if payloads can't contain messages of `message_class`
+    """
+    try:
+        return _PAYLOAD_FIELDS[message_class]
+    except KeyError:
+        raise TypeError('%s messages are not seto payloads' % (message_class.__name__,))
 
 
 def set_payload_message(payload, message):
-    underscore_form = camel_case_to_underscores(type(message).__name__)
-    payload_type = getattr(seto, 'PAYLOAD_' + underscore_form.upper())
+    "Set the type of `payload` and copy `message` in it"
+    payload_type, field = payload_field(type(message))
+    payload.type = payload_type
+    getattr(payload, field.name).CopyFrom(message)
+
+
+def wrap(message, payload=None):
+    """
+    :return: a payload containing a copy of `message`, `payload` (cleared first) if given
+    :rtype: :class:`seto.Payload`
+    """
+    payload_type, field = payload_field(type(message))
+    if payload is None:
+        payload = seto.Payload()
+    else:
+        payload.Clear()
+    payload.type = payload_type
+    getattr(payload, field.name).CopyFrom(message)
+    return payload
+
+
+def payload_message(payload, message_class):
+    """
+    Clear `payload` and set it up to contain a message of `message_class`, to build the
+    message in place instead of copying it::
+
+        order = payload_message(session.out_payload, seto.OrderCreate)
+        order.market_id = market_id
+        ...
+
+    :param message_class: message class or name of the payload field (``'order_create'``)
+    :return: the (empty) message of `payload`
+    """
+    if isinstance(message_class, string_types):
+        try:
+            payload_type, field = _PAYLOAD_FIELDS_BY_NAME[message_class]
+        except KeyError:
+            raise ValueError('%r is not a seto payload message' % (message_class,))
+    else:
+        payload_type, field = payload_field(message_class)
+    payload.Clear()
     payload.type = payload_type
-    getattr(payload, underscore_form).CopyFrom(message)
+    message = getattr(payload, field.name)
+    # Messages without any field set wouldn't be serialised otherwise
+    message.SetInParent()
+    return message
+
+
+# Protobuf wire types we can come across in a seto.Payload
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+# Field numbers of seto.Payload.type, seto.Payload.eto_payload and eto.Payload.{seq,type}
+_SETO_TYPE_FIELD = 1
+_SETO_ETO_PAYLOAD_FIELD = 2
+_ETO_SEQ_FIELD = 1
+_ETO_TYPE_FIELD = 2
+
+# Keys (field number and wire type) the fields above are serialised with
+_SETO_TYPE_KEY = _SETO_TYPE_FIELD << 3 | _WIRE_VARINT
+_SETO_ETO_PAYLOAD_KEY = _SETO_ETO_PAYLOAD_FIELD << 3 | _WIRE_LENGTH_DELIMITED
+_ETO_SEQ_KEY = _ETO_SEQ_FIELD << 3 | _WIRE_VARINT
+_ETO_TYPE_KEY = _ETO_TYPE_FIELD << 3 | _WIRE_VARINT
+
+# Values protobuf uses when the fields are not set
+_SETO_TYPE_DEFAULT = seto.PAYLOAD_ETO
+_ETO_TYPE_DEFAULT = eto.PAYLOAD_NONE
+
+
+def peek_payload(data):
+    """Get the type, ETO sequence number and ETO type of a serialised :class:`seto.Payload`
+    without parsing it.
+
+    Fields are serialised in field number order so only the first few bytes of `data`
+    need to be looked at.
+
+    :type data: bytes, bytearray or memoryview
+    :return: payload type, sequence number and ETO payload type
+    :rtype: tuple of 3 ints
+    :raises:
+        :ParseError: when `data` is not a valid protobuf message
+    """
+    try:
+        # Fast path for the layout every serialiser produces:
+        # type key, type, eto_payload key, eto_payload length, seq key, seq[, type key, type]
+        if data[0] == _SETO_TYPE_KEY and data[2] == _SETO_ETO_PAYLOAD_KEY and data[4] == _ETO_SEQ_KEY:
+            seto_type = data[1]
+            eto_size = data[3]
+            if seto_type < 0x80 and eto_size < 0x80:
+                eto_end = 4 + eto_size
+                seq, size = uleb128_decode(data, 5)
+                position = 5 + size
+                if position < eto_end and data[position] == _ETO_TYPE_KEY and data[position + 1] < 0x80:
+                    return seto_type, seq, data[position + 1]
+                elif position == eto_end:
+                    return seto_type, seq, _ETO_TYPE_DEFAULT
+        return _peek_payload(data)
+    except (IndexError, IncompleteULEB128):
+        raise ParseError('Truncated payload')
+
+
+def _peek_payload(data):
+    "Generic version of :func:`peek_payload`"
+    seto_type = _SETO_TYPE_DEFAULT
+    seq = eto_type = None
+    for field, position, value in _iter_fields(data, 0, len(data)):
+        if field == _SETO_TYPE_FIELD:
+            seto_type = value
+        elif field == _SETO_ETO_PAYLOAD_FIELD:
+            eto_type = _ETO_TYPE_DEFAULT
+            for eto_field, _, eto_value in _iter_fields(data, position, position + value):
+                if eto_field == _ETO_SEQ_FIELD:
+                    seq = eto_value
+                elif eto_field == _ETO_TYPE_FIELD:
+                    eto_type = eto_value
+                    break
+            break
+
+    if seq is None:
+        raise ParseError('Payload without ETO sequence number')
+    return seto_type, seq, eto_type
+
+
+def _iter_fields(data, position, end):
+    """Iterate over fields serialised in data[position:end].
+
+    :return: field numbers, offsets of field values and values of varint fields or lengths of
+        length-delimited fields
+    :rtype: iterator of tuples of 3 ints
+    """
+    while position < end:
+        key, size = uleb128_decode(data, position)
+        position += size
+        wire_type = key & 0x07
+        if wire_type == _WIRE_VARINT:
+            value, size = uleb128_decode(data, position)
+            yield key >> 3, position, value
+            position += size
+        elif wire_type == _WIRE_LENGTH_DELIMITED:
+            value, size = uleb128_decode(data, position)
+            position += size
+            yield key >> 3, position, value
+            position += value
+        elif wire_type == _WIRE_FIXED64:
+            position += 8
+        elif wire_type == _WIRE_FIXED32:
+            position += 4
+        else:
+            raise ParseError('Unsupported wire type %d' % (wire_type,))
@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from nose.tools import eq_
+
+from smarkets.histogram import Histogram
+
+
+def test_empty_histogram():
+    histogram = Histogram()
+    eq_((histogram.count, histogram.mean, histogram.percentile(99)), (0, None, None))
+    eq_(histogram.buckets(), [])
+
+
+def test_percentiles():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value)
+
+    eq_([histogram.percentile(percent) for percent in (0, 10, 50, 90, 99.9, 100)],
+        [1, 127, 511, 1000, 1000, 1000])
+    eq_(histogram.mean, 500.5)
+
+
+def test_reset():
+    histogram = Histogram()
+    histogram.record(2 ** 70)
+    eq_(histogram.buckets(), [(2 ** 71 - 1, 1)])
+
+    histogram.reset()
+    eq_((histogram.count, histogram.total, histogram.min, histogram.max), (0, 0, None, None))
+
+
+def test_significant_bits():
+    histogram = Histogram(significant_bits=2)
+    for value in (0, 5, 7, 8, 9, 10, 1000):
+        histogram.record(value)
+
+    # Exact up to 7, then 4 buckets per power of two
+    eq_(histogram.buckets(), [(0, 1), (5, 1), (7, 1), (9, 2), (11, 1), (1023, 1)])
+    eq_(histogram.percentile(50), 9)
+
+
+def test_summary():
+    histogram = Histogram()
+    for value in range(1, 101):
+        histogram.record(value)
+
+    eq_(histogram.summary(percentiles=(50, 99.9)),
+        [('count', 100), ('min', 1), ('mean', 50.5), ('max', 100), ('p50', 63), ('p99_9', 100)])
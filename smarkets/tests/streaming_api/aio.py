@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+
+import sys
+import unittest
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+if sys.version_info < (3, 5):
+    raise SkipTest('asyncio support requires Python 3.5+')
+
+import asyncio  # noqa
+
+from smarkets.streaming_api import eto, seto  # noqa
+from smarkets.streaming_api.aio import AsyncKeepalive, AsyncSession, AsyncStreamingAPIClient  # noqa
+from smarkets.streaming_api.framing import frame_encode, FrameDecoder  # noqa
+from smarkets.streaming_api.session import SessionSettings  # noqa
+
+
+class FakeServerProtocol(asyncio.Protocol):
+
+    "Answers logins and pings"
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.decoder = FrameDecoder()
+        self.outseq = 1
+        self.received = []
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for raw in self.decoder.decode():
+            payload = seto.Payload.FromString(bytes(raw))
+            self.received.append(payload)
+            if payload.type == seto.PAYLOAD_LOGIN:
+                self.reply(eto.PAYLOAD_LOGIN_RESPONSE)
+            elif payload.eto_payload.type == eto.PAYLOAD_PING:
+                self.reply(eto.PAYLOAD_PONG)
+
+    def reply(self, eto_type):
+        payload = seto.Payload()
+        payload.type = seto.PAYLOAD_ETO
+        payload.eto_payload.seq = self.outseq
+        payload.eto_payload.type = eto_type
+        if eto_type == eto.PAYLOAD_LOGIN_RESPONSE:
+            payload.eto_payload.login_response.session = 'session'
+            payload.eto_payload.login_response.reset = 2
+        self.outseq += 1
+        frame = bytearray()
+        frame_encode(frame, payload.SerializeToString())
+        self.transport.write(bytes(frame))
+
+
+class AsyncStreamingAPIClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server_protocols = []
+
+        def protocol_factory():
+            protocol = FakeServerProtocol()
+            self.server_protocols.append(protocol)
+            return protocol
+
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(protocol_factory, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def create_client(self):
+        settings = SessionSettings('username', 'password', host='127.0.0.1', port=self.port, ssl=False,
+                                   socket_timeout=5)
+        return AsyncStreamingAPIClient(AsyncSession(settings, loop=self.loop))
+
+    def test_login(self):
+        client = self.create_client()
+        self.loop.run_until_complete(client.login())
+        self.assertTrue(client.check_login())
+        eq_(client.session.inseq, 2)
+        eq_(client.session.buf_outseq, 2)
+        eq_(self.server_protocols[0].received[0].login.username, 'username')
+
+    def test_many_sessions_share_a_loop(self):
+        clients = [self.create_client() for _ in range(5)]
+        self.loop.run_until_complete(asyncio.gather(*(client.login() for client in clients)))
+        for client in clients:
+            self.assertTrue(client.check_login())
+        eq_(len(self.server_protocols), 5)
+
+    def test_iterating_dispatches_frames(self):
+        client = self.create_client()
+        pongs = []
+        client.add_handler('eto.pong', lambda message: pongs.append(message))
+        self.loop.run_until_complete(client.login())
+        self.loop.run_until_complete(client.ping())
+        self.loop.run_until_complete(client.flush())
+
+        frame = self.loop.run_until_complete(client.__anext__())
+        eq_(frame.protobuf.eto_payload.type, eto.PAYLOAD_PONG)
+        eq_(len(pongs), 1)
+
+    def test_iteration_stops_when_connection_is_closed(self):
+        client = self.create_client()
+        self.loop.run_until_complete(client.login())
+        self.server_protocols[0].transport.close()
+        self.assertRaises(StopAsyncIteration, self.loop.run_until_complete, client.__anext__())
+        self.assertFalse(client.session.connected)
+
+    def test_keepalive_pings_and_flushes(self):
+        client = self.create_client()
+        self.loop.run_until_complete(client.login())
+        keepalive = AsyncKeepalive(client, max_flush_delay=0.01)
+        keepalive.start()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        eq_(self.server_protocols[0].received[-1].eto_payload.type, eto.PAYLOAD_PING)
+
+        self.loop.run_until_complete(client.__anext__())
+        eq_(keepalive.latency.count, 1)
+        keepalive.stop()
+        eq_(len(client.callbacks['eto.pong']), 0)
@@ -0,0 +1,181 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import mmap
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from functools import partial
+from itertools import islice
+
+import six
+from mock import patch
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, raises
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import (
+    CaptureReader, CaptureWriter, DIRECTION_IN, DIRECTION_OUT, MappedCaptureReader,
+)
+from smarkets.streaming_api.exceptions import ParseError
+from smarkets.streaming_api.framing import frame_encode
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+def _records(capture_file):
+    return [(record.direction, record.timestamp, record.payload.tobytes())
+            for record in CaptureReader(capture_file)]
+
+
+def test_records_round_trip():
+    capture_file = io.BytesIO()
+    writer = CaptureWriter(capture_file, clock=partial(next, iter([10, 20, 30])))
+    writer.write(DIRECTION_OUT, b'login')
+    writer.write_many(DIRECTION_IN, [b'', b'x' * 300])
+    writer.write(DIRECTION_IN, b'late', timestamp=100)
+    writer.flush()
+
+    eq_(_records(capture_file), [
+        (DIRECTION_OUT, 20, b'login'),
+        (DIRECTION_IN, 30, b''),
+        (DIRECTION_IN, 30, b'x' * 300),
+        (DIRECTION_IN, 100, b'late'),
+    ])
+
+
+def test_appending_to_a_capture_file():
+    capture_file = io.BytesIO()
+    for payload in (b'first', b'second'):
+        writer = CaptureWriter(capture_file)
+        writer.write(DIRECTION_IN, payload)
+        writer.flush()
+
+    eq_([payload for _, _, payload in _records(capture_file)], [b'first', b'second'])
+
+
+def test_wall_clock():
+    capture_file = io.BytesIO()
+    CaptureWriter(capture_file, clock=lambda: 5 * 10 ** 9).flush()
+    reader = CaptureReader(capture_file)
+    eq_(reader.wall_clock(reader.start_monotonic + 1500000000),
+        reader.start_wall_clock / 1e9 + 1.5)
+
+
+@raises(ParseError)
+def test_reading_something_else():
+    CaptureReader(io.BytesIO(b'\x03abc' * 10))
+
+
+@raises(ParseError)
+def test_reading_a_truncated_capture():
+    capture_file = io.BytesIO()
+    writer = CaptureWriter(capture_file)
+    writer.write(DIRECTION_IN, b'payload')
+    writer.flush()
+    capture_file.truncate(len(capture_file.getvalue()) - 1)
+    list(CaptureReader(capture_file))
+
+
+def _payload(seq, eto_type):
+    payload = seto.Payload(type=seto.PAYLOAD_ETO)
+    payload.eto_payload.seq = seq
+    payload.eto_payload.type = eto_type
+    return payload.SerializeToString()
+
+
+def test_session_captures_sent_and_received_payloads():
+    capture_file = io.BytesIO()
+    session = Session(SessionSettings('username', 'password'), capture=CaptureWriter(capture_file))
+    session.socket._sock, server = socket.socketpair()
+    try:
+        session.out_payload.CopyFrom(seto.Payload.FromString(_payload(1, eto.PAYLOAD_PING)))
+        session.send()
+        stream = bytearray()
+        frame_encode(stream, _payload(1, eto.PAYLOAD_PONG))
+        server.sendall(bytes(stream))
+        session.read()
+    finally:
+        session.socket._sock.close()
+        server.close()
+    session.capture.flush()
+
+    eq_([(direction, seto.Payload.FromString(payload).eto_payload.type)
+         for direction, _, payload in _records(capture_file)],
+        [(DIRECTION_OUT, eto.PAYLOAD_PING), (DIRECTION_IN, eto.PAYLOAD_PONG)])
+
+
+class MappedCaptureReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if six.PY2:
+            raise SkipTest('memory-mapped capture reading requires Python 3')
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.cap')
+        # Two incoming pongs per millisecond, each read followed by a ping
+        self.write_records(range(1, 1001))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_records(self, seqs):
+        with CaptureWriter(self.path, clock=lambda: 0) as writer:
+            for seq in seqs:
+                timestamp = (seq + 1) // 2 * 10 ** 6
+                writer.write(DIRECTION_IN, _payload(seq, eto.PAYLOAD_PONG), timestamp)
+                if not seq % 2:
+                    writer.write(DIRECTION_OUT, _payload(seq // 2, eto.PAYLOAD_PING), timestamp)
+
+    def reader(self):
+        return MappedCaptureReader(self.path, index_interval=1024)
+
+    def test_iterates_records_without_copying(self):
+        with self.reader() as reader:
+            records = list(reader)
+            eq_(len(records), 1500)
+            eq_(_records(self.path), [(r.direction, r.timestamp, r.payload.tobytes()) for r in records])
+            assert isinstance(records[0].payload.obj, mmap.mmap)
+
+    def test_builds_a_sparse_index(self):
+        with self.reader() as reader:
+            index = reader.index
+            assert os.path.exists(self.path + '.idx')
+            assert 10 < len(index) < 100
+            eq_([seto.Payload.FromString(next(reader.records(entry.offset)).payload).eto_payload.seq
+                 for entry in index], [entry.seq for entry in index])
+
+        with patch.object(MappedCaptureReader, '_extend_index') as extend_index:
+            eq_(self.reader().index, index)
+        self.assertFalse(extend_index.called)
+
+    def test_extends_the_index_of_grown_captures(self):
+        index = self.reader().index
+        self.write_records(range(1001, 2001))
+        new_index = self.reader().index
+        eq_(new_index[:len(index)], index)
+        assert new_index[-1].seq > 1900
+
+    def test_seeks_to_time_and_sequence(self):
+        with self.reader() as reader:
+            seqs = [seto.Payload.FromString(record.payload).eto_payload.seq
+                    for record in reader.window(reader.wall_clock(99.5 * 10 ** 6),
+                                                reader.wall_clock(102.5 * 10 ** 6))]
+            eq_(seqs, [199, 200, 201, 202, 203, 204])
+
+            offset = reader.seek_seq(700)
+            assert offset > reader.seek_seq(300) > reader.seek_seq(1)
+            eq_(700 in [seto.Payload.FromString(record.payload).eto_payload.seq
+                        for record in islice(reader.records(offset), 200)], True)
+
+    def test_reading_empty_or_truncated_files(self):
+        for data in (b'', b'SMKCAP'):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertRaises(ParseError, self.reader)
+
+    def test_ignores_incomplete_last_record(self):
+        with open(self.path, 'ab') as f:
+            f.write(b'\x40\x00')
+        with self.reader() as reader:
+            eq_(len(list(reader)), 1500)
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 import unittest
-from collections import namedtuple
+from collections import deque
 from itertools import chain, product
 
 import six
@@ -12,8 +12,11 @@ from six.moves import xrange
 
 from smarkets import uuid
 from smarkets.streaming_api.api import eto, InvalidCallbackError, seto, StreamingAPIClient
+from smarkets.streaming_api.client import READ_MODE_DISPATCH_FROM_BUFFER
+from smarkets.streaming_api.instrumentation import Instrumentation
 from smarkets.streaming_api.exceptions import LoginError, LoginTimeout
 from smarkets.streaming_api.framing import frame_decode_all
+from smarkets.streaming_api.session import Frame, LazyFrame, Session, SessionSettings
 
 SUCCESSFUL_LOGIN_RESPONSE_RAW = bytearray(
     b'@\x08\x01\x12<\x08\x01\x10\x08\x18\x0024\n\x129RK4DpIK9HY5FpZKTo\x10\x02\x1a\x13hanson'
@@ -28,11 +31,17 @@ LOGOUT_HEARTBEAT_TIMEOUT_RAW = bytearray(
     b'\x0e\x08\x01\x12\n\x08\x08\x10\t\x18\x00:\x02\x08\x02')
 
 
-class Frame(namedtuple('Frame', 'bytes protobuf')):
-    pass
+def buffer_frames(session, frames):
+    "Make the (mock) `session` hand out `frames` as if they were buffered"
+    buffered = session.buffered_incoming_payloads = deque(frames)
 
+    def next_frame():
+        # None stands for a frame dropped by the session
+        return buffered.popleft() if buffered else None
+    session.next_frame.side_effect = next_frame
 
-def read_session_buff_gen(raw_response):
+
+def read_session_buff_gen(session, raw_response):
     buffers = []
     if raw_response:
         decoded_response, dummy = frame_decode_all(raw_response)
@@ -40,18 +49,7 @@ def read_session_buff_gen(raw_response):
             payload = seto.Payload()
             payload.ParseFromString(bytes(data))
             buffers.extend([Frame(bytes=data, protobuf=payload)])
-
-    class indexer(object):
-        index = 0
-
-    def ret_buff():
-        if indexer.index < len(buffers):
-            val = buffers[indexer.index]
-            indexer.index += 1
-            return val
-        return None
-
-    return ret_buff
+    buffer_frames(session, buffers)
 
 
 class Handler(object):
@@ -70,6 +68,7 @@ class SmarketsTestCase(unittest.TestCase):
         self.session_patcher = patch('smarkets.streaming_api.session.Session')
         self.mock_session_cls = self.session_patcher.start()
         self.mock_session = self.mock_session_cls.return_value
+        self.mock_session.instrumentation = None
         self.client = StreamingAPIClient(self.mock_session)
 
     def tearDown(self):
@@ -81,14 +80,15 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_ok(self):
         "Test the `Smarkets.login` method"
-        self.client.session.next_frame = read_session_buff_gen(SUCCESSFUL_LOGIN_RESPONSE_RAW)
+        read_session_buff_gen(self.client.session, SUCCESSFUL_LOGIN_RESPONSE_RAW)
         self.client.login()
         self.assertTrue(self.client.check_login())
 
     def test_login_ok_async(self):
         "Test the `Smarkets.login` method"
         self.client.login(False)
-        self.client.session.next_frame = read_session_buff_gen(
+        read_session_buff_gen(
+            self.client.session,
             SUCCESSFUL_LOGIN_RESPONSE_RAW +
             PAYLOAD_THROTTLE_LIMITS_RAW +
             PAYLOAD_THROTTLE_LIMITS_RAW)
@@ -97,7 +97,7 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_unauthorized(self):
         "Test the `Smarkets.login` method for unauthorized"
-        self.client.session.next_frame = read_session_buff_gen(UNAUTHORIZED_LOGIN_RESPONSE_RAW)
+        read_session_buff_gen(self.client.session, UNAUTHORIZED_LOGIN_RESPONSE_RAW)
         try:
             self.client.login()
         except LoginError as ex:
@@ -110,7 +110,8 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_ok_then_timeout(self):
         "Test the `Smarkets.login` method for a sequence of messages"
-        self.client.session.next_frame = read_session_buff_gen(
+        read_session_buff_gen(
+            self.client.session,
             SUCCESSFUL_LOGIN_RESPONSE_RAW +
             PAYLOAD_THROTTLE_LIMITS_RAW +
             LOGOUT_HEARTBEAT_TIMEOUT_RAW)
@@ -126,7 +127,7 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_noresponse(self):
         "Test the `Smarkets.login` when no login response has been received"
-        self.client.session.next_frame = read_session_buff_gen('')
+        read_session_buff_gen(self.client.session, '')
 
         try:
             self.client.login()
@@ -155,6 +156,122 @@ class SmarketsTestCase(unittest.TestCase):
         client_b.callbacks['seto.order_accepted'](message='also irrelevant')
         eq_(handler.call_count, 1)
 
+    def test_lazy_frames_are_only_parsed_when_handled(self):
+        frames = []
+        for seq, eto_type in ((1, eto.PAYLOAD_PONG), (2, eto.PAYLOAD_HEARTBEAT)):
+            payload = seto.Payload(type=seto.PAYLOAD_ETO)
+            payload.eto_payload.seq = seq
+            payload.eto_payload.type = eto_type
+            frames.append(LazyFrame(payload.SerializeToString(), seto.PAYLOAD_ETO, seq, eto_type))
+
+        handler = Handler()
+        self.client.add_handler('eto.pong', handler)
+        for frame in frames:
+            self.client._dispatch(frame)
+
+        eq_(handler.call_count, 1)
+        self.assertIsNotNone(frames[0]._protobuf)
+        self.assertIsNone(frames[1]._protobuf)
+
+    def test_dispatch_with_and_without_debug_logging(self):
+        payload = seto.Payload(type=seto.PAYLOAD_ETO)
+        payload.eto_payload.seq = 1
+        payload.eto_payload.type = eto.PAYLOAD_PONG
+        frame = Frame(bytes=payload.SerializeToString(), protobuf=payload)
+
+        handler, global_handler = Handler(), Handler()
+        self.client.add_global_handler(global_handler)
+        self.client.add_handler('eto.pong', handler)
+        for debug in (False, True):
+            with patch.object(self.client.logger, 'isEnabledFor', return_value=debug):
+                with patch.object(self.client.logger, 'debug') as debug_log:
+                    self.client._dispatch(frame)
+            eq_(debug_log.called, debug)
+
+        eq_((handler.call_count, global_handler.call_count), (2, 2))
+
+    def test_dispatch_unknown_payload_types(self):
+        names = []
+        self.client.add_global_handler(lambda name, message: names.append(name))
+        for seto_type, eto_type in ((seto.PAYLOAD_ETO, 1000), (1000, eto.PAYLOAD_NONE)):
+            frame = LazyFrame(b'', seto_type, 1, eto_type)
+            self.client._dispatch(frame)
+            self.assertIsNone(frame._protobuf)
+
+        eq_(names, [None, 'seto.unknown'])
+
+    @staticmethod
+    def _contract_quotes_frames(*contracts):
+        "Frames of contract quotes for each given (market, contract, price) triple"
+        frames = []
+        for seq, (market_id, contract_id, price) in enumerate(contracts, 1):
+            payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+            payload.eto_payload.seq = seq
+            payload.eto_payload.type = eto.PAYLOAD_NONE
+            payload.contract_quotes.market_id = market_id
+            payload.contract_quotes.contract_id = contract_id
+            payload.contract_quotes.bids.add(price=price, quantity=10000)
+            frames.append(Frame(bytes=payload.SerializeToString(), protobuf=payload))
+        return frames
+
+    def _read_frames(self, frames):
+        buffer_frames(self.client.session, frames)
+        return self.client.read()
+
+    def test_batch_handler_receives_messages_of_a_read(self):
+        batches, handler = [], Handler()
+        self.client.add_batch_handler('seto.contract_quotes', lambda messages: batches.append(messages))
+        self.client.add_handler('seto.contract_quotes', handler)
+        frames = self._contract_quotes_frames((1, 2, 10), (1, 3, 20), (1, 2, 30))
+
+        eq_(self._read_frames(frames), 3)
+        eq_(batches, [[frame.protobuf for frame in frames]])
+        eq_(handler.call_count, 3)
+
+        self._read_frames([])
+        eq_(len(batches), 1)
+
+    def test_batched_frames_are_released_after_delivery(self):
+        self.client.add_batch_handler(
+            'seto.contract_quotes', lambda messages: self.mock_session.delivered(len(messages)))
+        frames = self._contract_quotes_frames((1, 2, 10), (1, 3, 20))
+        self._read_frames(frames)
+
+        calls = [call for call in self.mock_session.method_calls if call[0] not in ('read', 'next_frame')]
+        eq_(calls[0], ('delivered', (2,), {}))
+        eq_(calls[1:], [('release_frame', (frame,), {}) for frame in frames])
+
+    def test_batch_handler_coalesces_messages(self):
+        by_contract, by_market = [], []
+        self.client.add_batch_handler(
+            'seto.contract_quotes', lambda messages: by_contract.extend(messages), coalesce=True)
+        self.client.add_batch_handler(
+            'seto.contract_quotes', lambda messages: by_market.extend(messages),
+            coalesce=lambda message: message.contract_quotes.market_id)
+        self._read_frames(self._contract_quotes_frames((1, 2, 10), (1, 3, 20), (1, 2, 30), (4, 5, 40)))
+
+        eq_([(m.contract_quotes.contract_id, m.contract_quotes.bids[0].price) for m in by_contract],
+            [(2, 30), (3, 20), (5, 40)])
+        eq_([(m.contract_quotes.contract_id, m.contract_quotes.bids[0].price) for m in by_market],
+            [(2, 30), (5, 40)])
+
+    def test_del_batch_handler(self):
+        handler = Handler()
+        self.client.add_batch_handler('seto.contract_quotes', handler)
+        self.client.del_batch_handler('seto.contract_quotes', handler)
+        self._read_frames(self._contract_quotes_frames((1, 2, 10)))
+
+        eq_(handler.call_count, 0)
+        self.assertRaises(KeyError, self.client.del_batch_handler, 'seto.contract_quotes', handler)
+
+    def test_add_bad_batch_handler(self):
+        handler = Handler()
+        self.assertRaises(ValueError, self.client.add_batch_handler, 'eto.pong', 50)
+        self.assertRaises(InvalidCallbackError, self.client.add_batch_handler, 'foo', handler)
+        self.assertRaises(ValueError, self.client.add_batch_handler, 'eto.pong', handler, coalesce=True)
+        self.assertRaises(
+            ValueError, self.client.add_batch_handler, 'seto.market_quotes', handler, coalesce='yes')
+
     def test_add_bad_handler(self):
         "Test trying to add a bad handler either as a global or normal"
         for bad_handler in (
@@ -164,6 +281,69 @@ class SmarketsTestCase(unittest.TestCase):
             self.assertRaises(
                 ValueError, self.client.add_global_handler, bad_handler)
 
+    def test_send_many(self):
+        "Test sending a batch of messages with a single flush"
+        self.mock_session.out_payload = seto.Payload()
+        sent = []
+
+        def send():
+            payload = seto.Payload()
+            payload.CopyFrom(self.mock_session.out_payload)
+            sent.append(payload)
+        self.mock_session.send.side_effect = send
+
+        messages = [
+            seto.OrderCreate(market_id=1, contract_id=2, quantity=10000, price=5000, reference=1),
+            seto.OrderCancel(order_id=3),
+            seto.OrderCreate(market_id=1, contract_id=2, quantity=20000, price=2500, reference=2),
+        ]
+        eq_(self.client.send_many(messages, flush=True), 3)
+        eq_([payload.type for payload in sent],
+            [seto.PAYLOAD_ORDER_CREATE, seto.PAYLOAD_ORDER_CANCEL, seto.PAYLOAD_ORDER_CREATE])
+        eq_((sent[1].order_cancel, sent[2].order_create), (messages[1], messages[2]))
+        self.assertFalse(sent[1].HasField('order_create'))
+        eq_(self.mock_session.flush.call_count, 1)
+
+        eq_(self.client.send_many(iter(messages)), 3)
+        eq_(self.mock_session.flush.call_count, 1)
+
+    def test_compose(self):
+        "Test building a message in the outgoing payload"
+        self.mock_session.out_payload = seto.Payload()
+        sent = []
+        self.mock_session.send.side_effect = lambda: sent.append(
+            self.mock_session.out_payload.SerializePartialToString())
+
+        with self.client.compose('order_create') as order:
+            order.market_id = 1
+            order.quantity = 10000
+        with self.client.compose(seto.OrderCancel) as cancel:
+            cancel.order_id = 2
+        eq_([seto.Payload.FromString(payload) for payload in sent], [
+            seto.Payload(type=seto.PAYLOAD_ORDER_CREATE,
+                         order_create=seto.OrderCreate(market_id=1, quantity=10000)),
+            seto.Payload(type=seto.PAYLOAD_ORDER_CANCEL, order_cancel=seto.OrderCancel(order_id=2)),
+        ])
+
+        # Nothing is sent when building the message fails, nor left for the next send
+        with self.assertRaises(ZeroDivisionError):
+            with self.client.compose('order_cancel') as cancel:
+                cancel.order_id = 3
+                cancel.order_id = 1 // 0
+        eq_(len(sent), 2)
+        eq_(self.mock_session.out_payload, seto.Payload())
+
+    def test_compose_claims_the_payload_when_entered(self):
+        "Test messages sent between compose() and the block aren't overwritten"
+        self.mock_session.out_payload = seto.Payload()
+        composed = self.client.compose('order_cancel')
+        self.client.send(seto.OrderCreate(market_id=1))
+        eq_(self.mock_session.out_payload.type, seto.PAYLOAD_ORDER_CREATE)
+        with composed as cancel:
+            cancel.order_id = 2
+        eq_(self.mock_session.out_payload,
+            seto.Payload(type=seto.PAYLOAD_ORDER_CANCEL, order_cancel=seto.OrderCancel(order_id=2)))
+
     def test_add_unknown_handler(self):
         "Test trying to add a handler for an unknown callback name"
         handler = lambda: None
@@ -306,3 +486,25 @@ class UuidTestCase(unittest.TestCase):
         uuid_prefix = uuid.Uuid.from_slug(slug)
         uuid_no_prefix = uuid.Uuid.from_slug(slug_no_prefix)
         self.assertEqual(uuid_prefix, uuid_no_prefix)
+
+
+def test_dispatch_skips_stale_frames():
+    "Frames buffered after a duplicate are dispatched by the same read"
+    for instrumentation in (None, Instrumentation()):
+        yield _check_dispatch_skips_stale_frames, instrumentation
+
+
+def _check_dispatch_skips_stale_frames(instrumentation):
+    session = Session(SessionSettings('username', 'password'), inseq=2, instrumentation=instrumentation)
+    client = StreamingAPIClient(session)
+    pongs = []
+    client.add_handler('eto.pong', lambda message: pongs.append(message))
+    for seq in (1, 2, 1, 3):
+        payload = seto.Payload(type=seto.PAYLOAD_ETO)
+        payload.eto_payload.seq = seq
+        payload.eto_payload.type = eto.PAYLOAD_PONG
+        session._buffer_payloads([payload.SerializeToString()], 0)
+
+    eq_(client.read(read_mode=READ_MODE_DISPATCH_FROM_BUFFER), 2)
+    eq_([pong.eto_payload.seq for pong in pongs], [2, 3])
+    eq_(len(session.buffered_incoming_payloads), 0)
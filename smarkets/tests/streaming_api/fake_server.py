@@ -0,0 +1,196 @@
+from __future__ import absolute_import
+
+import socket
+import sys
+import unittest
+from collections import defaultdict
+
+from nose.plugins.skip import SkipTest
+from mock import patch
+from nose.tools import eq_
+
+if sys.version_info < (3, 5):
+    raise SkipTest('the fake server requires Python 3.5+')
+
+from smarkets.streaming_api import eto, seto  # noqa
+from smarkets.streaming_api.client import StreamingAPIClient  # noqa
+from smarkets.streaming_api.fake_server import FakeServer  # noqa
+from smarkets.streaming_api.framing import frame_decode_all, frame_encode  # noqa
+from smarkets.streaming_api.orderbook import OrderBook, TICK_PRICES  # noqa
+from smarkets.streaming_api.session import Session, SessionSettings  # noqa
+
+
+class _ServerMixin(object):
+
+    "Runs a fake server for each test and collects the messages received by clients"
+
+    server_kwargs = {}
+
+    def setUp(self):
+        self.server = FakeServer(seed=0, **self.server_kwargs)
+        self.server.start_thread()
+        self.clients = []
+        self.messages = defaultdict(list)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.session.disconnect()
+        self.server.stop_thread()
+
+    def logged_in_client(self):
+        settings = SessionSettings(
+            'username', 'password', host='127.0.0.1', port=self.server.port, ssl=False,
+            socket_timeout=5)
+        client = StreamingAPIClient(Session(settings))
+        self.clients.append(client)
+        client.add_global_handler(lambda name, message: self.messages[name].append(message.protobuf))
+        client.login()
+        return client
+
+    def receive(self, client, name, count=1, flush=True):
+        "Read until `count` `name` messages have been received, return them"
+        while len(self.messages[name]) < count:
+            client.read()
+            if flush:
+                # Heartbeat answers
+                client.flush()
+        return self.messages[name]
+
+
+class FakeServerTestCase(_ServerMixin, unittest.TestCase):
+
+    def test_login(self):
+        client = self.logged_in_client()
+        eq_(client.last_login.eto_payload.type, eto.PAYLOAD_LOGIN_RESPONSE)
+        eq_(client.last_login.eto_payload.login_response.session, 'fake-session-1')
+        eq_(client.session.buf_outseq, 2)
+
+    def test_answers_pings(self):
+        client = self.logged_in_client()
+        for _ in range(3):
+            client.ping()
+        client.flush()
+        pongs = self.receive(client, 'eto.pong', 3)
+        eq_([pong.eto_payload.seq for pong in pongs], [2, 3, 4])
+        eq_(self.server.received, 4)
+
+    def test_accepts_and_cancels_orders(self):
+        client = self.logged_in_client()
+        client.send(seto.OrderCreate(
+            market_id=1, contract_id=2, side=seto.SIDE_BUY, quantity=10000, price=2500, reference=7))
+        client.flush()
+        accepted, = self.receive(client, 'seto.order_accepted')
+        eq_((accepted.order_accepted.seq, accepted.order_accepted.reference), (2, 7))
+
+        order_id = accepted.order_accepted.order_id
+        for _ in range(2):
+            client.send(seto.OrderCancel(order_id=order_id))
+        client.flush()
+        self.receive(client, 'seto.order_cancel_rejected')
+        eq_(self.messages['seto.order_cancelled'][0].order_cancelled.order_id, order_id)
+        eq_(self.messages['seto.order_cancel_rejected'][0].order_cancel_rejected.reason,
+            seto.ORDER_CANCEL_REJECTED_NOT_FOUND)
+
+    def test_rejects_orders(self):
+        client = self.logged_in_client()
+        client.send(seto.OrderCreate(
+            market_id=5, contract_id=1, side=seto.SIDE_BUY, quantity=10000, price=2500, reference=1))
+        client.send(seto.OrderCreate(
+            market_id=1, contract_id=1, side=seto.SIDE_SELL, quantity=0, price=10000, reference=2))
+        # Off the tick ladder
+        client.send(seto.OrderCreate(
+            market_id=1, contract_id=1, side=seto.SIDE_SELL, quantity=10000, price=2501, reference=3))
+        client.flush()
+        invalid, off_tick = self.receive(client, 'seto.order_invalid', 2)
+        rejected, = self.messages['seto.order_rejected']
+        eq_(rejected.order_rejected.reason, seto.ORDER_REJECTED_MARKET_NOT_FOUND)
+        eq_(list(invalid.order_invalid.reasons),
+            [seto.ORDER_INVALID_INVALID_PRICE, seto.ORDER_INVALID_INVALID_QUANTITY])
+        eq_(list(off_tick.order_invalid.reasons), [seto.ORDER_INVALID_INVALID_PRICE])
+        eq_((self.server.orders_accepted, self.server.orders_rejected), (0, 3))
+
+    def test_requests_replay_of_missing_payloads(self):
+        client = self.logged_in_client()
+        client.session.buf_outseq += 1
+        client.ping()
+        client.flush()
+        replay, = self.receive(client, 'eto.replay')
+        eq_(replay.eto_payload.replay.seq, 2)
+
+    def test_confirms_logout(self):
+        client = self.logged_in_client()
+        client.logout()
+        eq_([logout.eto_payload.logout.reason for logout in self.messages['eto.logout']],
+            [eto.LOGOUT_CONFIRMATION])
+
+    def test_requires_login_first(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port), 5)
+        payload = seto.Payload(type=seto.PAYLOAD_ETO)
+        payload.eto_payload.seq = 1
+        payload.eto_payload.type = eto.PAYLOAD_PING
+        frame = bytearray()
+        frame_encode(frame, payload.SerializeToString())
+        sock.sendall(frame)
+        data = b''
+        while True:
+            received = sock.recv(1024)
+            if not received:
+                break
+            data += received
+        sock.close()
+        payloads, _ = frame_decode_all(data)
+        logout = seto.Payload.FromString(bytes(payloads[0])).eto_payload
+        eq_((logout.type, logout.logout.reason), (eto.PAYLOAD_LOGOUT, eto.LOGOUT_LOGIN_NOT_FIRST_SEQ))
+
+
+class FakeServerQuotesTestCase(_ServerMixin, unittest.TestCase):
+
+    server_kwargs = {'quote_rate': 1000, 'markets': (1, 2), 'heartbeat_interval': 0.05}
+
+    def test_streams_quotes_of_subscribed_markets(self):
+        client = self.logged_in_client()
+        client.send(seto.MarketSubscribe(market_id=2))
+        client.flush()
+        quotes = self.receive(client, 'seto.contract_quotes', 20)
+        eq_(set(quote.contract_quotes.market_id for quote in quotes), set([2]))
+        eq_(set(quote.contract_quotes.contract_id for quote in quotes), set([1, 2, 3]))
+        for quote in quotes:
+            bids, offers = quote.contract_quotes.bids, quote.contract_quotes.offers
+            self.assertTrue(bids[0].price < offers[0].price)
+
+    def test_sends_a_snapshot_on_subscription(self):
+        client = self.logged_in_client()
+        client.send(seto.MarketSubscribe(market_id=1))
+        client.flush()
+        snapshot, = self.receive(client, 'seto.market_quotes')
+        eq_([quotes.contract_id for quotes in snapshot.market_quotes.contract_quotes], [1, 2, 3])
+        # Before any contract quotes
+        eq_(self.messages['seto.contract_quotes'], [])
+
+    def test_quotes_keep_an_order_book_consistent(self):
+        client = self.logged_in_client()
+        book = OrderBook(client)
+        client.send(seto.MarketSubscribe(market_id=1))
+        client.flush()
+        with patch.object(OrderBook.logger, 'warning') as warning:
+            quotes = self.receive(client, 'seto.contract_quotes', 200)
+        eq_(warning.call_count, 0)
+        ticks = set(TICK_PRICES)
+        for quote in quotes:
+            for level in list(quote.contract_quotes.bids) + list(quote.contract_quotes.offers):
+                self.assertTrue(level.price in ticks)
+        for contract_id in (1, 2, 3):
+            contract = book.contract(1, contract_id)
+            eq_((len(contract.bids()), len(contract.offers())), (3, 3))
+            self.assertTrue(contract.best_bid.price < contract.best_offer.price)
+
+    def test_sends_heartbeats(self):
+        client = self.logged_in_client()
+        # The session answers heartbeats, the server doesn't time out
+        self.receive(client, 'eto.heartbeat', 5)
+        eq_(len(self.server.connections), 1)
+
+    def test_logs_out_silent_clients(self):
+        client = self.logged_in_client()
+        logout, = self.receive(client, 'eto.logout', flush=False)
+        eq_(logout.eto_payload.logout.reason, eto.LOGOUT_HEARTBEAT_TIMEOUT)
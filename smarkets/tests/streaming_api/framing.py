@@ -6,7 +6,8 @@ from nose.tools import eq_, raises
 from six.moves import xrange
 
 from smarkets.streaming_api.framing import (
-    frame_decode_all, frame_encode, IncompleteULEB128, uleb128_decode, uleb128_encode,
+    frame_decode_all, frame_encode, frame_index, FrameDecoder, IncompleteULEB128, uleb128_decode,
+    uleb128_encode,
 )
 
 
@@ -35,6 +36,7 @@ def test_loads():
 
 def check_loads(byte_array, value):
     eq_(uleb128_decode(byte_array), (value, len(byte_array)))
+    eq_(uleb128_decode(b'\xff\x01' + byte_array, 2), (value, len(byte_array)))
 
 
 def test_loads_and_dumps_are_consistent():
@@ -109,3 +111,97 @@ def test_frame_decode_all():
 
 def check_frame_decode_all(byte_array, output):
     eq_(frame_decode_all(byte_array), output)
+
+
+def test_frame_decoder():
+    for input_, output in (
+        (b'', ([], 0)),
+        (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd', ([b'a', b'ab', b'abc', b'abcd'], 0)),
+        (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd\x03ab', ([b'a', b'ab', b'abc', b'abcd'], 3)),
+        (b'\x80\x80\x80\x80\x80', ([], 5)),
+        (b'\x05abcde\x03abc', ([b'abcde', b'abc'], 0)),
+    ):
+        yield check_frame_decoder, bytearray(input_), output
+
+
+def check_frame_decoder(byte_array, output):
+    decoder = FrameDecoder()
+    decoder.feed(byte_array)
+    payloads = [payload.tobytes() for payload in decoder.decode()]
+    eq_((payloads, len(decoder)), output)
+
+
+def test_frame_decoder_decodes_byte_by_byte_input():
+    payloads = [b'x' * size for size in (0, 1, 3, 4, 127, 128, 300, 20000)]
+    stream = bytearray()
+    for payload in payloads:
+        frame_encode(stream, payload)
+
+    decoder = FrameDecoder()
+    decoded = []
+    for i in xrange(len(stream)):
+        decoder.feed(stream[i:i + 1])
+        decoded.extend(payload.tobytes() for payload in decoder.decode())
+
+    eq_(decoded, payloads)
+    eq_(len(decoder), 0)
+
+
+def test_frame_decoder_payloads_are_not_overwritten_by_later_data():
+    decoder = FrameDecoder()
+    decoder.feed(b'\x03abc\x03de')
+    payloads = list(decoder.decode())
+    decoder.feed(b'f\x03ghi')
+    payloads.extend(decoder.decode())
+    eq_([payload.tobytes() for payload in payloads], [b'abc', b'def', b'ghi'])
+
+
+def test_frame_index():
+    for input_, position, output in (
+        (b'', 0, ([], 0)),
+        (b'\x01a\x00\x00\x02ab\x00\x03abc', 0, ([(1, 1), (5, 2), (9, 3)], 12)),
+        (b'\x01a\x00\x00\x02ab\x00\x03abc', 4, ([(5, 2), (9, 3)], 12)),
+        (b'\x01a\x00\x00\x03ab', 0, ([(1, 1)], 4)),
+        (b'\x80\x01' + b'x' * 128 + b'\x80', 0, ([(2, 128)], 130)),
+        (b'\x80\x80\x80\x80\x80', 0, ([], 0)),
+    ):
+        yield check_frame_index, bytearray(input_), position, output
+
+
+def check_frame_index(byte_array, position, output):
+    eq_(frame_index(byte_array, position), output)
+
+
+def test_frame_decoder_receives_into_its_buffer():
+    decoder = FrameDecoder()
+    view = decoder.writable(8)
+    view[:6] = b'\x03abc\x03d'
+    del view
+    decoder.commit(6)
+
+    eq_([payload.tobytes() for payload in decoder.decode()], [b'abc'])
+    eq_(len(decoder), 2)
+
+
+def test_frame_decoder_reuses_buffer_once_payloads_are_released():
+    decoder = FrameDecoder(8)
+    decoder.feed(b'\x03abc\x03d')
+    payloads = decoder.decode()
+    buffer_ = decoder._buffer
+
+    decoder.feed(b'ef\x03gh')
+    assert decoder._buffer is not buffer_
+    eq_([payload.tobytes() for payload in payloads], [b'abc'])
+
+    del payloads[:]
+    buffer_ = decoder._buffer
+    eq_([payload.tobytes() for payload in decoder.decode()], [b'def'])
+    decoder.feed(b'i\x03jkl')
+    assert decoder._buffer is buffer_
+    eq_([payload.tobytes() for payload in decoder.decode()], [b'ghi', b'jkl'])
+    eq_(decoder.capacity, 8)
+
+
+def test_frame_index_stops_at_end():
+    eq_(frame_index(bytearray(b'\x01a\x00\x00\x80\x01'), 0, 5), ([(1, 1)], 4))
+    eq_(frame_index(bytearray(b'\x01a\x00\x00\x01a\x00\x00'), 0, 7), ([(1, 1)], 4))
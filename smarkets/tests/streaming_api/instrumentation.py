@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+from functools import partial
+import socket
+import unittest
+
+from mock import call, Mock
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.framing import frame_encode
+from smarkets.streaming_api.instrumentation import Instrumentation
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+def _quotes_stream(count):
+    stream = bytearray()
+    for seq in range(1, count + 1):
+        payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+        payload.eto_payload.seq = seq
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.contract_quotes.market_id = 1
+        payload.contract_quotes.contract_id = seq
+        frame_encode(stream, payload.SerializeToString())
+    return bytes(stream)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Every clock reading is 10ns after the previous one
+        self.instrumentation = Instrumentation(clock=partial(next, itertools.count(0, 10)))
+        session = Session(SessionSettings('username', 'password'), instrumentation=self.instrumentation)
+        session.socket._sock, self.server = socket.socketpair()
+        self.client = StreamingAPIClient(session)
+
+    def tearDown(self):
+        self.client.session.socket._sock.close()
+        self.server.close()
+
+    def test_records_traffic(self):
+        stream = _quotes_stream(3)
+        self.server.sendall(stream)
+        self.client.read()
+        self.client.ping()
+        self.client.flush()
+
+        eq_(self.instrumentation.bytes_in, len(stream))
+        eq_(self.instrumentation.bytes_out, len(self.server.recv(1024)))
+        eq_(self.instrumentation.frames_per_read.buckets(), [(3, 1)])
+
+    def test_records_frame_timings_by_message_type(self):
+        self.client.add_handler('seto.contract_quotes', lambda message: None)
+        self.server.sendall(_quotes_stream(3))
+        self.client.read()
+
+        timings = self.instrumentation.messages['seto.contract_quotes']
+        # Received at 0, decoded at 10, then taken, ready and handled at 20, 30 and 40 for
+        # the first frame, 50, 60 and 70 for the second one... Waits are 10, 40 and 70.
+        eq_(timings.decode.buckets(), [(10, 3)])
+        eq_(timings.wait.buckets(), [(10, 1), (43, 1), (71, 1)])
+        eq_(timings.parse.buckets(), [(10, 3)])
+        eq_(timings.handle.buckets(), [(10, 3)])
+
+    def test_batched_frames_are_handled_when_delivered(self):
+        self.client.add_batch_handler('seto.contract_quotes', lambda messages: None)
+        self.server.sendall(_quotes_stream(2))
+        self.client.read()
+
+        # Frames ready at 30 and 50 are delivered at 60
+        eq_(self.instrumentation.messages['seto.contract_quotes'].handle.buckets(), [(10, 1), (31, 1)])
+
+    def test_export(self):
+        self.server.sendall(_quotes_stream(1))
+        self.client.read()
+        metrics = dict(self.instrumentation.metrics())
+        eq_(metrics['bytes_in'], len(_quotes_stream(1)))
+        eq_(metrics['frames_per_read.count'], 1)
+        eq_(metrics['messages.seto.contract_quotes.decode.p99_9'], 10)
+        self.assertNotIn('messages.eto.ping.decode.count', metrics)
+
+        statsd = Mock()
+        self.instrumentation.export_statsd(statsd)
+        self.assertIn(call.gauge('messages.seto.contract_quotes.handle.max', 10), statsd.method_calls)
+
+        graphite = Mock()
+        self.instrumentation.export_graphite(graphite, timestamp=1)
+        self.assertIn(call.send_metric('bytes_out', 0, 1), graphite.method_calls)
+        eq_(len(graphite.method_calls), len(metrics))
+
+        self.instrumentation.reset()
+        eq_(self.instrumentation.metrics(), [('bytes_in', 0), ('bytes_out', 0)])
@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import sys
+import threading
+import time
+import unittest
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.framing import frame_decode_all
+from smarkets.streaming_api.keepalive import BaseKeepalive, Keepalive
+from smarkets.streaming_api.resilient import ResilientSession
+from smarkets.streaming_api.session import Frame, Session, SessionSettings
+
+
+class ServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.client = StreamingAPIClient(Session(SessionSettings('username', 'password')))
+        self.client.session.socket._sock, self.server = self.sockets = socket.socketpair()
+        self.client.session.logged_in = True
+        self.keepalive = BaseKeepalive(self.client, ping_interval=5, clock=lambda: self.now)
+        self.keepalive._attach()
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def received(self):
+        return [
+            seto.Payload.FromString(bytes(data)).eto_payload.type
+            for data in frame_decode_all(self.server.recv(1024))[0]]
+
+    def test_pings_are_sent_and_flushed(self):
+        self.keepalive.service()
+        eq_(self.received(), [eto.PAYLOAD_PING])
+
+        # Output buffered by the client is flushed, pings wait for the interval
+        self.now = 4 * 10 ** 9
+        self.client.ping()
+        self.keepalive.service()
+        eq_(self.received(), [eto.PAYLOAD_PING])
+        eq_(len(self.client.session.send_queue), 0)
+
+        self.now = 5 * 10 ** 9
+        self.keepalive.service()
+        eq_(self.received(), [eto.PAYLOAD_PING])
+
+    def test_pong_round_trips_are_recorded(self):
+        self.keepalive.service()
+        self.now = 3000
+        pong = seto.Payload(type=seto.PAYLOAD_ETO)
+        pong.eto_payload.seq = 1
+        pong.eto_payload.type = eto.PAYLOAD_PONG
+        self.client._dispatch(Frame(bytes=pong.SerializeToString(), protobuf=pong))
+        eq_((self.keepalive.latency.count, self.keepalive.latency.max), (1, 3000))
+
+        # Pongs of pings sent by someone else
+        self.client._dispatch(Frame(bytes=pong.SerializeToString(), protobuf=pong))
+        eq_(self.keepalive.latency.count, 1)
+
+        self.keepalive._detach()
+        eq_(len(self.client.callbacks['eto.pong']), 0)
+
+    def test_nothing_is_done_until_logged_in(self):
+        self.client.session.logged_in = False
+        self.keepalive.service()
+        self.client.session.logged_in = True
+        self.client.session.socket._sock = None
+        self.keepalive.service()
+        eq_(len(self.client.session.send_queue), 0)
+
+    def test_ssl_sessions_are_refused(self):
+        self.client.session.settings.ssl = True
+        self.assertRaises(ValueError, Keepalive(self.client).start)
+
+
+class FakeServerKeepaliveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if sys.version_info < (3, 5):
+            raise SkipTest('the fake server requires Python 3.5+')
+        from smarkets.streaming_api.fake_server import FakeServer
+        self.server = FakeServer(heartbeat_interval=0.05)
+        self.server.start_thread()
+        settings = SessionSettings(
+            'username', 'password', host='127.0.0.1', port=self.server.port, ssl=False,
+            socket_timeout=5)
+        self.client = StreamingAPIClient(Session(settings))
+        self.client.login()
+        self.keepalive = Keepalive(self.client, ping_interval=0.05, max_flush_delay=0.01)
+
+    def tearDown(self):
+        self.client.session.disconnect()
+        self.server.stop_thread()
+
+    def test_busy_client_isnt_logged_out(self):
+        self.keepalive.start()
+        # Busy for more than the heartbeat timeout
+        time.sleep(0.3)
+        logouts = []
+        self.client.add_handler('eto.logout', logouts.append)
+        # Pongs are only dispatched by the client's thread
+        while not self.keepalive.latency.count:
+            self.client.read()
+        self.keepalive.stop()
+
+        eq_(logouts, [])
+        self.assertTrue(self.client.session.connected)
+
+
+class FakeServerResilientKeepaliveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if sys.version_info < (3, 5):
+            raise SkipTest('the fake server requires Python 3.5+')
+        from smarkets.streaming_api.fake_server import FakeServer
+        self.server = FakeServer()
+        self.server.start_thread()
+        settings = SessionSettings(
+            'username', 'password', host='127.0.0.1', port=self.server.port, ssl=False,
+            socket_timeout=5)
+        self.client = StreamingAPIClient(ResilientSession(settings))
+        self.client.login()
+        self.keepalive = Keepalive(self.client, ping_interval=0.01, max_flush_delay=0.001)
+        self.keepalive.start()
+
+    def tearDown(self):
+        self.keepalive.stop()
+        self.client.session.disconnect()
+        self.server.stop_thread()
+
+    def test_reconnecting_while_running(self):
+        dropped = threading.Event()
+
+        def drop():
+            for connection in list(self.server.connections):
+                connection.transport.abort()
+            dropped.set()
+        self.server.loop.call_soon_threadsafe(drop)
+        dropped.wait()
+
+        session = self.client.session
+
+        def send_until_reconnected():
+            # Flushing fails and logs in again, which sends, while the thread pings and flushes
+            while not session.reconnects:
+                self.client.send(seto.MarketSubscribe(market_id=1))
+                self.client.flush()
+            self.client.read()
+            while not self.keepalive.latency.count:
+                self.client.read()
+        thread = threading.Thread(target=send_until_reconnected)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        eq_(self.client.last_login.eto_payload.login_response.session, 'fake-session-2')
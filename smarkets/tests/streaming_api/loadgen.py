@@ -0,0 +1,32 @@
+from __future__ import absolute_import
+
+import sys
+import unittest
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+if sys.version_info < (3, 5):
+    raise SkipTest('the fake server requires Python 3.5+')
+
+from smarkets.streaming_api.fake_server import FakeServer  # noqa
+from smarkets.streaming_api.loadgen import LoadGenerator  # noqa
+
+
+class LoadGeneratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer(quote_rate=1000)
+        self.server.start_thread()
+
+    def tearDown(self):
+        self.server.stop_thread()
+
+    def test_run(self):
+        generator = LoadGenerator(port=self.server.port, clients=2, order_rate=200)
+        report = generator.run(0.3)
+        self.assertTrue(report.quotes > 0)
+        self.assertTrue(report.orders_sent >= 50)
+        self.assertTrue(report.orders_answered >= report.orders_sent - 5)
+        eq_(report.latency.count, report.orders_answered)
+        self.assertIn('order latency', str(report))
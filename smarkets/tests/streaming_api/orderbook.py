@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.orderbook import OrderBook, PriceLevel, TICK_PRICES
+from smarkets.streaming_api.session import Frame
+
+
+def _contract_quotes(contract_id, bids=(), offers=()):
+    quotes = seto.ContractQuotes(market_id=1, contract_id=contract_id)
+    for price, quantity in bids:
+        quotes.bids.add(price=price, quantity=quantity)
+    for price, quantity in offers:
+        quotes.offers.add(price=price, quantity=quantity)
+    return quotes
+
+
+class OrderBookTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.book = OrderBook()
+        self.changes = []
+        self.book.top_changed += lambda contract: self.changes.append(contract.top())
+
+    def test_snapshot_and_updates(self):
+        market_quotes = seto.MarketQuotes(market_id=1)
+        market_quotes.contract_quotes.extend([
+            _contract_quotes(2, bids=[(4762, 100), (4545, 200)], offers=[(5000, 300), (5263, 400)]),
+            _contract_quotes(3, offers=[(2000, 10)]),
+        ])
+        self.book.update_market_quotes(market_quotes)
+
+        contract = self.book.contract(1, 2)
+        eq_((contract.best_bid, contract.best_offer), (PriceLevel(4762, 100), PriceLevel(5000, 300)))
+        eq_(self.book.contract(1, 3).best_bid, None)
+        eq_(self.book.contract(1, 4), None)
+
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(4762, 0), (4854, 50)]))
+        eq_(contract.bids(), [PriceLevel(4854, 50), PriceLevel(4545, 200)])
+
+        # A new snapshot replaces everything
+        self.book.update_market_quotes(
+            seto.MarketQuotes(market_id=1, contract_quotes=[_contract_quotes(2, bids=[(1000, 1)])]))
+        eq_((contract.bids(), contract.offers()), ([PriceLevel(1000, 1)], []))
+
+    def test_depth(self):
+        self.book.update_contract_quotes(_contract_quotes(
+            2, bids=[(price, 10) for price in TICK_PRICES[100:110]],
+            offers=[(price, 10) for price in TICK_PRICES[110:120]]))
+        contract = self.book.contract(1, 2)
+        eq_([level.price for level in contract.bids(3)], list(reversed(TICK_PRICES[107:110])))
+        eq_([level.price for level in contract.offers(2)], list(TICK_PRICES[110:112]))
+        eq_(len(contract.offers()), 10)
+
+    def test_removing_the_best_levels(self):
+        self.book.update_contract_quotes(
+            _contract_quotes(2, bids=[(4000, 1), (4167, 2)], offers=[(6024, 3), (6250, 4)]))
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(4167, 0)], offers=[(6024, 0)]))
+        contract = self.book.contract(1, 2)
+        eq_((contract.best_bid, contract.best_offer), (PriceLevel(4000, 1), PriceLevel(6250, 4)))
+
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(4000, 0)], offers=[(6250, 0)]))
+        eq_((contract.best_bid, contract.best_offer), (None, None))
+
+    def test_top_changed_fires_only_when_the_top_changes(self):
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(4000, 1), (3846, 2)]))
+        eq_(len(self.changes), 1)
+
+        # Below the best bid
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(3846, 5), (3704, 1)]))
+        eq_(len(self.changes), 1)
+
+        # Quantity at the best bid, then a better offer
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(4000, 3)]))
+        self.book.update_contract_quotes(_contract_quotes(2, offers=[(6024, 1)]))
+        eq_(len(self.changes), 3)
+
+    def test_prices_off_the_ticks_are_ignored(self):
+        self.book.update_contract_quotes(_contract_quotes(2, bids=[(4001, 1)], offers=[(6024, 1)]))
+        eq_(self.book.contract(1, 2).bids(), [])
+
+    def test_attached_to_a_client(self):
+        client = StreamingAPIClient(None)
+        self.book.attach(client)
+        payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+        payload.eto_payload.seq = 1
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.contract_quotes.CopyFrom(_contract_quotes(2, offers=[(6024, 1)]))
+        client._dispatch(Frame(bytes=payload.SerializeToString(), protobuf=payload))
+        eq_(self.book.contract(1, 2).best_offer, PriceLevel(6024, 1))
+
+        self.book.detach(client)
+        eq_(len(client.callbacks['seto.contract_quotes']), 0)
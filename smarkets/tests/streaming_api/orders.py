@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from mock import Mock
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.orders import OrderTracker
+from smarkets.streaming_api.session import Frame
+from smarkets.streaming_api.utils import set_payload_message
+
+
+def _order_create(market_id=1, contract_id=2, side=seto.SIDE_BUY, price=2500, quantity=100000):
+    return seto.OrderCreate(
+        market_id=market_id, contract_id=contract_id, side=side, price=price, quantity=quantity)
+
+
+class OrderTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StreamingAPIClient(None)
+        self.client.send = Mock()
+        self.tracker = OrderTracker(self.client)
+        self.changes = []
+        self.tracker.order_changed += lambda order: self.changes.append(order.state)
+
+    def receive(self, message):
+        payload = seto.Payload()
+        set_payload_message(payload, message)
+        payload.eto_payload.seq = 1
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        self.client._dispatch(Frame(bytes=payload.SerializePartialToString(), protobuf=payload))
+
+    def accept(self, order, order_id):
+        self.receive(seto.OrderAccepted(
+            reference=order.reference, order_id=order_id, market_id=order.market_id,
+            contract_id=order.contract_id, side=order.side, price=order.price, quantity=order.quantity))
+
+    def test_create_and_fill(self):
+        order = self.tracker.create(_order_create())
+        eq_((order.reference, order.state), (1, 'pending'))
+        eq_(self.client.send.call_args[0][0].reference, 1)
+
+        self.accept(order, 10)
+        eq_((order.order_id, order.state), (10, 'live'))
+        self.assertIs(self.tracker.by_order_id[10], order)
+
+        self.receive(seto.OrderExecuted(order_id=10, price=2500, quantity=40000))
+        eq_((order.executed_quantity, order.remaining_quantity), (40000, 60000))
+        self.receive(seto.OrderExecuted(order_id=10, price=2500, quantity=60000))
+        eq_(order.state, 'filled')
+        eq_(self.changes, ['live', 'live', 'filled'])
+        eq_((self.tracker.by_reference, self.tracker.by_order_id, self.tracker.by_market), ({}, {}, {}))
+
+    def test_rejected_and_invalid_orders(self):
+        rejected = self.tracker.create(_order_create())
+        invalid = self.tracker.create(_order_create())
+        self.receive(seto.OrderRejected(reference=rejected.reference))
+        self.receive(seto.OrderInvalid(reference=invalid.reference))
+        eq_((rejected.state, invalid.state), ('rejected', 'rejected'))
+        eq_(self.tracker.open_orders(), [])
+        eq_(self.tracker.exposure(1).open_quantity, 0)
+
+    def test_exposure(self):
+        buy = self.tracker.create(_order_create(side=seto.SIDE_BUY, price=2500, quantity=100000))
+        sell = self.tracker.create(_order_create(side=seto.SIDE_SELL, price=4000, quantity=50000))
+        self.tracker.create(_order_create(market_id=3, contract_id=4))
+
+        exposure = self.tracker.exposure(1)
+        eq_((exposure.open_quantity, exposure.open_stake), (150000, 25000 + 30000))
+        eq_(self.tracker.exposure(1, 2, seto.SIDE_SELL).open_stake, 30000)
+        eq_(self.tracker.exposure(5).open_quantity, 0)
+
+        self.accept(buy, 10)
+        self.accept(sell, 11)
+        # Executed at a better price than the order's
+        self.receive(seto.OrderExecuted(order_id=10, price=2000, quantity=40000))
+        eq_((exposure.open_stake, exposure.executed_quantity, exposure.executed_stake),
+            (15000 + 30000, 40000, 8000))
+
+        self.receive(seto.OrderCancelled(order_id=11))
+        eq_((exposure.open_quantity, exposure.open_stake), (60000, 15000))
+        eq_(self.tracker.exposure(3).open_quantity, 100000)
+
+    def test_cancel_market(self):
+        live = self.tracker.create(_order_create())
+        pending = self.tracker.create(_order_create())
+        self.tracker.create(_order_create(market_id=3))
+        self.accept(live, 10)
+        self.client.send.reset_mock()
+
+        eq_(self.tracker.cancel_market(1), 2)
+        eq_([args[0][0] for args in self.client.send.call_args_list], [seto.OrderCancel(order_id=10)])
+
+        # Cancelled as soon as it's accepted
+        self.accept(pending, 11)
+        eq_(self.client.send.call_args[0][0], seto.OrderCancel(order_id=11))
+
+        self.receive(seto.OrderCancelled(order_id=10))
+        self.receive(seto.OrderCancelled(order_id=11))
+        eq_((live.state, pending.state), ('cancelled', 'cancelled'))
+        eq_(list(self.tracker.by_market), [3])
+
+    def test_orders_created_elsewhere(self):
+        self.receive(seto.OrderAccepted(
+            order_id=10, market_id=1, contract_id=2, side=seto.SIDE_BUY, price=5000, quantity=1000))
+        order = self.tracker.by_order_id[10]
+        eq_(self.tracker.exposure(1).open_stake, 500)
+
+        self.receive(seto.OrderExecuted(order_id=12, price=5000, quantity=1000))
+        self.receive(seto.OrderExecuted(order_id=10, price=5000, quantity=1000))
+        eq_(order.state, 'filled')
+
+    def test_cancel_replace(self):
+        original = self.tracker.create(_order_create(price=2500, quantity=100000))
+        self.accept(original, 10)
+        # Merged into an order cancel replace by a send scheduler
+        replacement_create = _order_create(price=3000, quantity=50000)
+        replacement_create.reference = 20
+        replacement = self.tracker.track(replacement_create)
+        exposure = self.tracker.exposure(1)
+        eq_(exposure.open_quantity, 150000)
+
+        self.receive(seto.OrderCancelReplaceAccepted(
+            order_id=11, orig_order_id=10, reference=replacement.reference, market_id=1,
+            contract_id=2, side=seto.SIDE_BUY, price=3000, quantity=50000, quantity_left=50000))
+        eq_((original.state, replacement.state, replacement.order_id), ('cancelled', 'live', 11))
+        self.assertIs(self.tracker.by_order_id[11], replacement)
+        eq_((exposure.open_quantity, exposure.open_stake), (50000, 15000))
+
+        self.receive(seto.OrderExecuted(order_id=11, price=3000, quantity=50000))
+        eq_(replacement.state, 'filled')
+        eq_(exposure.open_quantity, 0)
+
+    def test_rejected_cancel_replace(self):
+        original = self.tracker.create(_order_create())
+        self.accept(original, 10)
+        replacement_create = _order_create(price=3000)
+        replacement_create.reference = 20
+        replacement = self.tracker.track(replacement_create)
+        self.receive(seto.OrderCancelReplaceRejected(
+            order_id=10, orig_order_id=10, reference=replacement.reference))
+        eq_((original.state, replacement.state), ('live', 'rejected'))
+        eq_(self.tracker.exposure(1).open_quantity, 100000)
+
+    def test_references_must_be_unique(self):
+        self.tracker.create(_order_create())
+        with self.assertRaises(ValueError):
+            self.tracker.track(seto.OrderCreate(reference=1))
+
+    def test_detach(self):
+        self.tracker.detach()
+        eq_(len(self.client.callbacks['seto.order_accepted']), 0)
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import unittest
+
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.framing import frame_decode_all, frame_encode
+from smarkets.streaming_api.reactor import Backlog, Reactor
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+def _frames(eto_type, seqs):
+    frames = bytearray()
+    for seq in seqs:
+        payload = seto.Payload(type=seto.PAYLOAD_ETO)
+        payload.eto_payload.seq = seq
+        payload.eto_payload.type = eto_type
+        frame_encode(frames, payload.SerializeToString())
+    return bytes(frames)
+
+
+class ReactorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.server_sockets = []
+
+    def tearDown(self):
+        self.reactor.close()
+        for sock in self.server_sockets:
+            sock.close()
+
+    def connected_client(self):
+        "A client connected to one end of a socket pair, the other one is the server's"
+        client_socket, server_socket = socket.socketpair()
+        self.server_sockets.append(server_socket)
+        client = StreamingAPIClient(Session(SessionSettings('username', 'password', ssl=False)))
+        client.session.socket._sock = client_socket
+        self.reactor.register(client)
+        return client
+
+    def test_dispatches_ready_clients(self):
+        clients = [self.connected_client() for _ in range(3)]
+        pongs = []
+        for client in clients:
+            client.add_handler('eto.pong', lambda message, client=client: pongs.append(client))
+
+        self.server_sockets[0].sendall(_frames(eto.PAYLOAD_PONG, [1, 2]))
+        self.server_sockets[2].sendall(_frames(eto.PAYLOAD_PONG, [1]))
+
+        eq_(self.reactor.poll(1), 3)
+        eq_(sorted(map(clients.index, pongs)), [0, 0, 2])
+        eq_(self.reactor.poll(0), 0)
+
+    def test_flushes_buffered_output(self):
+        client = self.connected_client()
+        client.ping()
+        eq_(self.reactor.backlog(client).outgoing_bytes, len(_frames(eto.PAYLOAD_PING, [1])))
+
+        self.reactor.poll(1)
+
+        payloads, _ = frame_decode_all(self.server_sockets[0].recv(1024))
+        eq_([seto.Payload.FromString(bytes(payload)).eto_payload.type for payload in payloads],
+            [eto.PAYLOAD_PING])
+        eq_(self.reactor.backlogs(), {client: Backlog(0, 0, 0)})
+
+    def test_answers_heartbeats(self):
+        self.connected_client()
+        self.server_sockets[0].sendall(_frames(eto.PAYLOAD_HEARTBEAT, [1]))
+
+        self.reactor.poll(1)
+
+        payloads, _ = frame_decode_all(self.server_sockets[0].recv(1024))
+        eq_([seto.Payload.FromString(bytes(payload)).eto_payload.type for payload in payloads],
+            [eto.PAYLOAD_HEARTBEAT])
+
+    def test_reports_incomplete_frames(self):
+        client = self.connected_client()
+        frame = _frames(eto.PAYLOAD_PONG, [1])
+        self.server_sockets[0].sendall(frame[:-1])
+
+        eq_(self.reactor.poll(1), 0)
+        eq_(self.reactor.backlog(client), Backlog(0, len(frame) - 1, 0))
+
+    def test_unregisters_disconnected_clients(self):
+        clients = [self.connected_client() for _ in range(2)]
+        disconnected = []
+        self.reactor.disconnected += lambda client, exception: disconnected.append(client)
+
+        self.server_sockets[0].close()
+        self.reactor.poll(1)
+
+        eq_(disconnected, [clients[0]])
+        eq_(self.reactor.clients, [clients[1]])
+        self.assertFalse(clients[0].session.connected)
+
+    def test_run_returns_when_no_clients_are_left(self):
+        client = self.connected_client()
+        self.reactor.unregister(client)
+        self.reactor.run()
+        self.assertRaises(KeyError, self.reactor.unregister, client)
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import unittest
+
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import CaptureWriter, DIRECTION_IN, DIRECTION_OUT
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import SocketDisconnected
+from smarkets.streaming_api.replay import ReplaySession
+from smarkets.streaming_api.session import SessionSettings
+
+
+def _payload(seq, eto_type):
+    payload = seto.Payload(type=seto.PAYLOAD_ETO)
+    payload.eto_payload.seq = seq
+    payload.eto_payload.type = eto_type
+    if eto_type == eto.PAYLOAD_LOGIN_RESPONSE:
+        payload.eto_payload.login_response.session = 'session'
+        payload.eto_payload.login_response.reset = 2
+    return payload.SerializeToString()
+
+
+class ReplaySessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # A login, then two reads of two pongs and one pong, a second apart
+        self.capture_file = io.BytesIO()
+        writer = CaptureWriter(self.capture_file)
+        writer.write(DIRECTION_OUT, b'login', timestamp=0)
+        writer.write(DIRECTION_IN, _payload(1, eto.PAYLOAD_LOGIN_RESPONSE), timestamp=10 ** 9)
+        writer.write(DIRECTION_IN, _payload(2, eto.PAYLOAD_PONG), timestamp=2 * 10 ** 9)
+        writer.write(DIRECTION_IN, _payload(3, eto.PAYLOAD_PONG), timestamp=2 * 10 ** 9)
+        writer.write(DIRECTION_IN, _payload(4, eto.PAYLOAD_PONG), timestamp=3 * 10 ** 9)
+        writer.flush()
+        self.sleeps = []
+        self.now = 0
+
+    def replay_client(self, speed=None):
+        session = ReplaySession(SessionSettings('username', 'password'), self.capture_file, speed=speed,
+                                sleep=self.sleeps.append, clock=lambda: self.now)
+        client = StreamingAPIClient(session)
+        self.pongs = []
+        client.add_handler('eto.pong', lambda message: self.pongs.append(message.eto_payload.seq))
+        return client
+
+    def test_replays_reads_as_fast_as_possible(self):
+        client = self.replay_client()
+        client.login()
+        self.assertTrue(client.check_login())
+
+        eq_(client.read(), 2)
+        eq_(client.read(), 1)
+        self.assertRaises(SocketDisconnected, client.read)
+        eq_(self.pongs, [2, 3, 4])
+        eq_(self.sleeps, [])
+        self.assertFalse(client.session.connected)
+
+    def test_replays_at_recorded_speed(self):
+        client = self.replay_client(speed=2)
+        client.login()
+        self.now = 2 * 10 ** 8
+        client.read()
+        client.read()
+
+        eq_(self.sleeps, [0.3, 0.8])
+
+    def test_discards_sent_payloads(self):
+        client = self.replay_client()
+        client.login()
+        client.ping()
+        client.flush()
+        eq_(client.output_buffer_size, 0)
+
+    def test_replays_again_after_reconnecting(self):
+        client = self.replay_client()
+        client.login()
+        client.session.disconnect()
+        client.login()
+        client.read()
+        eq_(self.pongs, [2, 3])
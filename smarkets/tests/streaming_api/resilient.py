@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import sys
+import threading
+import unittest
+
+from mock import patch
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.framing import frame_decode_all
+from smarkets.streaming_api.resilient import ResilientSession
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+def _payload(seq, eto_type=eto.PAYLOAD_NONE, account_sequence=None):
+    payload = seto.Payload()
+    payload.eto_payload.seq = seq
+    payload.eto_payload.type = eto_type
+    if account_sequence is not None:
+        payload.type = seto.PAYLOAD_ORDER_ACCEPTED
+        payload.order_accepted.account_sequence_64 = account_sequence
+    elif eto_type == eto.PAYLOAD_NONE:
+        payload.type = seto.PAYLOAD_CONTRACT_QUOTES
+    else:
+        payload.type = seto.PAYLOAD_ETO
+        if eto_type == eto.PAYLOAD_LOGOUT:
+            payload.eto_payload.logout.reason = eto.LOGOUT_UNAUTHORISED
+    return payload.SerializePartialToString()
+
+
+class GapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = ResilientSession(SessionSettings('username', 'password'), reorder_buffer_size=2)
+        self.session.socket._sock, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.session.socket._sock.close()
+        self.server.close()
+
+    def receive(self, *seqs):
+        self.session._buffer_payloads([_payload(seq) for seq in seqs], 0)
+        return [frame.seq for frame in self.session.next_frames()]
+
+    def test_out_of_sequence_payloads_are_reordered(self):
+        eq_(self.receive(1, 2, 4, 5), [1, 2])
+        replay, = [
+            seto.Payload.FromString(bytes(data)) for data in frame_decode_all(self.server.recv(1024))[0]]
+        eq_((replay.eto_payload.type, replay.eto_payload.replay.seq), (eto.PAYLOAD_REPLAY, 3))
+
+        # Replayed payloads, some of them already received
+        eq_(self.receive(3, 4, 5, 6), [3, 4, 5, 6])
+        eq_(self.session.inseq, 7)
+        metrics = dict(self.session.metrics())
+        eq_((metrics['frames_replayed'], metrics['frames_reordered'], metrics['gap_size.max']), (1, 2, 1))
+
+    def test_payloads_not_fitting_in_the_reorder_buffer_are_dropped(self):
+        eq_(self.receive(1, 3, 4, 5, 6), [1])
+        eq_((sorted(self.session.reorder_buffer), self.session.frames_dropped), ([3, 4], 2))
+        eq_(self.receive(2), [2, 3, 4])
+        eq_(self.receive(5, 6, 7), [5, 6, 7])
+        eq_(self.session.frames_replayed, 3)
+
+    def test_keeps_the_account_sequence_of_the_last_message(self):
+        self.session._buffer_payloads([_payload(1, account_sequence=41), _payload(2, account_sequence=42)], 0)
+        self.session.next_frame()
+        eq_(self.session.account_sequence, 41)
+        self.session.next_frame()
+        eq_(self.session.account_sequence, 42)
+
+
+class ReconnectTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.session = ResilientSession(
+            SessionSettings('username', 'password'), max_attempts=3, sleep=self.sleeps.append)
+
+    @patch.object(Session, 'connect', side_effect=[ConnectionError('refused')] * 2 + [None])
+    def test_backoff(self, connect):
+        self.session.reconnect()
+        eq_((connect.call_count, self.sleeps, self.session.reconnects), (3, [0.1, 0.2], 1))
+        eq_(self.session.reconnect_times.count, 1)
+
+    @patch.object(Session, 'connect', side_effect=ConnectionError('refused'))
+    def test_gives_up_after_max_attempts(self, connect):
+        self.assertRaises(ConnectionError, self.session.reconnect)
+        eq_(connect.call_count, 3)
+
+    def test_no_reconnection_after_logging_out(self):
+        self.session._buffer_payloads([_payload(1, eto.PAYLOAD_LOGOUT)], 0)
+        self.session.next_frame()
+        with patch.object(Session, 'connect') as connect:
+            self.assertRaises(SocketDisconnected, self.session.read)
+        eq_(connect.call_count, 0)
+
+
+class FakeServerReconnectTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if sys.version_info < (3, 5):
+            raise SkipTest('the fake server requires Python 3.5+')
+        from smarkets.streaming_api.fake_server import FakeServer
+        self.logins = []
+        self.server = FakeServer(check_login=lambda login: self.logins.append(login) or True)
+        self.server.start_thread()
+        settings = SessionSettings(
+            'username', 'password', host='127.0.0.1', port=self.server.port, ssl=False,
+            socket_timeout=5)
+        self.client = StreamingAPIClient(ResilientSession(settings))
+        self.client.login()
+
+    def tearDown(self):
+        self.client.session.disconnect()
+        self.server.stop_thread()
+
+    def test_reconnects_and_resumes(self):
+        session = self.client.session
+        session.account_sequence = 7
+        dropped = threading.Event()
+
+        def drop():
+            for connection in list(self.server.connections):
+                connection.transport.abort()
+            dropped.set()
+        self.server.loop.call_soon_threadsafe(drop)
+        dropped.wait()
+
+        while not session.reconnects:
+            self.client.read()
+        self.client.read()
+        eq_(self.client.last_login.eto_payload.login_response.session, 'fake-session-2')
+        eq_([login.account_sequence_64 for login in self.logins], [0, 7])
@@ -0,0 +1,179 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from mock import Mock
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.orders import TrackedOrder
+from smarkets.streaming_api.scheduler import SendScheduler, TokenBucket
+from smarkets.streaming_api.session import Frame
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=3)
+    bucket.tokens = 0
+    eq_(bucket.delay(0), 0.5)
+    bucket.refill(1)
+    eq_((bucket.tokens, bucket.delay(1)), (2, 0))
+    bucket.refill(10)
+    eq_(bucket.tokens, 3)
+
+
+def test_token_bucket_with_ticks():
+    bucket = TokenBucket(rate=10, burst=10, tick=0.5)
+    bucket.tokens = 0
+    bucket.refill(0.4)
+    eq_((bucket.tokens, bucket.delay(0.4)), (0, 0.5 - 0.4))
+    bucket.refill(1.2)
+    eq_((bucket.tokens, bucket.updated), (10, 1))
+
+
+class SendSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.client = Mock()
+        self.scheduler = SendScheduler(self.client, clock=lambda: self.now)
+
+    def sent(self):
+        messages = [message for call in self.client.send_many.call_args_list for message in call[0][0]]
+        self.client.send_many.reset_mock()
+        return messages
+
+    def test_messages_are_sent_within_the_limits(self):
+        self.scheduler.set_limit('order_create', rate=10, burst=2)
+        creates = [seto.OrderCreate(reference=reference) for reference in range(1, 5)]
+        for create in creates:
+            self.scheduler.schedule(create)
+        self.scheduler.schedule(seto.OrderCancel(order_id=1))
+
+        eq_(self.scheduler.flush(), 2)
+        eq_(self.sent(), creates[:2])
+        eq_(self.scheduler.next_send_delay(), 0.1)
+
+        self.now = 0.15
+        eq_(self.scheduler.flush(), 1)
+        self.now = 1
+        eq_(self.scheduler.flush(), 2)
+        # Messages are kept in order
+        eq_(self.sent(), creates[2:] + [seto.OrderCancel(order_id=1)])
+        eq_((self.scheduler.next_send_delay(), self.scheduler.flush()), (None, 0))
+
+    def test_exchange_limits(self):
+        client = StreamingAPIClient(None)
+        client.send_many = self.client.send_many
+        scheduler = SendScheduler(client, clock=lambda: self.now)
+        payload = seto.Payload(type=seto.PAYLOAD_THROTTLE_LIMITS_CHANGED)
+        payload.eto_payload.seq = 1
+        payload.eto_payload.type = eto.PAYLOAD_NONE
+        payload.throttle_limits_changed.average_rate_ps = 10
+        payload.throttle_limits_changed.burst_size = 2
+        payload.throttle_limits_changed.tick_ms = 500
+        client._dispatch(Frame(bytes=payload.SerializeToString(), protobuf=payload))
+
+        for order_id in range(10):
+            scheduler.schedule(seto.OrderCancel(order_id=order_id))
+        eq_(scheduler.flush(), 2)
+        eq_(scheduler.next_send_delay(), 0.5)
+        self.now = 0.4
+        eq_(scheduler.flush(), 0)
+        self.now = 0.5
+        eq_(scheduler.flush(), 2)
+
+        scheduler.detach()
+        eq_(len(client.callbacks['seto.throttle_limits_changed']), 0)
+
+    def test_duplicate_cancels_are_dropped(self):
+        eq_(self.scheduler.schedule(seto.OrderCancel(order_id=1)), True)
+        eq_(self.scheduler.schedule(seto.OrderCancel(order_id=1)), False)
+        eq_((len(self.scheduler), self.scheduler.dropped), (1, 1))
+
+        # Unless the first one was sent already
+        self.scheduler.flush()
+        eq_(self.scheduler.schedule(seto.OrderCancel(order_id=1)), True)
+
+    def test_cancel_and_create_are_merged(self):
+        order = TrackedOrder(1, market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2000,
+                             quantity=10000, order_id=1)
+        self.scheduler.schedule(seto.OrderCancel(order_id=1))
+        self.scheduler.schedule(seto.OrderCancel(order_id=2))
+        create = seto.OrderCreate(
+            market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2500, quantity=10000, reference=5)
+        eq_(self.scheduler.schedule(create, replaces=order), False)
+        # Replacing an order that isn't being cancelled, or with fields a replace can't carry
+        other = TrackedOrder(6, market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2000,
+                             quantity=10000, order_id=6)
+        self.scheduler.schedule(create, replaces=other)
+        order.order_id = 2
+        tif_create = seto.OrderCreate(
+            market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2500, quantity=10000,
+            tif=seto.IMMEDIATE_OR_CANCEL)
+        self.scheduler.schedule(tif_create, replaces=order)
+        # Cancelling an order that's being replaced
+        eq_(self.scheduler.schedule(seto.OrderCancel(order_id=1)), False)
+
+        self.scheduler.flush()
+        eq_(self.sent(), [
+            seto.OrderCancelReplace(
+                orig_order_id=1, price=2500, quantity=10000, reference=5, market_id=3),
+            seto.OrderCancel(order_id=2),
+            create,
+            tif_create,
+        ])
+        eq_((self.scheduler.merged, self.scheduler.dropped), (1, 1))
+        eq_(self.scheduler.cancels, {})
+
+    def test_cancel_replaces_are_limited(self):
+        order = TrackedOrder(1, market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2000,
+                             quantity=10000, order_id=1)
+        create = seto.OrderCreate(
+            market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2500, quantity=10000)
+
+        def replace():
+            self.scheduler.schedule(seto.OrderCancel(order_id=1))
+            self.scheduler.schedule(create, replaces=order)
+
+        # Charged against the limits of cancels and creates without a limit of their own
+        self.scheduler.set_limit('order_create', rate=1, burst=1)
+        self.scheduler.set_limit('order_cancel', rate=10, burst=1)
+        replace()
+        eq_(self.scheduler.flush(), 1)
+        replace()
+        eq_((self.scheduler.flush(), self.scheduler.next_send_delay()), (0, 1))
+        self.now = 1
+        eq_(self.scheduler.flush(), 1)
+
+        # Or against their own limit, even with no create tokens left
+        self.scheduler.set_limit('order_cancel_replace', rate=1, burst=1)
+        replace()
+        eq_(self.scheduler.flush(), 1)
+        replace()
+        eq_((self.scheduler.flush(), self.scheduler.next_send_delay()), (0, 1))
+        eq_([type(message) for message in self.sent()], [seto.OrderCancelReplace] * 3)
+
+    def test_creates_for_another_contract_or_side_arent_merged(self):
+        order = TrackedOrder(1, market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2000,
+                             quantity=10000, order_id=1)
+        self.scheduler.schedule(seto.OrderCancel(order_id=1))
+        creates = [
+            seto.OrderCreate(market_id=3, contract_id=5, side=seto.SIDE_BUY, price=2500, quantity=10000),
+            seto.OrderCreate(market_id=3, contract_id=4, side=seto.SIDE_SELL, price=2500, quantity=10000),
+            seto.OrderCreate(market_id=2, contract_id=4, side=seto.SIDE_BUY, price=2500, quantity=10000),
+        ]
+        for create in creates:
+            eq_(self.scheduler.schedule(create, replaces=order), True)
+        self.scheduler.flush()
+        eq_(self.sent(), [seto.OrderCancel(order_id=1)] + creates)
+        eq_(self.scheduler.merged, 0)
+
+    def test_creates_without_a_price_arent_merged(self):
+        order = TrackedOrder(1, market_id=3, contract_id=4, side=seto.SIDE_BUY, price=2000,
+                             quantity=10000, order_id=1)
+        self.scheduler.schedule(seto.OrderCancel(order_id=1))
+        create = seto.OrderCreate(market_id=3, contract_id=4, side=seto.SIDE_BUY, quantity=10000)
+        eq_(self.scheduler.schedule(create, replaces=order), True)
+        self.scheduler.flush()
+        eq_(self.sent(), [seto.OrderCancel(order_id=1), create])
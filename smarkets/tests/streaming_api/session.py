@@ -1,18 +1,282 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import socket
+
+from mock import Mock
 from nose.tools import eq_
-from smarkets.streaming_api.session import SessionSettings, Session
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_decode_all
+from smarkets.streaming_api.session import PayloadPool, SessionSettings, Session
 
 
 def test_next_frame_regression():
     settings = SessionSettings('username', 'password')
     session = Session(settings)
     session_string = '8zysBBGAD6nb95JDIO'
-    session.buffered_incoming_payloads = \
-        [bytearray(
+    session.buffered_incoming_payloads.append(
+        bytearray(
             b'\x08\x01\x12\x1e\x08\x01\x10\x08\x18\x002\x16\n\x12' +
             session_string.encode('utf-8') +
             b'\x10\x02'
-        )]
+        ))
     payload = session.next_frame().protobuf
     eq_(payload.eto_payload.login_response.session, session_string)
+
+
+def _logged_in_session():
+    session = Session(SessionSettings('username', 'password'))
+    session.socket._sock = Mock()
+    return session
+
+
+def _queue_pings(session, count):
+    payload = session.out_payload
+    for _ in range(count):
+        payload.Clear()
+        payload.type = seto.PAYLOAD_ETO
+        payload.eto_payload.type = eto.PAYLOAD_PING
+        session.send()
+
+
+def _sent_payloads(sent):
+    payloads, remaining = frame_decode_all(bytearray(sent))
+    eq_(remaining, b'')
+    return [seto.Payload.FromString(bytes(payload)) for payload in payloads]
+
+
+def test_flush_sends_all_queued_frames_at_once():
+    session = _logged_in_session()
+    sent = bytearray()
+
+    def sendmsg(buffers):
+        for buffer_ in buffers:
+            sent.extend(buffer_)
+        return len(sent)
+
+    session.socket._sock.sendmsg.side_effect = sendmsg
+    _queue_pings(session, 3)
+    session.flush()
+
+    eq_(session.socket._sock.sendmsg.call_count, 1)
+    eq_(session.output_buffer_size, 0)
+    eq_([payload.eto_payload.seq for payload in _sent_payloads(sent)], [1, 2, 3])
+
+
+def test_flush_keeps_unsent_data_after_partial_write():
+    session = _logged_in_session()
+    sent = bytearray()
+
+    def sendmsg(buffers):
+        # Only ever accept 5 bytes
+        data = b''.join(bytes(buffer_) for buffer_ in buffers)[:5]
+        sent.extend(data)
+        return len(data)
+
+    session.socket._sock.sendmsg.side_effect = sendmsg
+    _queue_pings(session, 4)
+    total_size = session.output_buffer_size
+    while session.output_buffer_size:
+        session.flush()
+        eq_(session.output_buffer_size, total_size - len(sent))
+
+    eq_([payload.eto_payload.seq for payload in _sent_payloads(sent)], [1, 2, 3, 4])
+
+
+def _buffer_payloads(session, seqs):
+    for seq in seqs:
+        payload = seto.Payload()
+        payload.type = seto.PAYLOAD_ETO
+        payload.eto_payload.seq = seq
+        payload.eto_payload.type = eto.PAYLOAD_PONG
+        session.buffered_incoming_payloads.append(payload.SerializeToString())
+
+
+def test_next_frames():
+    session = Session(SessionSettings('username', 'password'))
+    _buffer_payloads(session, range(1, 6))
+
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames(3)], [1, 2, 3])
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [4, 5])
+    eq_(session.next_frames(), [])
+    eq_(session.inseq, 6)
+
+
+def test_next_frames_skips_out_of_sequence_payloads():
+    session = Session(SessionSettings('username', 'password'))
+    _buffer_payloads(session, [1, 5, 2])
+
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames(2)], [1, 2])
+    eq_(len(session.buffered_incoming_payloads), 0)
+
+
+def test_next_frame_with_lazy_parsing():
+    session = Session(SessionSettings('username', 'password', lazy_parse=True))
+    _buffer_payloads(session, [1, 2])
+
+    frame = session.next_frame()
+    eq_((frame.type, frame.seq, frame.eto_type), (seto.PAYLOAD_ETO, 1, eto.PAYLOAD_PONG))
+    eq_(frame._protobuf, None)
+    eq_(frame.protobuf.eto_payload.seq, 1)
+    eq_(session.next_frame().seq, 2)
+
+
+def test_lazy_parsing_still_handles_login_response():
+    session = Session(SessionSettings('username', 'password', lazy_parse=True))
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_ETO
+    payload.eto_payload.seq = 1
+    payload.eto_payload.type = eto.PAYLOAD_LOGIN_RESPONSE
+    payload.eto_payload.login_response.session = 'session'
+    payload.eto_payload.login_response.reset = 5
+    session.buffered_incoming_payloads.append(payload.SerializeToString())
+
+    session.next_frame()
+    eq_(session.session, 'session')
+    eq_(session.buf_outseq, 5)
+
+
+def test_payloads_are_reused_with_pooling():
+    for lazy_parse in (False, True):
+        yield check_payloads_are_reused_with_pooling, lazy_parse
+
+
+def check_payloads_are_reused_with_pooling(lazy_parse):
+    session = Session(SessionSettings('username', 'password', lazy_parse=lazy_parse, payload_pool_size=2))
+    _buffer_payloads(session, range(1, 11))
+
+    payloads = set()
+    for seq in range(1, 11):
+        frame = session.next_frame()
+        eq_(frame.protobuf.eto_payload.seq, seq)
+        payloads.add(id(frame.protobuf))
+        session.release_frame(frame)
+
+    eq_(len(payloads), 1)
+    eq_((session.payload_pool.acquired, session.payload_pool.allocated), (10, 1))
+    eq_(session.payload_pool.allocations_per_payload, 0.1)
+
+
+def test_payload_pool_size_is_bounded():
+    pool = PayloadPool(1)
+    payloads = [pool.acquire() for _ in range(3)]
+    for payload in payloads:
+        pool.release(payload)
+
+    assert pool.acquire() is payloads[0]
+    pool.acquire()
+    eq_((pool.acquired, pool.allocated), (5, 4))
+
+
+def test_released_twice_frames_dont_share_payloads():
+    for lazy_parse in (False, True):
+        yield check_released_twice_frames_dont_share_payloads, lazy_parse
+
+
+def check_released_twice_frames_dont_share_payloads(lazy_parse):
+    session = Session(SessionSettings('username', 'password', lazy_parse=lazy_parse, payload_pool_size=2))
+    _buffer_payloads(session, range(1, 4))
+    frame = session.next_frame()
+    frame.protobuf
+    session.release_frame(frame)
+    session.release_frame(frame)
+
+    second, third = session.next_frame(), session.next_frame()
+    assert second.protobuf is not third.protobuf
+    eq_((second.protobuf.eto_payload.seq, third.protobuf.eto_payload.seq), (2, 3))
+
+
+def test_non_blocking_socket_that_is_not_ready():
+    session = Session(SessionSettings('username', 'password'))
+    session.socket._sock, server = socket.socketpair()
+    session.socket._sock.setblocking(False)
+    try:
+        eq_(session.socket.recv(), b'')
+
+        # Nothing reads from the other end, eventually the socket can't take any more data
+        _queue_pings(session, 50000)
+        for _ in range(20):
+            session.flush()
+        assert session.output_buffer_size
+    finally:
+        session.socket._sock.close()
+        server.close()
+
+
+def _pings_stream(count):
+    sender = _logged_in_session()
+    _queue_pings(sender, count)
+    return b''.join(bytes(chunk) for chunk in sender.send_queue)
+
+
+def test_read_receives_into_the_decoder_buffer():
+    session = Session(SessionSettings('username', 'password'))
+    session.settings.read_chunksize = 16
+    session.socket._sock, server = socket.socketpair()
+    try:
+        server.sendall(bytes(_pings_stream(10)))
+        while len(session.buffered_incoming_payloads) < 10:
+            session.read()
+        eq_([seto.Payload.FromString(bytes(payload)).eto_payload.seq
+             for payload in session.buffered_incoming_payloads], list(range(1, 11)))
+    finally:
+        session.socket._sock.close()
+        server.close()
+
+
+def _reading_session(received_sizes, frames, **settings):
+    "A session whose reads return `received_sizes` bytes, decoding `frames` frames each"
+    session = Session(SessionSettings('username', 'password', **settings))
+    session.socket.recv_into = Mock(side_effect=received_sizes)
+    session.decoder = Mock()
+    session.decoder.decode.return_value = [b'payload'] * frames
+    return session
+
+
+def test_read_records_read_sizes_and_frames():
+    session = _reading_session([100, 0, 3000], frames=2)
+    for _ in range(3):
+        session.read()
+
+    eq_(session.read_sizes.buckets(), [(127, 1), (4095, 1)])
+    eq_(session.frames_per_read.buckets(), [(3, 2)])
+    eq_(session.read_chunksize, 65536)
+
+
+def test_read_size_follows_the_settings_unless_adaptive():
+    session = _reading_session([100, 100], frames=1)
+    session.settings.read_chunksize = 1024
+    session.read()
+    eq_(session.decoder.writable.call_args[0][0], 1024)
+
+    session.settings.adaptive_read = True
+    session.read()
+    eq_(session.decoder.writable.call_args[0][0], 65536)
+
+
+def test_adaptive_read_grows_when_reads_fill_the_buffer():
+    session = _reading_session([65536, 131072, 262144], frames=10, adaptive_read=True,
+                               max_read_chunksize=200000)
+    sizes = []
+    for _ in range(3):
+        session.read()
+        sizes.append(session.read_chunksize)
+
+    eq_(sizes, [131072, 200000, 200000])
+
+
+def test_adaptive_read_grows_when_no_frame_is_complete():
+    session = _reading_session([1000], frames=0, adaptive_read=True)
+    session.read()
+    eq_(session.read_chunksize, 131072)
+
+
+def test_adaptive_read_shrinks_after_small_reads():
+    session = _reading_session([100] * 100, frames=1, adaptive_read=True, min_read_chunksize=16384)
+    sizes = set()
+    for _ in range(100):
+        session.read()
+        sizes.add(session.read_chunksize)
+
+    eq_(sorted(sizes), [16384, 32768, 65536])
+    eq_(session.read_chunksize, 16384)
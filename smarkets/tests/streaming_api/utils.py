@@ -1,9 +1,16 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from nose.tools import eq_
+from nose.tools import eq_, raises
 
-from smarkets.streaming_api.seto import OrderCreate, Payload, PAYLOAD_ORDER_CREATE
-from smarkets.streaming_api.utils import set_payload_message
+from smarkets.streaming_api import eto
+from smarkets.streaming_api.exceptions import ParseError
+from smarkets.streaming_api.seto import (
+    OrderCancel, OrderCreate, Payload, PAYLOAD_ETO, PAYLOAD_ORDER_ACCEPTED, PAYLOAD_ORDER_CANCEL,
+    PAYLOAD_ORDER_CREATE,
+)
+from smarkets.streaming_api.utils import (
+    payload_field, payload_message, peek_payload, set_payload_message, wrap,
+)
 
 
 def test_set_payload_message():
@@ -14,3 +21,86 @@ def test_set_payload_message():
     set_payload_message(payload, oc)
     eq_(payload.type, PAYLOAD_ORDER_CREATE)
     eq_(payload.order_create, oc)
+
+
+def test_payload_field():
+    payload_type, field = payload_field(OrderCreate)
+    eq_((payload_type, field.name), (PAYLOAD_ORDER_CREATE, 'order_create'))
+    payload_type, field = payload_field(OrderCancel)
+    eq_((payload_type, field.name), (PAYLOAD_ORDER_CANCEL, 'order_cancel'))
+
+
+@raises(TypeError)
+def test_payload_field_of_other_messages():
+    payload_field(eto.Payload)
+
+
+def test_wrap():
+    oc = OrderCreate(quantity=123456)
+    payload = wrap(oc)
+    eq_((payload.type, payload.order_create), (PAYLOAD_ORDER_CREATE, oc))
+
+    # Reusing a payload
+    cancel = OrderCancel(order_id=1)
+    eq_(wrap(cancel, payload), Payload(type=PAYLOAD_ORDER_CANCEL, order_cancel=cancel))
+
+
+def test_payload_message():
+    payload = wrap(OrderCreate(quantity=123456))
+    cancel = payload_message(payload, OrderCancel)
+    eq_(payload, Payload(type=PAYLOAD_ORDER_CANCEL, order_cancel=OrderCancel()))
+    assert payload.HasField('order_cancel')
+
+    cancel.order_id = 1
+    eq_(payload.order_cancel.order_id, 1)
+
+    payload_message(payload, 'order_create').quantity = 1
+    eq_(payload, wrap(OrderCreate(quantity=1)))
+
+
+@raises(ValueError)
+def test_payload_message_of_unknown_field():
+    payload_message(Payload(), 'eto_payload')
+
+
+def test_peek_payload():
+    for payload in _payloads_to_peek():
+        yield check_peek_payload, payload
+
+
+def _payloads_to_peek():
+    heartbeat = Payload(type=PAYLOAD_ETO)
+    heartbeat.eto_payload.seq = 3
+    heartbeat.eto_payload.type = eto.PAYLOAD_HEARTBEAT
+    yield heartbeat
+
+    accepted = Payload(type=PAYLOAD_ORDER_ACCEPTED)
+    accepted.eto_payload.seq = 2 ** 40
+    accepted.order_accepted.seq = 1
+    accepted.order_accepted.order_id = 2
+    yield accepted
+
+    replay = Payload(type=PAYLOAD_ETO)
+    replay.eto_payload.seq = 300
+    replay.eto_payload.is_replay = True
+    yield replay
+
+    login_response = Payload(type=PAYLOAD_ETO)
+    login_response.eto_payload.seq = 1
+    login_response.eto_payload.type = eto.PAYLOAD_LOGIN_RESPONSE
+    login_response.eto_payload.login_response.session = 'x' * 200
+    yield login_response
+
+
+def check_peek_payload(payload):
+    expected = (payload.type, payload.eto_payload.seq, payload.eto_payload.type)
+    data = payload.SerializeToString()
+    eq_(peek_payload(data), expected)
+    eq_(peek_payload(memoryview(bytearray(data))), expected)
+
+
+@raises(ParseError)
+def test_peek_payload_fails_on_truncated_payload():
+    payload = Payload(type=PAYLOAD_ORDER_ACCEPTED)
+    payload.eto_payload.seq = 2 ** 40
+    peek_payload(payload.SerializeToString()[:6])